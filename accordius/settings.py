@@ -134,3 +134,118 @@ STATIC_URL = '/static/'
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
 }
+
+# Tags
+
+# How many seconds the in-memory tag autocomplete index may serve before it's
+# reloaded to pick up tags created by other server processes
+TAG_INDEX_MAX_AGE = 300
+
+# Search
+
+# Which full text search backend to use, one of 'auto', 'sqlite', 'postgres' or
+# 'scan'. 'auto' picks the index for the database in use and falls back to
+# 'scan', which searches without an index.
+SEARCH_BACKEND = 'auto'
+
+# When a search's parameters (author:, after:, etc) narrow it down to at most
+# this many documents, their bodies are matched directly instead of searching
+# the whole full text index
+SEARCH_SCOPE_THRESHOLD = 1000
+
+# Default and maximum number of search results per page
+SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE_MAX = 200
+
+# Search responses count matching documents up to this many
+SEARCH_COUNT_LIMIT = 1000
+
+# Number of parsed search strings to keep in the search plan cache
+SEARCH_PLAN_CACHE_SIZE = 1024
+
+# Groups of words or phrases that search treats as meaning the same thing.
+# Searching for any unquoted member of a group also finds the others.
+SEARCH_SYNONYMS = [
+    ["ai", "artificial intelligence"],
+    ["ea", "effective altruism"],
+    ["lw", "lesswrong", "less wrong"],
+]
+
+# Which fuzzy title and name lookup backend to use, one of 'auto', 'local' or
+# 'postgres'. 'auto' uses pg_trgm on Postgres and an in-process trigram index
+# everywhere else.
+FUZZY_BACKEND = 'auto'
+
+# How old in seconds the in-process trigram index can get before it's
+# reloaded, to pick up changes from other processes
+FUZZY_INDEX_MAX_AGE = 300
+
+# How similar (0 to 1) a title or name has to be to match a fuzzy lookup when
+# it doesn't contain the search text outright
+FUZZY_SIMILARITY_THRESHOLD = 0.3
+
+# How long in seconds AuthHeaderMiddleware caches which user a session key
+# belongs to, and how many session keys and users it caches
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_SIZE = 10000
+
+# Where sessions are kept, one of 'db', 'cached_db' (the database, read
+# through the cache) or 'signed' (no storage, the session key is signed
+# session data). 'cached_db' needs CACHES to point every server process at
+# the same cache, otherwise sessions logged out in one process stay valid in
+# the others. See lw2/sessions.py.
+SESSION_STORE = 'db'
+SESSION_ENGINE = {
+    'db':'django.contrib.sessions.backends.db',
+    'cached_db':'django.contrib.sessions.backends.cached_db',
+    'signed':'django.contrib.sessions.backends.signed_cookies',
+}[SESSION_STORE]
+
+# How often in seconds each process checks whether bans have changed, and how
+# old its copy of the active bans can get before it's reloaded regardless
+BAN_SET_CHECK_INTERVAL = 5
+BAN_SET_MAX_AGE = 300
+
+# How notifications are created for new comments and messages: 'thread' hands
+# them to a background thread, 'inline' creates them during the request
+NOTIFICATION_FANOUT = 'thread'
+
+# How long in seconds the fan-out thread waits for more events to batch with
+# the first one it takes, how many events a batch holds at most, and how many
+# events can wait in the queue before new ones are handled inline
+NOTIFICATION_FANOUT_DELAY = 1.0
+NOTIFICATION_BATCH_SIZE = 500
+NOTIFICATION_QUEUE_SIZE = 10000
+
+# How /api/events/ hears about notifications created by other server
+# processes: 'poll' checks the database every NOTIFICATION_EVENTS_POLL_INTERVAL
+# seconds while clients are waiting, 'local' only hears about this process's
+NOTIFICATION_EVENTS_NOTIFIER = 'poll'
+NOTIFICATION_EVENTS_POLL_INTERVAL = 2
+# The longest a long-poll waits before answering with nothing, in seconds, and
+# how long an event stream stays open before the client has to reconnect
+NOTIFICATION_EVENTS_TIMEOUT = 30
+NOTIFICATION_EVENTS_STREAM_SECONDS = 300
+# How many days viewed notifications are kept before prune_notifications
+# deletes them
+NOTIFICATION_RETENTION_DAYS = 90
+
+# Messages
+
+# Default and maximum number of messages per MessagesList page
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_SIZE_MAX = 200
+# Default and maximum number of conversations per ConversationsList page
+INBOX_PAGE_SIZE = 50
+INBOX_PAGE_SIZE_MAX = 200
+
+# Comments
+
+# Default and maximum number of comments per CommentsList page, for the views
+# that page
+COMMENTS_PAGE_SIZE = 50
+COMMENTS_PAGE_SIZE_MAX = 200
+
+# The most comments a threaded view shows, however deep and wide the thread,
+# see lw2/comments.py
+COMMENT_TREE_MAX_NODES = 500
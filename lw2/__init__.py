@@ -0,0 +1 @@
+default_app_config = 'lw2.apps.Lw2Config'
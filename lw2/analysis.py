@@ -0,0 +1,75 @@
+from django.conf import settings
+from functools import lru_cache
+import re
+
+"""Word analysis shared by search indexing and querying.
+
+The full text index stems words as it indexes them, with the porter tokenizer
+on SQLite and the english text search configuration on Postgres. Queries are
+stemmed the same way by the index, so this module only deals with what the
+index can't do:
+
+- stem() is a light English suffix stripper for the places that search
+  without the index, like the scan backend and snippet highlighting. Stems
+  are memoized, so each distinct word is only analyzed once per process.
+
+- SynonymTable maps analyzed words to the synonyms configured in
+  settings.SEARCH_SYNONYMS. The table is built once, after which expanding a
+  query term is a dict lookup."""
+
+VOWELS = re.compile("[aeiouy]")
+# Doubled consonants left behind by stripping -ing and -ed, as in 'running'
+DOUBLED = re.compile(r"([^aeioulsz])\1$")
+
+@lru_cache(maxsize=65536)
+def stem(word):
+    """Strip plural, -ing and -ed endings from a lowercase word."""
+    if len(word) <= 3 or not word.isalpha():
+        return word
+    if word.endswith("ies") and not word.endswith(("aies", "eies")):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "xes", "zes", "ches", "shes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    for suffix in ("ing", "ed"):
+        if word.endswith(suffix):
+            root = word[:-len(suffix)]
+            if len(root) >= 3 and VOWELS.search(root):
+                return DOUBLED.sub(r"\1", root)
+    return word
+
+def analyze(text):
+    """Return the key for a word or phrase: lowercased, with each word
+    stemmed."""
+    return " ".join(stem(word) for word in text.lower().split())
+
+class SynonymTable(object):
+    """Lookup table from analyzed words and phrases to their synonyms.
+
+    groups is a list of lists of words or phrases that mean the same thing,
+    e.g [["ai", "artificial intelligence"]]. Every member of a group expands
+    to all the others."""
+    def __init__(self, groups):
+        self.table = {}
+        for group in groups:
+            members = tuple(" ".join(member.lower().split()) for member in group)
+            for member in members:
+                self.table.setdefault(analyze(member), set()).update(
+                    other for other in members if analyze(other) != analyze(member))
+        self.table = {key:tuple(sorted(synonyms))
+                      for key, synonyms in self.table.items() if synonyms}
+
+    def synonyms(self, text):
+        """The synonyms of a word or phrase, as a tuple."""
+        return self.table.get(analyze(text), ())
+
+_tables = {}
+
+def get_synonym_table():
+    """Return the SynonymTable for settings.SEARCH_SYNONYMS."""
+    groups = tuple(tuple(group) for group in
+                   getattr(settings, "SEARCH_SYNONYMS", ()))
+    if groups not in _tables:
+        _tables[groups] = SynonymTable(groups)
+    return _tables[groups]
@@ -1,5 +1,59 @@
 from django.apps import AppConfig
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
 
 
 class Lw2Config(AppConfig):
     name = 'lw2'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from lw2 import auth_header, bans, comments, fulltext, fuzzy
+        from lw2.models import Post, Comment, Profile, Ban
+        # Keep comments' places in their threads
+        post_init.connect(comments.remember_place, sender=Comment,
+                          dispatch_uid="lw2_comment_place")
+        pre_save.connect(comments.assign_path, sender=Comment,
+                         dispatch_uid="lw2_comment_path")
+        post_save.connect(comments.move_subtree, sender=Comment,
+                          dispatch_uid="lw2_comment_move_subtree")
+        # Keep the full text search index in step with the content
+        post_init.connect(fulltext.remember_indexed_fields, sender=Post,
+                          dispatch_uid="lw2_remember_indexed_post")
+        post_init.connect(fulltext.remember_indexed_fields, sender=Comment,
+                          dispatch_uid="lw2_remember_indexed_comment")
+        post_save.connect(fulltext.index_post, sender=Post,
+                          dispatch_uid="lw2_index_post")
+        post_save.connect(fulltext.index_comment, sender=Comment,
+                          dispatch_uid="lw2_index_comment")
+        post_delete.connect(fulltext.unindex_post, sender=Post,
+                            dispatch_uid="lw2_unindex_post")
+        post_delete.connect(fulltext.unindex_comment, sender=Comment,
+                            dispatch_uid="lw2_unindex_comment")
+        # And the fuzzy lookup indexes in step with titles and names
+        post_save.connect(fuzzy.index_post, sender=Post,
+                          dispatch_uid="lw2_fuzzy_index_post")
+        post_delete.connect(fuzzy.unindex_post, sender=Post,
+                            dispatch_uid="lw2_fuzzy_unindex_post")
+        post_save.connect(fuzzy.index_user, sender=User,
+                          dispatch_uid="lw2_fuzzy_index_user")
+        post_save.connect(fuzzy.index_profile, sender=Profile,
+                          dispatch_uid="lw2_fuzzy_index_profile")
+        post_delete.connect(fuzzy.unindex_user, sender=User,
+                            dispatch_uid="lw2_fuzzy_unindex_user")
+        # Drop cached header authentication when it stops being valid
+        user_logged_out.connect(auth_header.user_logged_out,
+                                dispatch_uid="lw2_auth_logged_out")
+        post_save.connect(auth_header.user_changed, sender=User,
+                          dispatch_uid="lw2_auth_user_saved")
+        post_delete.connect(auth_header.user_changed, sender=User,
+                            dispatch_uid="lw2_auth_user_deleted")
+        post_save.connect(auth_header.ban_changed, sender=Ban,
+                          dispatch_uid="lw2_auth_ban_saved")
+        post_delete.connect(auth_header.ban_changed, sender=Ban,
+                            dispatch_uid="lw2_auth_ban_deleted")
+        # Keep the in-memory set of banned users current
+        post_save.connect(bans.ban_changed, sender=Ban,
+                          dispatch_uid="lw2_ban_set_saved")
+        post_delete.connect(bans.ban_changed, sender=Ban,
+                            dispatch_uid="lw2_ban_set_deleted")
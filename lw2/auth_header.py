@@ -1,6 +1,132 @@
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
 from django.contrib.auth.models import User
-from django.contrib.sessions.backends.db import SessionStore
-import pdb
+from django.utils.crypto import constant_time_compare
+from django.http import HttpResponse
+from lw2.bans import active_bans
+from lw2.user_context import load_user
+from importlib import import_module
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+"""Authentication by a session key sent in the Authorization header.
+
+API clients send the session key from the Login mutation with every request,
+so resolving it is cached: session keys map to user ids, and user ids to
+user objects as loaded by lw2.user_context.load_user(), for
+settings.AUTH_CACHE_TTL seconds each. Unknown and expired session keys are
+cached too, as belonging to nobody, and leave the request anonymous.
+
+The caches are per process. Logging out, saving a user (which is how
+passwords get changed) and banning a user drop that user's entries in this
+process straight away, other processes see the change within the TTL.
+
+Banned users are refused with a 403 carrying their ban message, checked 
+against lw2.bans.active_bans on every request."""
+
+class TTLCache(object):
+    """A dict whose entries expire, holding at most max_size of them. When
+    full, the oldest entry is dropped to make room. Values must be hashable,
+    they're indexed for pop_value()."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Value: the keys holding it
+        self.keys = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                self.remove(key)
+                return default
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.keys.setdefault(value, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Drop key's entry, with the lock held."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.keys[entry[0]]
+            keys.discard(key)
+            if not keys:
+                del self.keys[entry[0]]
+
+    def pop(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def pop_value(self, value):
+        """Drop every entry whose value is value."""
+        with self.lock:
+            for key in list(self.keys.get(value, ())):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+# Cached for session keys that don't belong to anyone
+NO_USER = 0
+
+session_users = TTLCache(getattr(settings, "AUTH_CACHE_SIZE", 10000))
+users = TTLCache(getattr(settings, "AUTH_CACHE_SIZE", 10000))
+
+def get_ttl():
+    return getattr(settings, "AUTH_CACHE_TTL", 60)
+
+def get_user(user_id):
+    """Return a private copy of the active user with user_id, or None."""
+    user = users.get(user_id)
+    if user is None:
+        try:
+            user = load_user(user_id)
+        except (User.DoesNotExist, ValueError):
+            return None
+        users.set(user.id, user, get_ttl())
+    if not user.is_active:
+        return None
+    # Requests are free to modify their user, so don't hand out the cached one
+    return copy.deepcopy(user)
+
+def get_session_user(session_key):
+    """Return the user logged in with session_key, or None if the session
+    doesn't exist, has expired or was invalidated by a password change."""
+    user_id = session_users.get(session_key)
+    if user_id == NO_USER:
+        return None
+    if user_id is not None:
+        return get_user(user_id)
+    session = import_module(settings.SESSION_ENGINE).SessionStore(
+        session_key=session_key)
+    user = None
+    if session.get(SESSION_KEY) is not None:
+        user = get_user(session[SESSION_KEY])
+    if user is None or not constant_time_compare(
+            session.get(HASH_SESSION_KEY, ""), user.get_session_auth_hash()):
+        session_users.set(session_key, NO_USER, get_ttl())
+        return None
+    session_users.set(session_key, user.id, get_ttl())
+    return user
+
+def invalidate_user(user_id):
+    """Forget the cached user and every session key cached as theirs."""
+    users.pop(user_id)
+    session_users.pop_value(user_id)
 
 class AuthHeaderMiddleware(object):
     def __init__(self, get_response):
@@ -10,9 +136,22 @@ class AuthHeaderMiddleware(object):
         if not authorization:
             response = self.get_response(request)
             return response
-        # TODO: Add code to handle session expiration
-        request.user = User.objects.get(
-            id = SessionStore(session_key = authorization).get('_auth_user_id')
-        )
+        user = get_session_user(authorization)
+        if user is not None:
+            ban = active_bans.get(user.id)
+            if ban is not None:
+                return HttpResponse("Banned until {}: {}".format(
+                    ban[0].isoformat(), ban[1]), status=403)
+            request.user = user
         response = self.get_response(request)
         return response
+
+def user_logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.id)
+
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+def ban_changed(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
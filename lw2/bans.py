@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from lw2.models import Ban, BanSetVersion
+import threading
+import time
+
+"""The set of currently banned users, kept in memory.
+
+Checking whether a user is banned is a dict lookup in active_bans. A ban
+stops counting at its until date without any bookkeeping, since lookups
+compare against the current time.
+
+Every change to a ban bumps the version number in the BanSetVersion row,
+from the model's post_save and post_delete signals. That's in the same
+transaction as the change when it's made inside atomic(), and otherwise
+commits just after it, so the bump never shows before the change it's for.
+Processes compare their copy's version against it at most every
+BAN_SET_CHECK_INTERVAL seconds, a single row read by primary key, and
+reload when it's moved on, so a ban takes effect everywhere within that
+interval. The set is also reloaded once it's older
+than BAN_SET_MAX_AGE seconds, in case bans were changed without going
+through the model's signals."""
+
+VERSION_ID = 1
+
+def current_version():
+    return BanSetVersion.objects.filter(id=VERSION_ID).values_list(
+        "version", flat=True).first()
+
+class BanSet(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bans = {}
+        self.version = None
+        self.loaded_at = None
+        self.checked_at = None
+
+    def load(self):
+        """Reload the active bans from the database."""
+        version = current_version()
+        bans = {}
+        for user_id, until, message in Ban.objects.filter(
+                until__gt=timezone.now()).order_by("until").values_list(
+                    "user_id", "until", "ban_message"):
+            # Ordered by until, so the longest running ban wins
+            bans[user_id] = (until, message)
+        now = time.monotonic()
+        with self.lock:
+            self.bans = bans
+            self.version = version
+            self.loaded_at = self.checked_at = now
+
+    def invalidate(self):
+        """Drop the set so it's reloaded on next use."""
+        with self.lock:
+            self.loaded_at = None
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self.loaded_at is None or (
+                now - self.loaded_at > getattr(settings, "BAN_SET_MAX_AGE", 300)):
+            self.load()
+        elif now - self.checked_at > getattr(settings, "BAN_SET_CHECK_INTERVAL", 5):
+            self.checked_at = now
+            if current_version() != self.version:
+                self.load()
+
+    def get(self, user_id):
+        """Return (until, ban_message) for the user's active ban, or None."""
+        self.ensure_fresh()
+        ban = self.bans.get(user_id)
+        if ban is None or ban[0] <= timezone.now():
+            return None
+        return ban
+
+    def banned_until(self, user_id):
+        ban = self.get(user_id)
+        return ban[0] if ban else None
+
+    def changed(self):
+        """Note that bans were changed by this process: bump the shared
+        version so other processes reload, and reload here right away."""
+        if not BanSetVersion.objects.filter(id=VERSION_ID).update(
+                version=F("version") + 1):
+            version, created = BanSetVersion.objects.get_or_create(
+                id=VERSION_ID, defaults={"version":1})
+            if not created:
+                # Someone else made the row first
+                BanSetVersion.objects.filter(id=VERSION_ID).update(
+                    version=F("version") + 1)
+        self.load()
+
+active_bans = BanSet()
+
+def ban_changed(sender, instance, **kwargs):
+    active_bans.changed()
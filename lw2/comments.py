@@ -0,0 +1,325 @@
+from django.conf import settings
+from django.db.models import Count, Value
+from django.db.models.functions import Concat, Substr
+from django.utils.timezone import is_naive, make_aware
+from lw2.models import Comment
+from datetime import datetime, timedelta, timezone
+import base64
+import hashlib
+import json
+
+"""Comment threads, read in display order straight from the database.
+
+Every comment has a materialized path: its parent's path followed by a
+segment of its own. Segments are the time it was posted, in fixed width
+base 36 so they sort the same as the times, followed by a few characters of
+a hash of its id to tell apart comments posted in the same microsecond. So
+ordering a post's comments by path lists each comment after its parent and
+before its parent's later replies, earliest replies first, which is the
+order threads are shown in. A subtree is the comments whose path starts with
+its root's, and ancestors are the comments whose paths are prefixes of it.
+
+Paths are only ever digits and lowercase letters, which sort the same way
+under every collation. They're kept up to date as comments are saved by
+assign_path() and move_subtree().
+
+Big threads can be read in pieces. load_tree() follows replies down from
+some comments a level at a time, at most max_depth levels, max_children
+replies per comment and COMMENT_TREE_MAX_NODES comments in all, and notes
+for every comment whose replies were cut off how many more there are and a
+cursor to carry on from with branch(). Top level comments come a page at a
+time from thread_roots().
+
+The LW 2 comment list views are in VIEWS, each a page of comments read along
+an index of its own. Those indexes are partial, leaving out deleted
+comments, so the views exclude them with the same condition the indexes
+were made with."""
+
+TIME_LENGTH = 11
+HASH_LENGTH = 8
+SEGMENT_LENGTH = TIME_LENGTH + HASH_LENGTH
+# How deep threads go, limited by the size of Comment.path
+MAX_DEPTH = 100
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def base36(number, width):
+    digits = []
+    while number:
+        number, digit = divmod(number, 36)
+        digits.append(DIGITS[digit])
+    return "".join(reversed(digits)).rjust(width, "0")[-width:]
+
+def path_segment(comment_id, posted_at):
+    if is_naive(posted_at):
+        # As CommentsNew makes them, read the way the database will store it
+        posted_at = make_aware(posted_at)
+    microseconds = (posted_at - EPOCH) // timedelta(microseconds=1)
+    return (base36(max(microseconds, 0), TIME_LENGTH) +
+            hashlib.md5(comment_id.encode("utf-8")).hexdigest()[:HASH_LENGTH])
+
+def build_path(comment):
+    """Work out the path comment should have."""
+    segment = path_segment(comment.id, comment.posted_at)
+    parent = comment.parent_comment
+    if parent is None:
+        return segment
+    parent_path = parent.path or build_path(parent)
+    if len(parent_path) // SEGMENT_LENGTH >= MAX_DEPTH:
+        raise ValueError("Replies can't be nested more than {} deep".format(MAX_DEPTH))
+    return parent_path + segment
+
+def depth(comment):
+    """How many ancestors comment has."""
+    return len(comment.path) // SEGMENT_LENGTH - 1
+
+def thread(post_id):
+    """All of a post's comments, in display order."""
+    return Comment.objects.filter(post_id=post_id).order_by("path")
+
+def subtree(comment):
+    """comment and all the replies under it, in display order."""
+    return Comment.objects.filter(
+        post_id=comment.post_id, path__startswith=comment.path).order_by("path")
+
+def ancestors(comment):
+    """The comments comment is a reply to, from the top of the thread down."""
+    paths = [comment.path[:end] for end in range(
+        SEGMENT_LENGTH, len(comment.path), SEGMENT_LENGTH)]
+    return Comment.objects.filter(post_id=comment.post_id, path__in=paths).order_by("path")
+
+# Matches the condition on the comment view indexes, see migration 0038.
+# filter(is_deleted=False) would pass False as a query parameter, and SQLite
+# only uses a partial index when it can tell from the query text alone that
+# the index's condition holds, so it'd pass the indexes over.
+NOT_DELETED = 'NOT "{}"."is_deleted"'.format(Comment._meta.db_table)
+
+def not_deleted(comments):
+    return comments.extra(where=[NOT_DELETED])
+
+def recent_comments(post_id=None, user_id=None):
+    """Comments across the site with a positive score, newest first."""
+    return not_deleted(Comment.objects.filter(base_score__gt=0)).order_by("-posted_at")
+
+def all_recent_comments(post_id=None, user_id=None):
+    """Comments across the site, newest first."""
+    return not_deleted(Comment.objects.all()).order_by("-posted_at")
+
+def post_comments_top(post_id=None, user_id=None):
+    """A post's comments, highest scoring first."""
+    return not_deleted(Comment.objects.filter(post_id=post_id)).order_by(
+        "-base_score", "-posted_at")
+
+def post_comments_new(post_id=None, user_id=None):
+    """A post's comments, newest first."""
+    return not_deleted(Comment.objects.filter(post_id=post_id)).order_by("-posted_at")
+
+def user_comments(post_id=None, user_id=None):
+    """A user's comments, newest first."""
+    return not_deleted(Comment.objects.filter(user_id=user_id)).order_by("-posted_at")
+
+# View name: (function, which of post_id and user_id it needs)
+VIEWS = {
+    "recentComments": (recent_comments, None),
+    "allRecentComments": (all_recent_comments, None),
+    "postCommentsTop": (post_comments_top, "post_id"),
+    "postCommentsNew": (post_comments_new, "post_id"),
+    "userComments": (user_comments, "user_id"),
+}
+
+def page_size(limit):
+    """How many comments a page holds: limit up to COMMENTS_PAGE_SIZE_MAX,
+    COMMENTS_PAGE_SIZE by default."""
+    size = limit if limit and limit > 0 else getattr(settings, "COMMENTS_PAGE_SIZE", 50)
+    return min(size, getattr(settings, "COMMENTS_PAGE_SIZE_MAX", 200))
+
+def list_view(view, post_id=None, user_id=None, limit=None, offset=0):
+    """A page of the view's comments, see page_size()."""
+    function, needs = VIEWS[view]
+    if needs and not {"post_id":post_id, "user_id":user_id}[needs]:
+        raise ValueError("The {} view needs a {}".format(
+            view, "postId" if needs == "post_id" else "userId"))
+    offset = max(offset or 0, 0)
+    return function(post_id=post_id, user_id=user_id)[offset:offset + page_size(limit)]
+
+# The most replies per comment a tree or branch can ask for
+MAX_CHILDREN_LIMIT = 100
+
+def encode_cursor(parent_id, after):
+    return base64.urlsafe_b64encode(json.dumps(
+        {"parent":parent_id, "after":after}).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        fields = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return str(fields["parent"]), str(fields["after"])
+    except (ValueError, TypeError, KeyError, UnicodeError, AttributeError):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+
+def clamp_children(max_children):
+    """max_children within MAX_CHILDREN_LIMIT, which is also the default."""
+    if max_children is None:
+        return MAX_CHILDREN_LIMIT
+    return min(max(max_children, 0), MAX_CHILDREN_LIMIT)
+
+def first_replies(parent_id, after, max_children):
+    """The ids and paths of the first max_children replies to parent_id
+    whose paths come after after, and one more if there is one, read along
+    the index on parent and path."""
+    return list(Comment.objects.filter(
+        parent_comment_id=parent_id, path__gt=after).order_by("path").values_list(
+            "id", "path")[:max_children + 1])
+
+def replies_to(parent_ids, max_children):
+    """A dict from those of parent_ids with replies to the ids and paths of
+    their first max_children replies, and one more if there is one.
+
+    Each query reads at most max_children + 1 rows per parent still
+    wanted, along the index on parent and path. A parent with more replies
+    than that can crowd out the ones after it, which are read again by the
+    next query, so it takes one query per level unless that happens."""
+    replies = {}
+    wanted = list(parent_ids)
+    while wanted:
+        limit = len(wanted) * (max_children + 1)
+        rows = list(Comment.objects.filter(
+            parent_comment_id__in=wanted).order_by("parent_comment_id", "path").values_list(
+                "parent_comment_id", "id", "path")[:limit])
+        for parent_id, comment_id, path in rows:
+            children = replies.setdefault(parent_id, [])
+            if len(children) <= max_children:
+                children.append((comment_id, path))
+        if len(rows) < limit:
+            break
+        # Every parent before the last one read was read to the end
+        last = rows[-1][0]
+        if len(replies[last]) <= max_children:
+            del replies[last]
+        wanted = [parent_id for parent_id in wanted if parent_id not in replies]
+    return replies
+
+def count_replies(parent_ids, after=""):
+    """A dict from those of parent_ids with replies after after to how many."""
+    return dict(Comment.objects.filter(
+        parent_comment_id__in=parent_ids, path__gt=after).order_by().values(
+            "parent_comment_id").annotate(count=Count("id")).values_list(
+                "parent_comment_id", "count"))
+
+# The most comments a tree from load_tree() shows by default
+TREE_MAX_NODES = 500
+
+def prune(root_ids, max_depth=None, max_children=MAX_CHILDREN_LIMIT, max_nodes=None):
+    """Follow replies down from the comments with root_ids, within the
+    budget. Returns the ids of the comments to show, and a dict from the ids
+    of comments with replies left out to (how many, cursor).
+
+    Each level down is read with replies_to() and at most max_nodes
+    comments are shown in all, COMMENT_TREE_MAX_NODES by default. The
+    replies left out are only counted, so the cost depends on the budget
+    rather than on how big the thread is."""
+    if max_nodes is None:
+        max_nodes = getattr(settings, "COMMENT_TREE_MAX_NODES", TREE_MAX_NODES)
+    shown_ids = list(root_ids)
+    more = {}
+    # Parent id: (path of the last reply shown, how many were shown)
+    cut = {}
+    frontier = list(root_ids)
+    level = 0
+    while frontier and len(shown_ids) < max_nodes and (
+            max_depth is None or level < max_depth):
+        children = replies_to(frontier, max_children)
+        replies = []
+        for parent_id in frontier:
+            replied = children.get(parent_id, [])
+            room = max(max_nodes - len(shown_ids) - len(replies), 0)
+            shown = replied[:min(max_children, room)]
+            if len(shown) < len(replied):
+                cut[parent_id] = (shown[-1][1] if shown else "", len(shown))
+            replies.extend(comment_id for comment_id, path in shown)
+        frontier = replies
+        shown_ids.extend(frontier)
+        level += 1
+    for parent_id, count in count_replies(list(cut)).items():
+        after, shown = cut[parent_id]
+        more[parent_id] = (count - shown, encode_cursor(parent_id, after))
+    if frontier:
+        # Out of depth or budget, everything under the last level is left out
+        for parent_id, count in count_replies(frontier).items():
+            more[parent_id] = (count, encode_cursor(parent_id, ""))
+    return shown_ids, more
+
+def load_tree(root_ids, max_depth=None, max_children=None):
+    """The comments with root_ids and their replies within the budget, in
+    display order. Each has more_replies, how many of its replies were left
+    out, and if there were any more_replies_cursor to get them with branch()."""
+    shown_ids, more = prune(root_ids, max_depth, clamp_children(max_children))
+    comments = list(Comment.objects.filter(id__in=shown_ids).order_by("path"))
+    for comment in comments:
+        comment.more_replies, comment.more_replies_cursor = more.get(
+            comment.id, (0, None))
+    return comments
+
+def thread_roots(post_id, limit=None, offset=0):
+    """The ids of a page of a post's top level comments in display order,
+    see page_size()."""
+    offset = max(offset or 0, 0)
+    return list(Comment.objects.filter(
+        post_id=post_id, parent_comment__isnull=True).order_by("path").values_list(
+            "id", flat=True)[offset:offset + page_size(limit)])
+
+def branch(cursor, max_depth=None, max_children=None):
+    """Carry on with the replies a cursor from load_tree() or a previous
+    branch() left off at. Returns (comments, more, more_cursor): up to
+    max_children replies with their own replies in display order, and how
+    many replies are still left after those with the cursor to get them."""
+    parent_id, after = decode_cursor(cursor)
+    max_children = clamp_children(max_children)
+    replies = first_replies(parent_id, after, max_children)
+    shown = replies[:max_children]
+    comments = load_tree([comment_id for comment_id, path in shown],
+                         max_depth, max_children)
+    if len(shown) == len(replies):
+        return comments, 0, None
+    after = shown[-1][1] if shown else after
+    return (comments, count_replies([parent_id], after).get(parent_id, 0),
+            encode_cursor(parent_id, after))
+
+# Stands in for fields that weren't loaded
+DEFERRED = object()
+
+def place(comment):
+    """What a comment's path depends on, read from __dict__ so deferred
+    fields aren't loaded just for this."""
+    return (comment.__dict__.get("parent_comment_id", DEFERRED),
+            comment.__dict__.get("posted_at", DEFERRED))
+
+def remember_place(sender, instance, **kwargs):
+    """Note a comment's place as it was loaded, see assign_path()."""
+    instance._loaded_place = place(instance)
+
+def assign_path(sender, instance, raw=False, **kwargs):
+    """Give a comment about to be saved its path, unless it already has one
+    and its parent and posting time are as they were loaded. If that moves an
+    existing comment, note where from so move_subtree() can bring its
+    replies."""
+    if raw:
+        return
+    current = place(instance)
+    if (instance.path and not instance._state.adding and
+            current == getattr(instance, "_loaded_place", None)):
+        return
+    path = build_path(instance)
+    if instance.path and instance.path != path:
+        instance.moved_from = instance.path
+    instance.path = path
+    instance._loaded_place = current
+
+def move_subtree(sender, instance, created=False, raw=False, **kwargs):
+    old_path = getattr(instance, "moved_from", None)
+    if raw or old_path is None:
+        return
+    del instance.moved_from
+    Comment.objects.filter(path__startswith=old_path).exclude(id=instance.id).update(
+        path=Concat(Value(instance.path), Substr("path", len(old_path) + 1)),
+        post_id=instance.post_id)
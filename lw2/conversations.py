@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Prefetch, Q
+from django.utils import timezone
+from lw2.models import Conversation, Message, Participant
+
+"""Private conversations.
+
+Messages are read a page at a time, newest page first, so a conversation
+costs the same to show however long it's been going. Pages are found by
+cursor, the _id of a message bordering them, along the index on
+(conversation, created_at).
+
+Each user's inbox is their Participant rows, which carry the time of the
+conversation's last message and how many messages they haven't read yet.
+record_message() keeps those and the conversation's preview of its last
+message up to date as messages are sent, so listing the inbox is one read
+along the index on (user, last_message_at)."""
+
+# How much of the last message's body conversations keep as its preview
+PREVIEW_LENGTH = 140
+
+def get_page_size(limit, setting="MESSAGES_PAGE_SIZE"):
+    page_size = getattr(settings, setting, 50)
+    if limit is None or limit <= 0:
+        return page_size
+    return min(limit, getattr(settings, setting + "_MAX", 200))
+
+def get_cursor(conversation_id, message_id):
+    try:
+        return Message.objects.only("id", "created_at").get(
+            conversation_id=conversation_id, id=int(message_id))
+    except (Message.DoesNotExist, ValueError):
+        raise ValueError("No message with _id '{}' in this conversation".format(
+            message_id))
+
+def message_page(conversation_id, limit=None, before=None, after=None):
+    """Return a page of a conversation's messages, oldest first.
+
+    - after: Only messages after the message with this _id, for fetching new
+      ones. The page is the oldest of them.
+    - before: Only messages before the message with this _id, for scrolling
+      back. The page is the newest of them.
+
+    Without either the page is the newest messages."""
+    page_size = get_page_size(limit)
+    messages = Message.objects.filter(conversation_id=conversation_id)
+    if before is not None:
+        cursor = get_cursor(conversation_id, before)
+        messages = messages.filter(
+            Q(created_at__lt=cursor.created_at) |
+            Q(created_at=cursor.created_at, id__lt=cursor.id))
+    if after is not None:
+        cursor = get_cursor(conversation_id, after)
+        messages = messages.filter(
+            Q(created_at__gt=cursor.created_at) |
+            Q(created_at=cursor.created_at, id__gt=cursor.id))
+        return list(messages.order_by("created_at", "id")[:page_size])
+    page = list(messages.order_by("-created_at", "-id")[:page_size])
+    page.reverse()
+    return page
+
+def preview(body):
+    return " ".join(body.split())[:PREVIEW_LENGTH]
+
+def record_message(message):
+    """Update the conversation and its participants' inbox entries for a
+    newly sent message. The sender has read everything up to it."""
+    sent_at = message.created_at
+    participants = Participant.objects.filter(conversation_id=message.conversation_id)
+    with transaction.atomic():
+        Conversation.objects.filter(id=message.conversation_id).update(
+            last_message_at=sent_at, last_message_preview=preview(message.body))
+        participants.exclude(user_id=message.user_id).update(
+            last_message_at=sent_at, unread_count=F("unread_count") + 1)
+        participants.filter(user_id=message.user_id).update(
+            last_message_at=sent_at, last_read_at=sent_at, unread_count=0)
+
+def mark_read(user_id, conversation_id):
+    """Note that the user has read the whole conversation."""
+    if not Participant.objects.filter(
+            user_id=user_id, conversation_id=conversation_id).update(
+                last_read_at=timezone.now(), unread_count=0):
+        raise ValueError("You aren't a participant in conversation '{}'".format(
+            conversation_id))
+
+def inbox(user_id, limit=None, offset=0):
+    """Return a page of the user's conversations, most recently active
+    first. Each has its user's Participant row as inbox_entry, and all of
+    the participants with their profiles loaded in one more query."""
+    page_size = get_page_size(limit, "INBOX_PAGE_SIZE")
+    offset = max(offset or 0, 0)
+    conversations = []
+    entries = Participant.objects.filter(user_id=user_id).select_related(
+        "conversation").prefetch_related(Prefetch(
+            "conversation__participants",
+            queryset=Participant.objects.select_related("user__profile")))
+    for participant in entries.order_by("-last_message_at", "-id")[
+            offset:offset + page_size]:
+        participant.conversation.inbox_entry = participant
+        conversations.append(participant.conversation)
+    return conversations
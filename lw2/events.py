@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.db import close_old_connections
+from lw2.models import Notification
+import logging
+import threading
+import time
+
+"""Waking clients waiting for new notifications.
+
+Clients long-poll /api/events/ instead of polling NotificationsList and
+MessagesList. Each waiting request subscribes to event_hub under its user's
+id and sleeps until it's woken or times out, so a waiting client costs no
+queries. Notification ids serve as the clients' cursors: fan-out inserts
+notifications under lw2.notifications.lock_notification_ids(), so they
+commit in id order and once id N is visible no lower id can turn up after
+it. Without that, a transaction that took its ids first but committed last
+would land behind cursors that had already moved past it.
+
+Fan-out publishes the users it notified to the hub of the process it ran in.
+To hear about notifications created by other processes, with
+settings.NOTIFICATION_EVENTS_NOTIFIER = 'poll' one thread per process checks
+for new notifications every NOTIFICATION_EVENTS_POLL_INTERVAL seconds while
+anyone is waiting, and publishes them too. That's one small query per
+interval however many clients are waiting. 'local' skips the poller, which
+is enough when there's a single server process."""
+
+logger = logging.getLogger(__name__)
+
+class EventHub(object):
+    """Publish/subscribe by user id, within this process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.poller = None
+
+    def subscribe(self, user_id):
+        """Return a threading.Event that's set when user_id is published.
+        Pass it to unsubscribe() when done waiting."""
+        event = threading.Event()
+        with self.lock:
+            self.waiters.setdefault(user_id, set()).add(event)
+        if getattr(settings, "NOTIFICATION_EVENTS_NOTIFIER", "poll") == "poll":
+            self.ensure_poller()
+        return event
+
+    def unsubscribe(self, user_id, event):
+        with self.lock:
+            events = self.waiters.get(user_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiters[user_id]
+
+    def publish(self, user_ids):
+        """Wake everyone waiting on one of user_ids."""
+        with self.lock:
+            events = [event for user_id in set(user_ids)
+                      for event in self.waiters.get(user_id, ())]
+        for event in events:
+            event.set()
+
+    def waiting(self):
+        """The ids of the users someone is waiting on."""
+        with self.lock:
+            return list(self.waiters)
+
+    def ensure_poller(self):
+        with self.lock:
+            if self.poller is None or not self.poller.is_alive():
+                self.poller = threading.Thread(target=self.poll, daemon=True,
+                                               name="notification-events")
+                self.poller.start()
+
+    def poll(self):
+        """Publish notifications created since the last check, whichever
+        process created them."""
+        last_id = None
+        while True:
+            try:
+                user_ids = self.waiting()
+                if user_ids and last_id is None:
+                    last_id = latest_notification_id()
+                    # Anything up to now may have been missed, have them look
+                    self.publish(user_ids)
+                elif user_ids:
+                    rows = list(Notification.objects.filter(
+                        id__gt=last_id).order_by().values_list("id", "user_id"))
+                    if rows:
+                        # Ids commit in order, nothing more can turn up below it
+                        last_id = max(notification_id for notification_id, user_id in rows)
+                        self.publish(user_id for notification_id, user_id in rows)
+                else:
+                    # Nobody would hear about these, don't bother fetching them
+                    last_id = None
+            except Exception:
+                logger.exception("Polling for new notifications failed")
+            close_old_connections()
+            time.sleep(getattr(settings, "NOTIFICATION_EVENTS_POLL_INTERVAL", 2))
+
+event_hub = EventHub()
+
+def latest_notification_id(user_id=None):
+    notifications = Notification.objects.order_by("-id")
+    if user_id is not None:
+        notifications = notifications.filter(user_id=user_id)
+    return notifications.values_list("id", flat=True).first() or 0
+
+# The most notifications one response carries, the rest come with the next
+MAX_EVENTS = 100
+
+def new_events(user_id, since):
+    """Return (cursor, notification ids, message ids) for the user's
+    notifications after the cursor since."""
+    rows = list(Notification.objects.filter(
+        user_id=user_id, id__gt=since).order_by("id").values_list(
+            "id", "document_type", "document_id")[:MAX_EVENTS])
+    if not rows:
+        return since, [], []
+    return (rows[-1][0],
+            [notification_id for notification_id, document_type, document_id in rows],
+            [document_id for notification_id, document_type, document_id in rows
+             if document_type == "message"])
+
+def wait_for_events(user_id, since, timeout):
+    """Like new_events(), but if there aren't any yet wait up to timeout
+    seconds for some to arrive."""
+    deadline = time.monotonic() + timeout
+    while True:
+        # Subscribe before looking so nothing published in between is missed
+        event = event_hub.subscribe(user_id)
+        try:
+            events = new_events(user_id, since)
+            remaining = deadline - time.monotonic()
+            if events[1] or remaining <= 0:
+                return events
+            event.wait(remaining)
+        finally:
+            event_hub.unsubscribe(user_id, event)
@@ -0,0 +1,376 @@
+from collections import namedtuple
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from lw2.models import Post, Comment, SearchDocument
+
+"""Full text search index for posts and comments.
+
+Documents are registered in SearchDocument, whose integer id keys a row in
+the lw2_search_fts table holding the indexed title and body. What that table
+is depends on the database:
+
+- SQLite: an FTS5 virtual table using the porter tokenizer, ranked by bm25.
+- Postgres: a regular table with a GIN indexed tsvector column, ranked by
+  ts_rank_cd.
+
+Other databases fall back to scanning texts with icontains, which is also
+what you get by setting SEARCH_BACKEND = 'scan'. The index is kept in sync
+by the post_save and post_delete handlers at the bottom of this module,
+which skip saves that leave the indexed fields as they were loaded, like
+votes updating a score.
+
+Backends compile the tree of a lw2.search.SearchPlan into an index query and
+apply it to a queryset with search(). Compiled queries are kept on the plan,
+so they're cached along with it. The index backends can also cut a
+highlighted snippet of each matching body while they search, see
+SNIPPET_TOKENS and render_snippet()."""
+
+FTS_TABLE = "lw2_search_fts"
+DOCUMENT_TABLE = SearchDocument._meta.db_table
+
+# The collection names used in SearchDocument, shared with the REST API
+COLLECTIONS = {Post:"posts", Comment:"comments"}
+# The fields searched in each collection
+TEXT_FIELDS = {Post:("title", "body"), Comment:("body",)}
+
+# Markup put around matched terms in snippets, and where a snippet cuts text
+HIGHLIGHT = ("<mark>", "</mark>")
+ELLIPSIS = "\u2026"
+# What the index marks matches with in the snippets it cuts, characters from
+# the private use area. Bodies are markdown, so the snippet is escaped before
+# these are swapped for HIGHLIGHT.
+MARKERS = ("\ue000", "\ue001")
+# Roughly how many words of a body to show in a snippet
+SNIPPET_TOKENS = 32
+
+# An index query compiled from a search tree. match_sql is a WHERE condition
+# on the index table, rank_sql a rank expression valid alongside it and
+# snippet_sql a highlighted excerpt of the matched body.
+CompiledQuery = namedtuple("CompiledQuery", ["match_sql", "params",
+                                             "rank_sql", "rank_params",
+                                             "snippet_sql", "snippet_params"])
+
+def render_snippet(snippet):
+    """Turn a snippet cut by an index backend into HTML, with the text
+    escaped and the matches wrapped in HIGHLIGHT. A body can hold the markers
+    itself, so only the ones that open or close a match count."""
+    pieces = []
+    highlighting = False
+    position = 0
+    for index, char in enumerate(snippet):
+        if char in MARKERS:
+            pieces.append(escape(snippet[position:index]))
+            position = index + 1
+            if highlighting != (char == MARKERS[0]):
+                pieces.append(HIGHLIGHT[highlighting])
+                highlighting = not highlighting
+    pieces.append(escape(snippet[position:]))
+    if highlighting:
+        pieces.append(HIGHLIGHT[1])
+    return "".join(pieces)
+
+def split_exclusions(tree):
+    """Return the alternatives whose matches a purely negative search tree
+    excludes, or None if the tree has something to match."""
+    if tree.op == "not":
+        return [tree.child]
+    if tree.op == "and" and all(child.op == "not" for child in tree.children):
+        return [child.child for child in tree.children]
+    return None
+
+class SearchBackend(object):
+    """Interface for full text search backends."""
+    def update(self, collection, document_id, title, body):
+        """Add a document to the index or replace its indexed text."""
+        raise NotImplementedError
+
+    def remove(self, collection, document_id):
+        """Remove a document from the index if it's there."""
+        raise NotImplementedError
+
+    def search(self, queryset, collection, plan, snippets=False):
+        """Filter queryset down to the documents matching a SearchPlan, best
+        matches first. If snippets is true and the backend can make them,
+        each result gets a search_snippet attribute."""
+        raise NotImplementedError
+
+class ScanBackend(SearchBackend):
+    """No index, every search is a substring scan over document titles and
+    bodies."""
+    def update(self, collection, document_id, title, body):
+        pass
+
+    def remove(self, collection, document_id):
+        pass
+
+    def search(self, queryset, collection, plan, snippets=False):
+        if plan.tree is None:
+            return queryset
+        return queryset.filter(plan.text_filter(TEXT_FIELDS[queryset.model]))
+
+class IndexBackend(SearchBackend):
+    """Shared bookkeeping for the backends that keep an index table."""
+    # SQL to insert a row into the index table, given rowid, title and body
+    insert_sql = None
+    # Whether the rank sorts best first when ordered ascending
+    rank_ascending = True
+
+    def insert_params(self, rowid, title, body):
+        return [rowid, title, body]
+
+    def update(self, collection, document_id, title, body):
+        document, created = SearchDocument.objects.get_or_create(
+            collection=collection, document_id=document_id)
+        with connection.cursor() as cursor:
+            if not created:
+                cursor.execute("DELETE FROM {} WHERE rowid = %s".format(FTS_TABLE),
+                               [document.id])
+            cursor.execute(self.insert_sql,
+                           self.insert_params(document.id, title or "", body or ""))
+
+    def remove(self, collection, document_id):
+        documents = SearchDocument.objects.filter(collection=collection,
+                                                  document_id=document_id)
+        rowids = list(documents.values_list("id", flat=True))
+        if not rowids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {} WHERE rowid IN ({})".format(
+                    FTS_TABLE, ", ".join(["%s"] * len(rowids))),
+                rowids)
+        documents.delete()
+
+    def compile(self, tree):
+        """Return the CompiledQuery for a search tree. Raises ValueError for
+        trees the index can't express, which search() matches by scanning."""
+        raise NotImplementedError
+
+    def compile_exclusion(self, alternatives):
+        """Return (match_sql, params) matching any of the alternatives."""
+        raise NotImplementedError
+
+    def compiled(self, plan):
+        """compile() or compile_exclusion() the plan's tree, once per plan.
+        None if the index can't express it."""
+        key = type(self).__name__
+        if key not in plan.compiled:
+            excluded = split_exclusions(plan.tree)
+            try:
+                if excluded is None:
+                    plan.compiled[key] = (False, self.compile(plan.tree))
+                else:
+                    plan.compiled[key] = (True, self.compile_exclusion(excluded))
+            except ValueError:
+                plan.compiled[key] = None
+        return plan.compiled[key]
+
+    def matching_documents_sql(self, match_sql):
+        return ("SELECT {documents}.document_id FROM {documents}, {fts} "
+                "WHERE {fts}.rowid = {documents}.id "
+                "AND {documents}.collection = %s AND {match}").format(
+                    documents=DOCUMENT_TABLE, fts=FTS_TABLE, match=match_sql)
+
+    def search(self, queryset, collection, plan, snippets=False):
+        if plan.tree is None:
+            return queryset
+        if self.compiled(plan) is None:
+            # Matched by scanning instead, newest first like other scans
+            return ScanBackend().search(queryset, collection, plan).order_by("-posted_at")
+        exclusion, compiled = self.compiled(plan)
+        pk_column = "{}.{}".format(queryset.model._meta.db_table,
+                                   queryset.model._meta.pk.column)
+        if exclusion:
+            match_sql, params = compiled
+            return queryset.extra(
+                where=["{} NOT IN ({})".format(
+                    pk_column, self.matching_documents_sql(match_sql))],
+                params=[collection] + params)
+        select = {"search_rank":compiled.rank_sql}
+        select_params = list(compiled.rank_params)
+        if snippets:
+            select["search_snippet"] = compiled.snippet_sql
+            select_params.extend(compiled.snippet_params)
+        return queryset.extra(
+            select=select,
+            select_params=select_params,
+            tables=[DOCUMENT_TABLE, FTS_TABLE],
+            where=["{}.rowid = {}.id".format(FTS_TABLE, DOCUMENT_TABLE),
+                   "{}.document_id = {}".format(DOCUMENT_TABLE, pk_column),
+                   "{}.collection = %s".format(DOCUMENT_TABLE),
+                   compiled.match_sql],
+            params=[collection] + compiled.params,
+            order_by=["search_rank" if self.rank_ascending else "-search_rank"])
+
+class SqliteBackend(IndexBackend):
+    """SQLite FTS5 index."""
+    insert_sql = "INSERT INTO {} (rowid, title, body) VALUES (%s, %s, %s)".format(
+        FTS_TABLE)
+    rank_ascending = True
+    # Relative weights of the title and body columns in bm25()
+    column_weights = (10.0, 1.0)
+
+    @staticmethod
+    def quote(term):
+        # Bare terms and exact phrases are both FTS5 strings, the tokenizer
+        # splits them into the phrase's tokens
+        return "\"{}\"".format(term.text.replace("\"", "\"\""))
+
+    def compile_tree(self, tree):
+        """Render a tree in FTS5 query syntax. FTS5 only has a binary NOT, so
+        negations have to sit in a group beside something to match, and
+        trees with one anywhere else, like a OR -b, are scanned instead."""
+        if tree.op == "term":
+            return self.quote(tree)
+        if tree.op == "or":
+            return "({})".format(" OR ".join(self.compile_tree(child)
+                                             for child in tree.children))
+        if tree.op == "and":
+            positive = [child for child in tree.children if child.op != "not"]
+            negative = [child.child for child in tree.children if child.op == "not"]
+            if positive:
+                match = "({})".format(" AND ".join(self.compile_tree(child)
+                                                   for child in positive))
+                if negative:
+                    match = "({} NOT ({}))".format(
+                        match, " OR ".join(self.compile_tree(child)
+                                           for child in negative))
+                return match
+        raise ValueError("Exclusions must be grouped with at least one term "
+                         "to search for")
+
+    def compile(self, tree):
+        rank_sql = "bm25({}, {}, {})".format(FTS_TABLE, *self.column_weights)
+        # Column 1 is the body
+        snippet_sql = "snippet({}, 1, %s, %s, %s, {})".format(FTS_TABLE,
+                                                             SNIPPET_TOKENS)
+        return CompiledQuery("{} MATCH %s".format(FTS_TABLE),
+                             [self.compile_tree(tree)], rank_sql, [],
+                             snippet_sql, list(MARKERS) + [ELLIPSIS])
+
+    def compile_exclusion(self, alternatives):
+        match = " OR ".join(self.compile_tree(tree) for tree in alternatives)
+        return "{} MATCH %s".format(FTS_TABLE), [match]
+
+class PostgresBackend(IndexBackend):
+    """Postgres tsvector index."""
+    config = "english"
+    insert_sql = (
+        "INSERT INTO {} (rowid, title, body, vector) VALUES (%s, %s, %s, "
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'B'))").format(FTS_TABLE)
+    rank_ascending = False
+
+    def insert_params(self, rowid, title, body):
+        return [rowid, title, body, title, body]
+
+    def compile_tree(self, tree):
+        """Return (sql, params) for a tsquery expression matching a tree."""
+        if tree.op == "term":
+            # Unquoted terms only have spaces when they're synonym phrases
+            phrase = tree.exact or " " in tree.text
+            function = "phraseto_tsquery" if phrase else "plainto_tsquery"
+            return "{}('{}', %s)".format(function, self.config), [tree.text]
+        if tree.op == "not":
+            sql, params = self.compile_tree(tree.child)
+            return "!!{}".format(sql), params
+        operator = " && " if tree.op == "and" else " || "
+        clauses = []
+        params = []
+        for child in tree.children:
+            sql, child_params = self.compile_tree(child)
+            clauses.append(sql)
+            params.extend(child_params)
+        return "({})".format(operator.join(clauses)), params
+
+    def compile(self, tree):
+        tsquery, params = self.compile_tree(tree)
+        match_sql = "{}.vector @@ {}".format(FTS_TABLE, tsquery)
+        rank_sql = "ts_rank_cd({}.vector, {})".format(FTS_TABLE, tsquery)
+        snippet_sql = "ts_headline('{}', {}.body, {}, %s)".format(
+            self.config, FTS_TABLE, tsquery)
+        options = ("StartSel={}, StopSel={}, FragmentDelimiter={}, "
+                   "MaxFragments=1, MaxWords={}, MinWords={}").format(
+                       MARKERS[0], MARKERS[1], ELLIPSIS,
+                       SNIPPET_TOKENS, SNIPPET_TOKENS // 2)
+        return CompiledQuery(match_sql, params, rank_sql, params,
+                             snippet_sql, params + [options])
+
+    def compile_exclusion(self, alternatives):
+        clauses = []
+        params = []
+        for tree in alternatives:
+            sql, tree_params = self.compile_tree(tree)
+            clauses.append(sql)
+            params.extend(tree_params)
+        return ("{}.vector @@ ({})".format(FTS_TABLE, " || ".join(clauses)),
+                params)
+
+BACKENDS = {"scan":ScanBackend,
+            "sqlite":SqliteBackend,
+            "postgres":PostgresBackend}
+
+# Which backend SEARCH_BACKEND = 'auto' picks for each database vendor
+VENDOR_BACKENDS = {"sqlite":"sqlite",
+                   "postgresql":"postgres"}
+
+_backends = {}
+
+def get_backend():
+    """Return the search backend configured by settings.SEARCH_BACKEND."""
+    name = getattr(settings, "SEARCH_BACKEND", "auto")
+    if name == "auto":
+        name = VENDOR_BACKENDS.get(connection.vendor, "scan")
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+def search(queryset, plan, snippets=False):
+    """Filter a Post or Comment queryset by a SearchPlan."""
+    return get_backend().search(queryset, COLLECTIONS[queryset.model], plan,
+                                snippets)
+
+# The fields a document's place in the index depends on
+INDEXED_FIELDS = {Post:("title", "body"), Comment:("body", "is_deleted")}
+# Stands in for fields that weren't loaded
+DEFERRED = object()
+
+def indexed_fields(instance):
+    # Read from __dict__, so deferred fields aren't loaded just for this
+    return tuple(instance.__dict__.get(name, DEFERRED)
+                 for name in INDEXED_FIELDS[type(instance)])
+
+def remember_indexed_fields(sender, instance, **kwargs):
+    """Note what a post or comment's indexed fields were when it was loaded."""
+    instance._indexed_fields = indexed_fields(instance)
+
+def needs_indexing(instance, created, update_fields):
+    """Whether a save changed what the index holds for the document."""
+    if created:
+        return True
+    if update_fields is not None and not (
+            set(update_fields) & set(INDEXED_FIELDS[type(instance)])):
+        return False
+    return indexed_fields(instance) != getattr(instance, "_indexed_fields", None)
+
+def index_post(sender, instance, created=False, update_fields=None, **kwargs):
+    if not needs_indexing(instance, created, update_fields):
+        return
+    get_backend().update("posts", instance.id, instance.title, instance.body)
+    instance._indexed_fields = indexed_fields(instance)
+
+def index_comment(sender, instance, created=False, update_fields=None, **kwargs):
+    if not needs_indexing(instance, created, update_fields):
+        return
+    if instance.is_deleted:
+        get_backend().remove("comments", instance.id)
+    else:
+        get_backend().update("comments", instance.id, "", instance.body)
+    instance._indexed_fields = indexed_fields(instance)
+
+def unindex_post(sender, instance, **kwargs):
+    get_backend().remove("posts", instance.id)
+
+def unindex_comment(sender, instance, **kwargs):
+    get_backend().remove("comments", instance.id)
@@ -0,0 +1,279 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from lw2.models import Post, Profile
+import heapq
+import math
+import re
+import threading
+import time
+
+"""Fuzzy lookup of post titles and user names by trigram similarity.
+
+A piece of text is broken into trigrams the way Postgres' pg_trgm does it:
+lowercased, split into words, each word padded with two spaces in front and
+one behind, and every three character run taken. Two texts are similar in
+proportion to how many trigrams they share, which tolerates typos, and a
+text contains a query if it has all the query's trigrams that don't touch
+its ends, which makes substring search indexable too.
+
+On Postgres lookups use pg_trgm's similarity() and GIN trigram indexes. On
+other databases they use TrigramIndex, an in-process inverted index from
+trigrams to documents that's kept up to date by the signal handlers at the
+bottom of this module. Both rank substring matches first, then by similarity.
+Pick one with settings.FUZZY_BACKEND."""
+
+WORD_RE = re.compile(r"\w+")
+
+def normalize_text(text):
+    return " ".join(WORD_RE.findall((text or "").lower()))
+
+def trigrams(text):
+    """The set of padded trigrams of text."""
+    grams = set()
+    for word in WORD_RE.findall((text or "").lower()):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def inner_trigrams(text):
+    """The trigrams every text containing text has, those which don't depend
+    on where its words start or end."""
+    words = WORD_RE.findall((text or "").lower())
+    grams = set()
+    for position, word in enumerate(words):
+        # Only the first word can start mid-word and only the last can end
+        # mid-word in a text that contains this one
+        padded = ("" if position == 0 else "  ") + word + (
+            "" if position == len(words) - 1 else " ")
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def similarity(grams, other_grams):
+    if not grams or not other_grams:
+        return 0.0
+    shared = len(grams & other_grams)
+    return shared / (len(grams) + len(other_grams) - shared)
+
+class TrigramIndex(object):
+    """An in-process trigram index over the names of some documents.
+
+    Each document has one or more names, e.g a user's username and display
+    name, and scores as its best matching name. Subclasses say where the
+    names come from with load_names(). The index is loaded on first use and
+    updated in place by update() and remove(); it's reloaded from the
+    database once it's older than settings.FUZZY_INDEX_MAX_AGE seconds, which
+    picks up changes made by other processes."""
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.loaded_at = None
+        self.names = {}
+        self.postings = {}
+
+    def load_names(self):
+        """Yield (document_id, names) for every document."""
+        raise NotImplementedError
+
+    def get_max_age(self):
+        if self.max_age is not None:
+            return self.max_age
+        return getattr(settings, "FUZZY_INDEX_MAX_AGE", 300)
+
+    def load(self):
+        names = {}
+        postings = {}
+        for document_id, document_names in self.load_names():
+            entries = self.entries(document_names)
+            names[document_id] = entries
+            for text, grams in entries:
+                for gram in grams:
+                    postings.setdefault(gram, set()).add(document_id)
+        with self.lock:
+            self.names = names
+            self.postings = postings
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Drop the index so it's reloaded on next use."""
+        with self.lock:
+            self.loaded_at = None
+
+    def ensure_loaded(self):
+        loaded_at = self.loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.get_max_age():
+            self.load()
+
+    @staticmethod
+    def entries(names):
+        return [(normalize_text(name), trigrams(name)) for name in names if name]
+
+    def update(self, document_id, names):
+        """Set a document's names, if the index is loaded."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            self.remove(document_id)
+            entries = self.entries(names)
+            self.names[document_id] = entries
+            for text, grams in entries:
+                for gram in grams:
+                    self.postings.setdefault(gram, set()).add(document_id)
+
+    def remove(self, document_id):
+        """Remove a document from the index, if the index is loaded."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for text, grams in self.names.pop(document_id, []):
+                for gram in grams:
+                    documents = self.postings.get(gram)
+                    if documents is not None:
+                        documents.discard(document_id)
+                        if not documents:
+                            del self.postings[gram]
+
+    def lookup(self, query, limit=10, threshold=None):
+        """Return up to limit (document_id, score) pairs for the documents
+        with a name containing query or at least threshold similar to it,
+        best first. Substring matches score 1 plus their similarity."""
+        self.ensure_loaded()
+        if threshold is None:
+            threshold = getattr(settings, "FUZZY_SIMILARITY_THRESHOLD", 0.3)
+        text = normalize_text(query)
+        grams = trigrams(text)
+        if not grams:
+            return []
+        inner = inner_trigrams(text)
+        if not inner:
+            # Too short to have a trigram of its own, look for names with a
+            # word starting with it instead
+            inner = {("  " + text)[-3:]} if len(text) < 3 else set()
+        # A name this similar must share at least this many trigrams
+        needed = max(1, math.ceil(threshold * len(grams)))
+        with self.lock:
+            shared = {}
+            for gram in grams | inner:
+                for document_id in self.postings.get(gram, ()):
+                    shared[document_id] = shared.get(document_id, 0) + 1
+            scored = []
+            for document_id, count in shared.items():
+                if count < needed and count < len(inner):
+                    continue
+                best = 0.0
+                for name, name_grams in self.names[document_id]:
+                    score = similarity(grams, name_grams)
+                    if text in name:
+                        score += 1
+                    best = max(best, score)
+                if best >= threshold:
+                    scored.append((best, document_id))
+        return [(document_id, score) for score, document_id in
+                heapq.nlargest(limit, scored, key=lambda item: item[0])]
+
+class PostTitleIndex(TrigramIndex):
+    def load_names(self):
+        for post_id, title in Post.objects.values_list("id", "title").iterator():
+            yield post_id, (title,)
+
+class UserNameIndex(TrigramIndex):
+    def load_names(self):
+        display_names = dict(Profile.objects.values_list("user_id", "display_name"))
+        for user_id, username in User.objects.values_list("id", "username").iterator():
+            yield user_id, (username, display_names.get(user_id))
+
+class LocalBackend(object):
+    """Lookups served from the in-process trigram indexes."""
+    def __init__(self):
+        self.indexes = {"posts":post_title_index, "users":user_name_index}
+
+    def lookup(self, collection, query, limit):
+        return self.indexes[collection].lookup(query, limit)
+
+class PostgresBackend(object):
+    """Lookups with pg_trgm, see migration 0032 for the indexes."""
+    # Parameters alternate between the search text and its LIKE pattern, with
+    # the limit last. The % operator's cutoff is pg_trgm's own
+    # similarity_threshold, not FUZZY_SIMILARITY_THRESHOLD.
+    queries = {
+        "posts":"""
+            SELECT id, similarity(title, %s) + (title ILIKE %s)::int AS score
+            FROM lw2_post
+            WHERE title %% %s OR title ILIKE %s
+            ORDER BY score DESC LIMIT %s""",
+        "users":"""
+            SELECT u.id,
+                   greatest(similarity(u.username, %s) + (u.username ILIKE %s)::int,
+                            similarity(coalesce(p.display_name, ''), %s) +
+                            (coalesce(p.display_name, '') ILIKE %s)::int) AS score
+            FROM auth_user u LEFT JOIN lw2_profile p ON p.user_id = u.id
+            WHERE u.username %% %s OR u.username ILIKE %s
+               OR p.display_name %% %s OR p.display_name ILIKE %s
+            ORDER BY score DESC LIMIT %s"""}
+
+    @staticmethod
+    def like_pattern(query):
+        escaped = re.sub(r"([\\%_])", r"\\\1", query)
+        return "%{}%".format(escaped)
+
+    def lookup(self, collection, query, limit):
+        pattern = self.like_pattern(query)
+        if collection == "posts":
+            params = [query, pattern, query, pattern, limit]
+        else:
+            params = [query, pattern, query, pattern] * 2 + [limit]
+        with connection.cursor() as cursor:
+            cursor.execute(self.queries[collection], params)
+            return [(document_id, score) for document_id, score in cursor.fetchall()]
+
+BACKENDS = {"local":LocalBackend,
+            "postgres":PostgresBackend}
+
+VENDOR_BACKENDS = {"postgresql":"postgres"}
+
+_backends = {}
+
+def get_backend():
+    """Return the fuzzy lookup backend configured by settings.FUZZY_BACKEND."""
+    name = getattr(settings, "FUZZY_BACKEND", "auto")
+    if name == "auto":
+        name = VENDOR_BACKENDS.get(connection.vendor, "local")
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+def lookup(collection, query, limit=10):
+    """Return up to limit (id, score) pairs for the posts or users (as given
+    by collection) whose title or names best match query."""
+    query = " ".join(query.split())
+    if not query:
+        return []
+    return get_backend().lookup(collection, query, limit)
+
+post_title_index = PostTitleIndex()
+user_name_index = UserNameIndex()
+
+def index_post(sender, instance, **kwargs):
+    post_title_index.update(instance.id, (instance.title,))
+
+def unindex_post(sender, instance, **kwargs):
+    post_title_index.remove(instance.id)
+
+def index_user(sender, instance, **kwargs):
+    if user_name_index.loaded_at is None:
+        # Don't look up the profile for nothing, users are saved on every login
+        return
+    try:
+        display_name = instance.profile.display_name
+    except Profile.DoesNotExist:
+        display_name = None
+    user_name_index.update(instance.id, (instance.username, display_name))
+
+def index_profile(sender, instance, **kwargs):
+    if user_name_index.loaded_at is None:
+        return
+    user_name_index.update(instance.user_id, (instance.user.username,
+                                              instance.display_name))
+
+def unindex_user(sender, instance, **kwargs):
+    user_name_index.remove(instance.id)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from lw2.related import compute_related_posts, sparse
+
+class Command(BaseCommand):
+    help = """Rebuild the related posts table from tag similarity. Run this 
+    periodically, e.g from cron, since the table isn't updated as tags change."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top-k", type=int, default=10,
+                            help="How many related posts to keep for each post.")
+        parser.add_argument("--no-sparse", action="store_true",
+                            help="Don't use scipy even if it's installed.")
+
+    def handle(self, *args, **options):
+        use_sparse = (sparse is not None) and not options["no_sparse"]
+        written = compute_related_posts(top_k=options["top_k"],
+                                        use_sparse=use_sparse)
+        self.stdout.write("Wrote {} related post links ({})".format(
+            written, "scipy" if use_sparse else "pure python"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from lw2.notifications import prune_notifications
+import time
+
+class Command(BaseCommand):
+    help = """Delete viewed notifications older than NOTIFICATION_RETENTION_DAYS
+    in small batches. Run this periodically, e.g from cron, or leave it
+    running with --every."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Delete viewed notifications older than this instead.")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="How many notifications to delete per statement.")
+        parser.add_argument("--pause", type=float, default=0.1,
+                            help="Seconds to wait between batches.")
+        parser.add_argument("--every", type=int, default=None,
+                            help="Keep running, pruning every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = prune_notifications(max_age_days=options["days"],
+                                          batch_size=options["batch_size"],
+                                          pause=options["pause"])
+            self.stdout.write("Deleted {} old notifications".format(deleted))
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
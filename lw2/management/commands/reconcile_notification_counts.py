@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from lw2.notifications import reconcile_unread_counts
+import time
+
+class Command(BaseCommand):
+    help = """Recount users' unread notification counters from their
+    notifications, fixing any that have drifted. Run this periodically, e.g
+    from cron, or leave it running with --every."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="How many profiles to recount per statement.")
+        parser.add_argument("--every", type=int, default=None,
+                            help="Keep running, reconciling every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            fixed = reconcile_unread_counts(batch_size=options["batch_size"])
+            self.stdout.write("Fixed {} unread notification counters".format(fixed))
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
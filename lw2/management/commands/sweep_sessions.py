@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from lw2.sessions import sweep_expired_sessions
+import time
+
+class Command(BaseCommand):
+    help = """Delete expired sessions from the database in small batches. Run 
+    this periodically, e.g from cron, or leave it running with --every."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="How many sessions to delete per statement.")
+        parser.add_argument("--pause", type=float, default=0.1,
+                            help="Seconds to wait between batches.")
+        parser.add_argument("--every", type=int, default=None,
+                            help="Keep running, sweeping every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = sweep_expired_sessions(batch_size=options["batch_size"],
+                                             pause=options["pause"])
+            self.stdout.write("Deleted {} expired sessions".format(deleted))
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
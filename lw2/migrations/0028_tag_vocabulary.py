@@ -0,0 +1,87 @@
+# Generated by Django 2.1.7 on 2026-10-19 04:45
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+def build_tag_vocabulary(apps, schema_editor):
+    """Point every existing tag at a vocabulary entry and count its uses."""
+    Tag = apps.get_model('lw2', 'Tag')
+    TagName = apps.get_model('lw2', 'TagName')
+    tag_ids = {}
+    texts = {}
+    for tag_id, text in Tag.objects.order_by('id').values_list('id', 'text'):
+        key = re.sub("\s+", " ", text).strip().casefold()
+        tag_ids.setdefault(key, []).append(tag_id)
+        texts.setdefault(key, text)
+    for key, ids in tag_ids.items():
+        tag_name = TagName.objects.create(key=key, text=texts[key],
+                                          count=len(ids))
+        Tag.objects.filter(id__in=ids).update(tag_name=tag_name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0027_auto_20190216_0628'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagName',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField(unique=True)),
+                ('text', models.TextField()),
+                ('count', models.IntegerField(db_index=True, default=0)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='post',
+            options={},
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_api_key',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_group',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_user',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='base_score',
+            field=models.IntegerField(db_index=True, default=1),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='posted_at',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.today),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profile', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='document_id',
+            field=models.CharField(db_index=True, max_length=17),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='tag_name',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='tags', to='lw2.TagName'),
+        ),
+        migrations.RunPython(build_tag_vocabulary, migrations.RunPython.noop),
+    ]
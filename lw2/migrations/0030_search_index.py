@@ -0,0 +1,78 @@
+# Generated by Django 2.1.7 on 2026-10-19 04:51
+
+from django.db import migrations, models
+
+
+SQLITE_FORWARDS = [
+    """CREATE VIRTUAL TABLE lw2_search_fts
+       USING fts5(title, body, tokenize='porter unicode61')""",
+    """INSERT INTO lw2_searchdocument (collection, document_id)
+       SELECT 'posts', id FROM lw2_post""",
+    """INSERT INTO lw2_searchdocument (collection, document_id)
+       SELECT 'comments', id FROM lw2_comment WHERE NOT is_deleted""",
+    """INSERT INTO lw2_search_fts (rowid, title, body)
+       SELECT d.id, p.title, p.body FROM lw2_searchdocument d
+       JOIN lw2_post p ON d.collection = 'posts' AND p.id = d.document_id""",
+    """INSERT INTO lw2_search_fts (rowid, title, body)
+       SELECT d.id, '', c.body FROM lw2_searchdocument d
+       JOIN lw2_comment c ON d.collection = 'comments' AND c.id = d.document_id""",
+]
+
+POSTGRES_FORWARDS = [
+    """CREATE TABLE lw2_search_fts (
+       rowid integer PRIMARY KEY REFERENCES lw2_searchdocument (id)
+                     ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+       title text NOT NULL,
+       body text NOT NULL,
+       vector tsvector NOT NULL)""",
+    "CREATE INDEX lw2_search_fts_vector ON lw2_search_fts USING GIN (vector)",
+    """INSERT INTO lw2_searchdocument (collection, document_id)
+       SELECT 'posts', id FROM lw2_post""",
+    """INSERT INTO lw2_searchdocument (collection, document_id)
+       SELECT 'comments', id FROM lw2_comment WHERE NOT is_deleted""",
+    """INSERT INTO lw2_search_fts (rowid, title, body, vector)
+       SELECT d.id, p.title, p.body,
+              setweight(to_tsvector('english', p.title), 'A') ||
+              setweight(to_tsvector('english', p.body), 'B')
+       FROM lw2_searchdocument d
+       JOIN lw2_post p ON d.collection = 'posts' AND p.id = d.document_id""",
+    """INSERT INTO lw2_search_fts (rowid, title, body, vector)
+       SELECT d.id, '', c.body, setweight(to_tsvector('english', c.body), 'B')
+       FROM lw2_searchdocument d
+       JOIN lw2_comment c ON d.collection = 'comments' AND c.id = d.document_id""",
+]
+
+def create_search_index(apps, schema_editor):
+    """Create the index table for this database and fill it. Databases other
+    than SQLite and Postgres don't get one, search scans them instead."""
+    statements = {"sqlite":SQLITE_FORWARDS,
+                  "postgresql":POSTGRES_FORWARDS}.get(schema_editor.connection.vendor)
+    for statement in statements or []:
+        schema_editor.execute(statement)
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute("DROP TABLE lw2_search_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0029_relatedpost'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(max_length=20)),
+                ('document_id', models.CharField(max_length=17)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchdocument',
+            unique_together={('collection', 'document_id')},
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
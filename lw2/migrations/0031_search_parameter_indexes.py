@@ -0,0 +1,36 @@
+# Generated by Django 2.1.7 on 2026-10-19 04:54
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0030_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='base_score',
+            field=models.IntegerField(db_index=True, default=1),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='posted_at',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.today),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['user', 'posted_at'], name='lw2_comment_user_id_1d34c5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'posted_at'], name='lw2_comment_post_id_1343e4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['user', 'posted_at'], name='lw2_post_user_id_e23368_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.db import migrations
+
+
+POSTGRES_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX lw2_post_title_trgm ON lw2_post USING GIN (title gin_trgm_ops)",
+    """CREATE INDEX lw2_user_username_trgm ON auth_user
+       USING GIN (username gin_trgm_ops)""",
+    """CREATE INDEX lw2_profile_display_name_trgm ON lw2_profile
+       USING GIN (display_name gin_trgm_ops)""",
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX lw2_post_title_trgm",
+    "DROP INDEX lw2_user_username_trgm",
+    "DROP INDEX lw2_profile_display_name_trgm",
+]
+
+def create_trigram_indexes(apps, schema_editor):
+    """Index titles and names for pg_trgm on Postgres. Other databases use
+    the in-process index in lw2/fuzzy.py, which needs no tables."""
+    if schema_editor.connection.vendor == "postgresql":
+        for statement in POSTGRES_FORWARDS:
+            schema_editor.execute(statement)
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        for statement in POSTGRES_BACKWARDS:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lw2', '0031_search_parameter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
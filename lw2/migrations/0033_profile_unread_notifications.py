@@ -0,0 +1,32 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:12
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_unread(apps, schema_editor):
+    Notification = apps.get_model('lw2', 'Notification')
+    Profile = apps.get_model('lw2', 'Profile')
+    Profile.objects.update(unread_notifications=Coalesce(Subquery(
+        Notification.objects.filter(
+            user_id=OuterRef('user_id'),
+            created_at__gt=OuterRef('last_notifications_check')).order_by().values(
+                'user_id').annotate(count=Count('id')).values('count'),
+        output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0032_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='unread_notifications',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0033_profile_unread_notifications'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'created_at'], name='lw2_notific_user_id_01c1e0_idx'),
+        ),
+    ]
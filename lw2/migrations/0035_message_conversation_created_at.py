@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0034_notification_user_created_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at'], name='lw2_message_convers_ffba76_idx'),
+        ),
+    ]
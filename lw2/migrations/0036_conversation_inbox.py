@@ -0,0 +1,63 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:19
+
+import datetime
+from django.db import migrations, models
+
+
+def fill_inbox(apps, schema_editor):
+    # Messages sent before this migration count as read
+    Conversation = apps.get_model('lw2', 'Conversation')
+    Message = apps.get_model('lw2', 'Message')
+    Participant = apps.get_model('lw2', 'Participant')
+    for conversation in Conversation.objects.all():
+        last = Message.objects.filter(conversation=conversation).order_by(
+            '-created_at', '-id').first()
+        if last:
+            conversation.last_message_at = last.created_at
+            conversation.last_message_preview = " ".join(last.body.split())[:140]
+        else:
+            conversation.last_message_at = conversation.created_at
+        conversation.save()
+        Participant.objects.filter(conversation=conversation).update(
+            last_message_at=conversation.last_message_at,
+            last_read_at=last.created_at if last else None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0035_message_conversation_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(default=datetime.datetime.today),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=140),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='last_message_at',
+            field=models.DateTimeField(default=datetime.datetime.today),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='unread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='participant',
+            index=models.Index(fields=['user', 'last_message_at'], name='lw2_partici_user_id_248063_idx'),
+        ),
+        migrations.RunPython(fill_inbox, migrations.RunPython.noop),
+    ]
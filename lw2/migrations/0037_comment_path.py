@@ -0,0 +1,72 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:22
+
+from datetime import datetime, timedelta, timezone
+import hashlib
+
+from django.db import migrations, models
+from django.utils.timezone import is_naive, make_aware
+
+
+# A copy of lw2.comments.path_segment() as it was when this migration was
+# written, so later changes there don't change what it does
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TIME_LENGTH = 11
+HASH_LENGTH = 8
+
+def base36(number, width):
+    digits = []
+    while number:
+        number, digit = divmod(number, 36)
+        digits.append(DIGITS[digit])
+    return "".join(reversed(digits)).rjust(width, "0")[-width:]
+
+def path_segment(comment_id, posted_at):
+    if is_naive(posted_at):
+        posted_at = make_aware(posted_at)
+    microseconds = (posted_at - EPOCH) // timedelta(microseconds=1)
+    return (base36(max(microseconds, 0), TIME_LENGTH) +
+            hashlib.md5(comment_id.encode("utf-8")).hexdigest()[:HASH_LENGTH])
+
+
+def fill_paths(apps, schema_editor):
+    Comment = apps.get_model('lw2', 'Comment')
+    comments = {comment_id: (parent_id, posted_at) for comment_id, parent_id, posted_at
+                in Comment.objects.values_list('id', 'parent_comment_id', 'posted_at')}
+    paths = {}
+    def path(comment_id):
+        # Walk up to the nearest ancestor with a path, then back down
+        chain = []
+        while comment_id in comments and comment_id not in paths:
+            if comment_id in chain:
+                # A reply loop, break it here
+                break
+            chain.append(comment_id)
+            comment_id = comments[comment_id][0]
+        prefix = paths.get(comment_id, "")
+        for comment_id in reversed(chain):
+            prefix = paths[comment_id] = prefix + path_segment(
+                comment_id, comments[comment_id][1])
+        return prefix
+    for comment_id in comments:
+        Comment.objects.filter(id=comment_id).update(path=path(comment_id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0036_conversation_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=1900),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='lw2_comment_post_id_69af7c_idx'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+# One per CommentsList view, leaving deleted comments out. Partial indexes
+# work on SQLite and Postgres. Nothing is created on other databases, where
+# the views fall back on the model's own indexes on posted_at, (post,
+# posted_at) and (user, posted_at).
+# Postgres builds them CONCURRENTLY, so the table isn't locked against writes
+# meanwhile. That can't happen in a transaction, hence atomic = False below.
+FORWARDS = [
+    """CREATE INDEX {concurrently} lw2_comment_recent ON lw2_comment (posted_at)
+       WHERE NOT is_deleted""",
+    """CREATE INDEX {concurrently} lw2_comment_post_top ON lw2_comment
+       (post_id, base_score DESC, posted_at DESC) WHERE NOT is_deleted""",
+    """CREATE INDEX {concurrently} lw2_comment_post_new ON lw2_comment (post_id, posted_at)
+       WHERE NOT is_deleted""",
+    """CREATE INDEX {concurrently} lw2_comment_user_new ON lw2_comment (user_id, posted_at)
+       WHERE NOT is_deleted""",
+]
+
+BACKWARDS = [
+    "DROP INDEX {concurrently} lw2_comment_recent",
+    "DROP INDEX {concurrently} lw2_comment_post_top",
+    "DROP INDEX {concurrently} lw2_comment_post_new",
+    "DROP INDEX {concurrently} lw2_comment_user_new",
+]
+
+def run(statements, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor in ("postgresql", "sqlite"):
+        concurrently = "CONCURRENTLY" if vendor == "postgresql" else ""
+        for statement in statements:
+            schema_editor.execute(statement.format(concurrently=concurrently))
+
+def create_view_indexes(apps, schema_editor):
+    run(FORWARDS, schema_editor)
+
+def drop_view_indexes(apps, schema_editor):
+    run(BACKWARDS, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('lw2', '0037_comment_path'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_view_indexes, drop_view_indexes),
+    ]
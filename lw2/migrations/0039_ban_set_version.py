@@ -0,0 +1,20 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0038_comment_view_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BanSetVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2026-10-19 05:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0039_ban_set_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent_comment', 'path'], name='lw2_comment_parent__b89025_idx'),
+        ),
+    ]
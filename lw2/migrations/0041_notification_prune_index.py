@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+# For prune_notifications(), which deletes old notifications once they've
+# been viewed. Partial on SQLite and Postgres, so unread notifications take
+# no room in it; other databases get a plain index on both columns. Postgres
+# builds it CONCURRENTLY, which can't happen in a transaction, hence atomic =
+# False below.
+FORWARDS = {
+    "partial": """CREATE INDEX {concurrently} lw2_notification_viewed
+                  ON lw2_notification (created_at) WHERE viewed""",
+    "plain": """CREATE INDEX lw2_notification_viewed
+                ON lw2_notification (viewed, created_at)""",
+}
+
+BACKWARDS = {
+    "partial": "DROP INDEX {concurrently} lw2_notification_viewed",
+    "plain": "DROP INDEX lw2_notification_viewed ON lw2_notification",
+}
+
+def run(statements, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor in ("postgresql", "sqlite"):
+        concurrently = "CONCURRENTLY" if vendor == "postgresql" else ""
+        schema_editor.execute(statements["partial"].format(concurrently=concurrently))
+    else:
+        schema_editor.execute(statements["plain"])
+
+def create_prune_index(apps, schema_editor):
+    run(FORWARDS, schema_editor)
+
+def drop_prune_index(apps, schema_editor):
+    run(BACKWARDS, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('lw2', '0040_comment_reply_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prune_index, drop_prune_index),
+    ]
@@ -14,11 +14,14 @@ class Profile(models.Model):
     name is desirable.
     - karma: The users karma score, this may be removed in later versions.
     - last_notifications_check: The last time the user's client checked their notifications.
+    - unread_notifications: How many notifications the user has gotten since 
+    last_notifications_check and not yet viewed, maintained by lw2.notifications.
     - moderator: Whether the user is a moderator or not. (May eventually be moved)"""
     user = models.OneToOneField(User, related_name="profile", on_delete=models.CASCADE)
     display_name = models.CharField(null=True, max_length=40)
     karma = models.IntegerField(default=1)
     last_notifications_check = models.DateTimeField(default=datetime.today)
+    unread_notifications = models.IntegerField(default=0)
     moderator = models.BooleanField(default=False)
     # TODO: Modularize this out into an extension somehow
     hypothesis_user = models.CharField(null=True, default=None, max_length=512)
@@ -43,9 +46,11 @@ class Post(models.Model):
     - comment_count: The number of comments on the post.
     - view_count: How many views the post has gotten since it was published.
     - draft: Whether the post is a draft or not."""
+    class Meta:
+        indexes = [models.Index(fields=['user', 'posted_at'])]
 
     id = models.CharField(primary_key=True, max_length=17)
-    posted_at = models.DateTimeField(default=datetime.today)
+    posted_at = models.DateTimeField(default=datetime.today, db_index=True)
     frontpage_date = models.DateTimeField(blank=True, null=True, default=None)
     curated_date = models.DateTimeField(blank=True, null=True, default=None)
     user = models.ForeignKey(User, related_name="posts",
@@ -54,7 +59,7 @@ class Post(models.Model):
                              max_length=250)
     url = models.URLField(blank=True, null=True)
     slug = models.CharField(max_length=60)
-    base_score = models.IntegerField(default=1)
+    base_score = models.IntegerField(default=1, db_index=True)
     body = models.TextField()
     vote_count = models.IntegerField(default=0)
     comment_count = models.IntegerField(default=0)
@@ -72,7 +77,13 @@ class Comment(models.Model):
     - posted_at: The time at which the comment was posted.
     - base_score: The score of the comment object.
     - body: A markdown text comment body.
-    - is_deleted: Whether the post has been hidden from public consumption."""
+    - is_deleted: Whether the post has been hidden from public consumption.
+    - path: The comment's place in its thread, see lw2.comments."""
+    class Meta:
+        indexes = [models.Index(fields=['user', 'posted_at']),
+                   models.Index(fields=['post', 'posted_at']),
+                   models.Index(fields=['post', 'path']),
+                   models.Index(fields=['parent_comment', 'path'])]
     id = models.CharField(primary_key=True, max_length=17)
     user = models.ForeignKey(User, related_name="comments",
                              null=True, on_delete=models.SET_NULL)
@@ -80,17 +91,29 @@ class Comment(models.Model):
                              null=True, on_delete=models.SET_NULL)
     parent_comment = models.ForeignKey('Comment',
                                        null=True, on_delete=models.SET_NULL)
-    posted_at = models.DateTimeField(default=datetime.today)
-    base_score = models.IntegerField(default=1)
+    posted_at = models.DateTimeField(default=datetime.today, db_index=True)
+    base_score = models.IntegerField(default=1, db_index=True)
     body = models.TextField()
     retracted = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
+    path = models.CharField(max_length=1900, blank=True, default="", db_index=True)
 
 def validate_tag_text(text):
     if "," in text or ";" in text:
         raise ValidationError("Commas and semicolons aren't allowed in tags")
     if not re.sub("\s","",text):
         raise ValidationError("Can't create a tag that's only whitespace")
+
+class TagName(models.Model):
+    """An entry in the normalized tag vocabulary, shared by every tag whose text
+    case-folds to the same key.
+
+    - key: The case-folded tag text, unique across the vocabulary.
+    - text: The tag text as it was first written, used for display.
+    - count: The number of tags currently using this name."""
+    key = models.TextField(unique=True)
+    text = models.TextField()
+    count = models.IntegerField(default=0, db_index=True)
     
 class Tag(models.Model):
     """A tag on a post, comment, or other taggable item.
@@ -100,21 +123,52 @@ class Tag(models.Model):
     - type: The type of media that was tagged.
     - created_at: The date on which the tag was made.
     - text: The tag text, which is case sensitive on storage but searched casei
+    - tag_name: The vocabulary entry for the tag's case-folded text.
     """
     user = models.ForeignKey(User, related_name="tags",
                              null=True, on_delete=models.SET_NULL)
-    document_id = models.CharField(max_length=17)
+    document_id = models.CharField(max_length=17, db_index=True)
     # Not an arbitrary limit, think about using type strings in code
     # They need to be able to fit onto a line with other code on it.
     type = models.CharField(max_length=40)
     created_at = models.DateTimeField(default=datetime.today)
     # Length-Limited by views
     text = models.TextField(validators=[validate_tag_text])
+    tag_name = models.ForeignKey(TagName, related_name="tags",
+                                 null=True, on_delete=models.PROTECT)
 
     def clean(self):
         # Replace non-space whitespace and strip leading whitespace
         self.text = re.sub("\s", " ", self.text).strip()
     
+class RelatedPost(models.Model):
+    """A precomputed neighbour of a post, by tag similarity. These are rebuilt
+    in bulk by the compute_related_posts command rather than kept up to date.
+
+    - post: The post the neighbour was computed for.
+    - related: The neighbouring post.
+    - rank: The neighbour's position in the post's list, starting from 0.
+    - score: The cosine similarity of the two posts' rarity weighted tags."""
+    class Meta:
+        indexes = [models.Index(fields=['post', 'rank'])]
+    post = models.ForeignKey(Post, related_name="related_links",
+                             on_delete=models.CASCADE)
+    related = models.ForeignKey(Post, related_name="+",
+                                on_delete=models.CASCADE)
+    rank = models.IntegerField()
+    score = models.FloatField()
+    
+class SearchDocument(models.Model):
+    """A post or comment registered in the full text search index. The row's id
+    is the key of the document's text in the index table, see fulltext.py.
+
+    - collection: 'posts' or 'comments'.
+    - document_id: The id of the indexed post or comment."""
+    class Meta:
+        unique_together = (('collection', 'document_id'),)
+    collection = models.CharField(max_length=20)
+    document_id = models.CharField(max_length=17)
+    
 class Vote(models.Model):
     """A vote on a post, comment, or other votable item.
 
@@ -131,6 +185,7 @@ class Vote(models.Model):
 class Notification(models.Model):
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['user', 'created_at'])]
     user = models.ForeignKey(User, related_name="notifications",
                              on_delete=models.CASCADE)
     created_at = models.DateTimeField(default=datetime.today)
@@ -141,16 +196,38 @@ class Notification(models.Model):
     viewed = models.BooleanField(default=False)
     
 class Conversation(models.Model):
+    """A private conversation between its participants.
+
+    - last_message_at: When the last message was sent, or when the 
+    conversation was created if there aren't any.
+    - last_message_preview: The start of the last message's body."""
     created_at = models.DateTimeField(default=datetime.today)
     title = models.CharField(max_length=150)
+    last_message_at = models.DateTimeField(default=datetime.today)
+    last_message_preview = models.CharField(max_length=140, blank=True, default="")
 
 class Participant(models.Model):
+    """A user taking part in a conversation, with their inbox entry for it.
+
+    - last_message_at: A copy of the conversation's, so the inbox is sorted 
+    along this table's index.
+    - last_read_at: When the user last read the conversation, if ever.
+    - unread_count: How many messages others have sent since last_read_at.
+
+    These are maintained by lw2.conversations."""
+    class Meta:
+        indexes = [models.Index(fields=['user', 'last_message_at'])]
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     conversation = models.ForeignKey(Conversation,
                                      related_name="participants",
                                      on_delete=models.CASCADE)
+    last_message_at = models.DateTimeField(default=datetime.today)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.IntegerField(default=0)
     
 class Message(models.Model):
+    class Meta:
+        indexes = [models.Index(fields=['conversation', 'created_at'])]
     user = models.ForeignKey(User,
                              null=True, on_delete=models.SET_NULL)
     conversation = models.ForeignKey(Conversation, related_name="messages",
@@ -176,6 +253,13 @@ class Ban(models.Model):
     until = models.DateTimeField()
     appeal_on = models.DateTimeField()
 
+class BanSetVersion(models.Model):
+    """A single row counting changes to bans, which every process compares
+    its in-memory copy of the active bans against. See bans.py.
+
+    - version: How many times bans have changed."""
+    version = models.BigIntegerField(default=0)
+
 class Invite(models.Model):
     """An invitation to join the forum.
 
@@ -0,0 +1,342 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from lw2.models import Comment, Message, Notification, Participant, Profile
+from lw2.events import event_hub
+from datetime import timedelta
+import logging
+import queue
+import re
+import threading
+import time
+
+"""Notification fan-out for replies, mentions and private messages.
+
+Creating a comment or message only queues an event naming it. A background
+thread takes events off the queue in batches, works out who should be
+notified of each, and inserts all of the batch's notifications with one
+bulk_create:
+
+- newReply: The author of the comment being replied to.
+- newComment: The author of the post, for comments that aren't replies.
+- newMention: Users named as @username in a comment, unless they're already
+  being notified of it.
+- newMessage: The other participants of a conversation.
+
+Nobody is notified of their own comments and messages. Recipients'
+Profile.unread_notifications counters go up in the same transaction.
+UsersEdit resets a counter when last_notifications_check moves, and
+reconcile_unread_counts() repairs any that have drifted. Clients waiting in
+lw2.events are woken once the notifications are committed.
+
+lw2.events uses notification ids as cursors, which only works if they
+become visible in id order. An autoincrement id is handed out at insert
+but a transaction commits whenever it gets round to it, so fan-out takes
+lock_notification_ids() before inserting and holds it until commit.
+
+Clients mark notifications read with mark_read(), which takes them off the
+unread counter too, and prune_notifications() deletes read ones once
+they're NOTIFICATION_RETENTION_DAYS old.
+
+Events wait at most settings.NOTIFICATION_FANOUT_DELAY seconds for a batch
+to fill up. Queued events are lost if the process exits before they're
+handled.
+
+settings.NOTIFICATION_FANOUT = 'inline' handles events on the spot instead,
+which is what the tests use. fanout_metrics() reports the queue depth and
+how much work has been done."""
+
+logger = logging.getLogger(__name__)
+
+MENTION_RE = re.compile(r"(?<![\w@])@([\w.@+-]+)")
+# Mentions past this many in one comment are ignored
+MAX_MENTIONS = 20
+
+def mentioned_usernames(body):
+    usernames = []
+    for username in MENTION_RE.findall(body or ""):
+        # Trailing punctuation belongs to the sentence, not the name
+        username = username.rstrip(".")
+        if username and username not in usernames:
+            usernames.append(username)
+    return usernames[:MAX_MENTIONS]
+
+def fan_out(events):
+    """Create the notifications for a batch of ("comment", id) and
+    ("message", id) events. Returns the notifications created."""
+    comment_ids = [document_id for kind, document_id in events if kind == "comment"]
+    message_ids = [document_id for kind, document_id in events if kind == "message"]
+    comments = Comment.objects.select_related(
+        "user", "post", "parent_comment").in_bulk(comment_ids)
+    messages = Message.objects.select_related("user", "conversation").in_bulk(
+        message_ids)
+    usernames = set()
+    for comment in comments.values():
+        usernames.update(mentioned_usernames(comment.body))
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list(
+        "username", "id")) if usernames else {}
+    participants = {}
+    for conversation_id, user_id in Participant.objects.filter(
+            conversation_id__in=[message.conversation_id
+                                 for message in messages.values()]).values_list(
+                                         "conversation_id", "user_id"):
+        participants.setdefault(conversation_id, []).append(user_id)
+
+    now = timezone.now()
+    notifications = {}
+    def notify(user_id, actor_id, document_id, document_type, kind, message):
+        key = (user_id, document_type, document_id)
+        if user_id is None or user_id == actor_id or key in notifications:
+            return
+        notifications[key] = Notification(
+            user_id=user_id, created_at=now, document_id=document_id,
+            document_type=document_type, type=kind, message=message)
+
+    def notify_comment(comment):
+        author = comment.user.username if comment.user else "Someone"
+        # The post can be deleted out from under its comments
+        title = comment.post.title if comment.post else "a deleted post"
+        if comment.parent_comment:
+            notify(comment.parent_comment.user_id, comment.user_id, comment.id,
+                   "comment", "newReply",
+                   "{} replied to your comment on {}".format(author, title))
+        elif comment.post:
+            notify(comment.post.user_id, comment.user_id, comment.id,
+                   "comment", "newComment",
+                   "{} commented on {}".format(author, title))
+        for username in mentioned_usernames(comment.body):
+            notify(user_ids.get(username), comment.user_id, comment.id,
+                   "comment", "newMention",
+                   "{} mentioned you on {}".format(author, title))
+
+    def notify_message(message):
+        author = message.user.username if message.user else "Someone"
+        for user_id in participants.get(message.conversation_id, []):
+            notify(user_id, message.user_id, str(message.id), "message",
+                   "newMessage", "{} sent you a message in {}".format(
+                       author, message.conversation.title))
+
+    for kind, document_id in events:
+        document = (comments if kind == "comment" else messages).get(document_id)
+        if document is None or getattr(document, "is_deleted", False):
+            continue
+        try:
+            (notify_comment if kind == "comment" else notify_message)(document)
+        except Exception:
+            # Don't let one bad event cost the rest of the batch theirs
+            logger.exception("Notification fan-out failed for %s %s", kind, document_id)
+    created = list(notifications.values())
+    with transaction.atomic():
+        lock_notification_ids()
+        Notification.objects.bulk_create(created)
+        increment_unread_counts(created)
+        user_ids = [notification.user_id for notification in created]
+        transaction.on_commit(lambda: event_hub.publish(user_ids))
+    return created
+
+# Key of the Postgres advisory lock fan-out inserts under
+NOTIFICATION_IDS_LOCK = 41716
+
+def lock_notification_ids():
+    """Wait until no other transaction is inserting notifications, and keep
+    them waiting until this one ends. SQLite already lets only one
+    transaction write at a time, from its first write until it commits."""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [NOTIFICATION_IDS_LOCK])
+
+def mark_read(user_id, up_to):
+    """Mark the user's notifications up to and including the one with id
+    up_to as viewed, in one UPDATE, and take the ones the unread counter
+    was counting off it in the same transaction. Returns how many were
+    marked."""
+    with transaction.atomic():
+        # Locking the profile keeps concurrent calls from both counting the
+        # same notifications as they go
+        last_check = Profile.objects.select_for_update().filter(
+            user_id=user_id).values_list("last_notifications_check", flat=True).first()
+        marking = Notification.objects.filter(user_id=user_id, id__lte=up_to, viewed=False)
+        counted = 0 if last_check is None else marking.filter(
+            created_at__gt=last_check).count()
+        marked = marking.update(viewed=True)
+        if counted:
+            Profile.objects.filter(user_id=user_id).update(
+                unread_notifications=Greatest(F("unread_notifications") - counted, 0))
+    return marked
+
+# Matches the condition on the index prune_notifications() reads along, see
+# migration 0041. As with lw2.comments.NOT_DELETED, filter(viewed=True) would
+# keep SQLite from using it.
+VIEWED = '"{}"."viewed"'.format(Notification._meta.db_table)
+
+def prune_notifications(max_age_days=None, batch_size=1000, pause=0.1, now=None):
+    """Delete viewed notifications older than max_age_days, by default
+    settings.NOTIFICATION_RETENTION_DAYS, batch_size at a time and sleeping
+    pause seconds between batches. Returns how many were deleted."""
+    if max_age_days is None:
+        max_age_days = getattr(settings, "NOTIFICATION_RETENTION_DAYS", 90)
+    cutoff = (now or timezone.now()) - timedelta(days=max_age_days)
+    deleted = 0
+    while True:
+        ids = list(Notification.objects.filter(created_at__lt=cutoff).extra(
+            where=[VIEWED]).order_by().values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += Notification.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+def increment_unread_counts(notifications):
+    """Add new notifications to their recipients' unread counters, with one
+    UPDATE per distinct number of new notifications."""
+    per_user = {}
+    for notification in notifications:
+        per_user[notification.user_id] = per_user.get(notification.user_id, 0) + 1
+    by_delta = {}
+    for user_id, delta in per_user.items():
+        by_delta.setdefault(delta, []).append(user_id)
+    for delta, user_ids in by_delta.items():
+        Profile.objects.filter(user_id__in=user_ids).update(
+            unread_notifications=F("unread_notifications") + delta)
+
+def unread_count_subquery():
+    """The number of unviewed notifications newer than
+    last_notifications_check, for annotating or updating Profiles."""
+    return Coalesce(Subquery(
+        Notification.objects.filter(
+            user_id=OuterRef("user_id"), viewed=False,
+            created_at__gt=OuterRef("last_notifications_check")).order_by().values(
+                "user_id").annotate(count=Count("id")).values("count"),
+        output_field=IntegerField()), 0)
+
+def reset_unread_count(profile):
+    """Set profile's unread counter to match its last_notifications_check,
+    which should already be saved."""
+    count = Notification.objects.filter(
+        user_id=profile.user_id, viewed=False,
+        created_at__gt=profile.last_notifications_check).count()
+    Profile.objects.filter(id=profile.id).update(unread_notifications=count)
+    profile.unread_notifications = count
+
+def reconcile_unread_counts(batch_size=1000):
+    """Recount every unread counter from the notifications themselves, a
+    batch of profiles per UPDATE. Returns how many counters were wrong."""
+    fixed = 0
+    last_id = 0
+    while True:
+        ids = list(Profile.objects.filter(id__gt=last_id).order_by("id").values_list(
+            "id", flat=True)[:batch_size])
+        if not ids:
+            return fixed
+        last_id = ids[-1]
+        with transaction.atomic():
+            wrong = Profile.objects.filter(id__in=ids).annotate(
+                actual=unread_count_subquery()).exclude(
+                    unread_notifications=F("actual")).values_list("id", flat=True)
+            fixed += Profile.objects.filter(id__in=list(wrong)).update(
+                unread_notifications=unread_count_subquery())
+
+class FanoutQueue(object):
+    """Queue of notification events with a worker thread to handle them."""
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=getattr(
+            settings, "NOTIFICATION_QUEUE_SIZE", 10000))
+        self.lock = threading.Lock()
+        self.worker = None
+        self.metrics = {"enqueued":0, "processed":0, "notifications":0,
+                        "batches":0, "overflows":0, "errors":0,
+                        "max_depth":0, "last_batch_seconds":0.0}
+
+    def count(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                self.metrics[name] += delta
+
+    def put(self, event):
+        self.ensure_worker()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Too far behind, make this request pay for its own notifications
+            self.count(overflows=1)
+            self.handle([event])
+            return
+        with self.lock:
+            self.metrics["enqueued"] += 1
+            self.metrics["max_depth"] = max(self.metrics["max_depth"],
+                                            self.queue.qsize())
+
+    def ensure_worker(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, daemon=True,
+                                               name="notification-fanout")
+                self.worker.start()
+
+    def take_batch(self):
+        """Wait for an event, then take whatever else arrives within the
+        delay budget, up to the batch size."""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + getattr(settings, "NOTIFICATION_FANOUT_DELAY", 1.0)
+        batch_size = getattr(settings, "NOTIFICATION_BATCH_SIZE", 500)
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def handle(self, batch):
+        started = time.monotonic()
+        try:
+            created = fan_out(batch)
+        except Exception:
+            logger.exception("Notification fan-out failed for %d events", len(batch))
+            self.count(errors=1)
+            return
+        self.count(processed=len(batch), notifications=len(created), batches=1)
+        with self.lock:
+            self.metrics["last_batch_seconds"] = time.monotonic() - started
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            self.handle(batch)
+            close_old_connections()
+
+    def snapshot(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics["depth"] = self.queue.qsize()
+        return metrics
+
+fanout_queue = FanoutQueue()
+
+def enqueue(kind, document_id):
+    """Queue notifications for a new document once the current transaction
+    commits, or create them right away if NOTIFICATION_FANOUT is 'inline'."""
+    if getattr(settings, "NOTIFICATION_FANOUT", "thread") == "inline":
+        fanout_queue.handle([(kind, document_id)])
+    else:
+        transaction.on_commit(lambda: fanout_queue.put((kind, document_id)))
+
+def notify_comment(comment):
+    enqueue("comment", comment.id)
+
+def notify_message(message):
+    enqueue("message", message.id)
+
+def fanout_metrics():
+    """Counters for the fan-out stage: the current queue depth and its
+    maximum so far, events enqueued and processed, notifications created,
+    batches handled, events handled inline because the queue was full,
+    failed batches and how long the last batch took."""
+    return fanout_queue.snapshot()
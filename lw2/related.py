@@ -0,0 +1,125 @@
+from django.db import transaction
+from lw2.models import Post, Tag, RelatedPost
+import heapq
+import math
+
+"""Offline computation of related posts from tag similarity.
+
+Each post is a vector over the tag vocabulary where a tag's weight is its
+inverse document frequency, so sharing a rare tag counts for more than
+sharing a common one. Two posts' similarity is the cosine of their vectors.
+The top neighbours of every post are written to RelatedPost, which makes
+reading them back a single indexed query.
+
+numpy and scipy are optional. When they're installed the similarities are
+computed as sparse matrix products over blocks of posts, otherwise with an
+equivalent pure Python pass over an inverted index."""
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+def load_post_tags():
+    """Return a dict mapping each post id to the set of vocabulary ids of its
+    tags."""
+    post_ids = set(Post.objects.values_list("id", flat=True))
+    post_tags = {}
+    for document_id, tag_name_id in Tag.objects.filter(
+            type="post", tag_name__isnull=False).values_list("document_id",
+                                                             "tag_name_id"):
+        if document_id in post_ids:
+            post_tags.setdefault(document_id, set()).add(tag_name_id)
+    return post_tags
+
+def tag_weights(post_tags):
+    """Inverse document frequency of each tag over the tagged posts."""
+    frequencies = {}
+    for tag_name_ids in post_tags.values():
+        for tag_name_id in tag_name_ids:
+            frequencies[tag_name_id] = frequencies.get(tag_name_id, 0) + 1
+    total = len(post_tags)
+    return {tag_name_id:math.log((1 + total) / frequency)
+            for tag_name_id, frequency in frequencies.items()}
+
+def top_neighbours_sparse(post_tags, weights, top_k, block_size=1024):
+    """Yield (post_id, [(score, related_id), ...]) using sparse matrix math."""
+    post_ids = sorted(post_tags)
+    columns = {tag_name_id:column
+               for column, tag_name_id in enumerate(sorted(weights))}
+    rows, cols, values = [], [], []
+    for row, post_id in enumerate(post_ids):
+        for tag_name_id in post_tags[post_id]:
+            rows.append(row)
+            cols.append(columns[tag_name_id])
+            values.append(weights[tag_name_id])
+    matrix = sparse.csr_matrix((values, (rows, cols)),
+                               shape=(len(post_ids), len(columns)))
+    norms = numpy.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms).dot(matrix).tocsr()
+    transposed = matrix.T.tocsc()
+    for start in range(0, len(post_ids), block_size):
+        block = matrix[start:start + block_size].dot(transposed).tocsr()
+        for offset in range(block.shape[0]):
+            row = start + offset
+            similar = block.getrow(offset)
+            neighbours = [(score, post_ids[column])
+                          for column, score in zip(similar.indices, similar.data)
+                          if column != row and score > 0]
+            yield post_ids[row], heapq.nlargest(top_k, neighbours)
+
+def top_neighbours_python(post_tags, weights, top_k):
+    """Yield (post_id, [(score, related_id), ...]) with plain dictionaries."""
+    tag_posts = {}
+    for post_id, tag_name_ids in post_tags.items():
+        for tag_name_id in tag_name_ids:
+            tag_posts.setdefault(tag_name_id, []).append(post_id)
+    norms = {post_id:math.sqrt(sum(weights[t] ** 2 for t in tag_name_ids)) or 1
+             for post_id, tag_name_ids in post_tags.items()}
+    for post_id in sorted(post_tags):
+        dot_products = {}
+        for tag_name_id in post_tags[post_id]:
+            weight = weights[tag_name_id] ** 2
+            for related_id in tag_posts[tag_name_id]:
+                if related_id != post_id:
+                    dot_products[related_id] = dot_products.get(related_id, 0) + weight
+        neighbours = [(dot_product / (norms[post_id] * norms[related_id]), related_id)
+                      for related_id, dot_product in dot_products.items()
+                      if dot_product > 0]
+        yield post_id, heapq.nlargest(top_k, neighbours)
+
+def compute_related_posts(top_k=10, use_sparse=None, batch_size=1000):
+    """Recompute the RelatedPost table, keeping top_k neighbours per post.
+    Returns the number of rows written."""
+    if use_sparse is None:
+        use_sparse = sparse is not None
+    post_tags = load_post_tags()
+    weights = tag_weights(post_tags)
+    if use_sparse and post_tags:
+        neighbours = top_neighbours_sparse(post_tags, weights, top_k)
+    else:
+        neighbours = top_neighbours_python(post_tags, weights, top_k)
+    written = 0
+    with transaction.atomic():
+        RelatedPost.objects.all().delete()
+        batch = []
+        for post_id, related in neighbours:
+            for rank, (score, related_id) in enumerate(related):
+                batch.append(RelatedPost(post_id=post_id, related_id=related_id,
+                                         rank=rank, score=float(score)))
+            if len(batch) >= batch_size:
+                RelatedPost.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        RelatedPost.objects.bulk_create(batch)
+        written += len(batch)
+    return written
+
+def related_posts(post, limit=5):
+    """The precomputed neighbours of post, most similar first."""
+    return [link.related for link in
+            RelatedPost.objects.filter(post=post).select_related(
+                "related").order_by("rank")[:limit]]
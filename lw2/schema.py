@@ -3,12 +3,22 @@ import graphene
 from graphene.types.generic import GenericScalar
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login
+from django.contrib.sessions.backends.signed_cookies import SessionStore as SignedSessionStore
+from django.db import transaction
 from django.db.models.functions import Greatest
 from .models import Profile,Vote, Notification, Conversation, Participant
+from .models import TagName
 from .models import Message as MessageModel
 from .models import Post as PostModel
 from .models import Comment as CommentModel
 from .markdown import md
+from . import tags as wl_tags
+from . import related as wl_related
+from .user_context import get_user_context
+from .bans import active_bans
+from . import notifications as wl_notifications
+from . import conversations as wl_conversations
+from . import comments as wl_comments
 from datetime import datetime, timezone
 
 import hashlib
@@ -37,6 +47,7 @@ class UserType(DjangoObjectType):
     display_name = graphene.String()
     karma = graphene.Int()
     last_notifications_check = graphene.types.datetime.Date()
+    unread_notifications_count = graphene.Int()
 
     def resolve__id(self, info):
         return str(self.id)
@@ -67,6 +78,15 @@ class UserType(DjangoObjectType):
         except AttributeError:
             raise ValueError("User {} has no profile!".format(self.username))
 
+    def resolve_unread_notifications_count(self, info):
+        # Nobody else's business
+        if not get_user_context(info.context).is_user(self.id):
+            return None
+        try:
+            return self.profile.unread_notifications
+        except AttributeError:
+            raise ValueError("User {} has no profile!".format(self.username))
+
 class UsersInput(graphene.InputObjectType):
     last_notifications_check = graphene.types.datetime.DateTime()
 
@@ -79,22 +99,33 @@ class UsersEdit(graphene.Mutation):
         
     @staticmethod
     def mutate(root, info, document_id=None, set=None):
-        user = User.objects.get(id=document_id)
-        if not (user == info.context.user and info.context.user.is_authenticated):
+        current = get_user_context(info.context)
+        try:
+            user_id = int(document_id)
+        except (TypeError, ValueError):
+            raise ValueError("'{}' is not a user id".format(document_id))
+        if not current.is_user(user_id):
             raise ValueError(
                 "Trying to change properties of user {} but logged in as {}".format(
-                    user.username,
-                    info.context.user.username)
+                    User.objects.filter(id=user_id).values_list(
+                        "username", flat=True).first() or user_id,
+                    current.user.username)
                 )
-        try:
-            profile = Profile.objects.get(user=user)
-        except Profile.DoesNotExist:
-            profile = Profile(user=user)
-                              
-        if set.last_notifications_check:
+        user = current.user
+        # Not current.profile, which can be a stale copy from the auth cache.
+        # Only the edited fields are written back, so the unread counter and
+        # whatever else other requests change meanwhile are left alone.
+        profile, created = Profile.objects.get_or_create(user=user)
+        changed = []
+        if (set.last_notifications_check and
+                set.last_notifications_check != profile.last_notifications_check):
             profile.last_notifications_check = set.last_notifications_check
+            changed.append("last_notifications_check")
 
-        profile.save()
+        if changed:
+            profile.save(update_fields=changed)
+        if "last_notifications_check" in changed:
+            wl_notifications.reset_unread_count(profile)
         return UsersEdit(_id=str(user.id))
         
                
@@ -111,7 +142,15 @@ class Login(graphene.Mutation):
     def mutate(root, info, username=None, password=None):
         user = authenticate(info.context, username=username, password=password)
         if user is not None:
+            ban = active_bans.get(user.id)
+            if ban is not None:
+                raise ValueError("You are banned until {}: {}".format(
+                    ban[0].isoformat(), ban[1]))
             login(info.context, user)
+            if isinstance(info.context.session, SignedSessionStore):
+                # Signed session keys are the session data, so re-sign it
+                # now that it has the login in it
+                info.context.session.save()
             return Login(user_id=user.id,
                          session_key=info.context.session.session_key,
                          expiration=(
@@ -154,21 +193,24 @@ class Comment(DjangoObjectType):
         description="Whether this comment has been deleted from view.")
     af = graphene.Boolean(
         description="Legacy field for whether we're on alignment forum, always false.")
+    depth = graphene.Int(
+        description="How many comments up the thread this one is nested, 0 at the top.")
+    more_replies = graphene.Int(
+        description="In trees cut down by maxDepth or maxChildren, how many replies were left out.")
+    more_replies_cursor = graphene.String(
+        description="Pass to CommentsBranch to get the replies that were left out.")
     
     def resolve__id(self, info):
         return self.id
     
     def resolve_user_id(self, info):
-        return str(self.user.id)
+        return str(self.user_id) if self.user_id else None
 
     def resolve_post_id(self, info):
-        return self.post.id
+        return self.post_id
 
     def resolve_parent_comment_id(self, info):
-        try:
-            return self.parent_comment.id
-        except AttributeError:
-            return None
+        return self.parent_comment_id
 
     def resolve_html_body(self, info):
         if self.is_deleted:
@@ -195,6 +237,9 @@ class Comment(DjangoObjectType):
         """Legacy field for whether this is the Alignment Forum, always false."""
         return False
 
+    def resolve_depth(self, info):
+        return wl_comments.depth(self)
+
 class CommentsInput(graphene.InputObjectType):
     body = graphene.String()
     post_id = graphene.String()
@@ -213,11 +258,11 @@ class CommentsNew(graphene.Mutation):
     
     @staticmethod
     def mutate(root, info, document=None):
-        user = info.context.user
+        current = get_user_context(info.context)
+        user = current.user
         if not document:
             return
-        if not user.is_authenticated:
-            raise ValueError("You're not logged in!")
+        current.require_write()
         if document.parent_comment_id:
             parent_comment =  CommentModel.objects.get(id=document.parent_comment_id)
         else:
@@ -239,6 +284,7 @@ class CommentsNew(graphene.Mutation):
             body=document.body)
         #TODO: Am I supposed to call save here or is there framework stuff I'm missing?
         comment.save()
+        wl_notifications.notify_comment(comment)
 
         return CommentsNew(comment=comment)
 
@@ -260,11 +306,13 @@ class CommentsEdit(graphene.Mutation):
             raise ValueError(
                     "You have set no changes to be made.  You must change at least one thing to save it.")
         comment = CommentModel.objects.get(id=document_id)
-        if info.context.user != comment.user:
+        current = get_user_context(info.context)
+        if not current.is_user(comment.user_id):
             raise ValueError(
                             "WrongUserError: You are {}, but to edit this comment you need to be {}.".format(
-                                                info.context.user.username, 
+                                                current.user.username, 
                                                 comment.user.username))
+        current.require_write()
         comment.body = set.body
         comment.save()
         return CommentsEdit(comment=comment)
@@ -283,6 +331,10 @@ class Post(DjangoObjectType):
                               description="Number of words in post body.")
     all_votes = graphene.List(VoteType, resolver=lambda x,y: [])
     current_user_votes = graphene.List(VoteType, resolver=lambda x,y:[])
+    related_posts = graphene.List(
+        lambda: Post,
+        limit=graphene.Int(default_value=5),
+        description="Posts with similar tags, most similar first.")
 
     meta = graphene.Boolean(
         description="""Legacy field for whether our post goes in 'meta' section, \
@@ -300,6 +352,10 @@ class Post(DjangoObjectType):
         """Create an HTML text from the Markdown post body."""
         return md.convert(self.body)
 
+    def resolve_related_posts(self, info, limit=5):
+        """Read the neighbours precomputed by the compute_related_posts command."""
+        return wl_related.related_posts(self, min(limit, 50))
+
     def resolve_comment_count(self, info):
         """Derived field that returns the number of comments on a given post."""
         return self.comments.count()
@@ -344,9 +400,9 @@ class PostsNew(graphene.Mutation):
 
     @staticmethod
     def mutate(root, info, document=None):
-        user = info.context.user
-        if not user.is_authenticated:
-            raise ValueError("Your user isn't logged in")
+        current = get_user_context(info.context)
+        current.require_write("Your user isn't logged in")
+        user = current.user
         if not document.title:
             raise ValueError("Can't make a post with an empty title!")
         posted_at = datetime.today()
@@ -389,11 +445,13 @@ class PostsEdit(graphene.Mutation):
                 "Your set has no changes to be made.  " +
                 "You must change at least one thing to save.")
         post = PostModel.objects.get(id=document_id)
-        if info.context.user != post.user:
+        current = get_user_context(info.context)
+        if not current.is_user(post.user_id):
             raise ValueError(
                             "WrongUserError: You are {}, but to edit this post you need to be {}.".format(
-                                                info.context.user.username, 
+                                                current.user.username, 
                                                 post.user.username))
+        current.require_write()
         post.body = set.body
         if set.title != None:
             post.title = set.title
@@ -423,12 +481,14 @@ class NewVote(graphene.Mutation):
     @staticmethod
     def mutate(root, info, document_id=None, vote_type=None,
                collection_name=None):
+        current = get_user_context(info.context)
+        current.require_write("You need to be logged in to vote")
         if collection_name.lower() == "comments":
             if Vote.objects.filter(document_id=document_id):
                 raise ValueError("User already voted on this")
             comment = CommentModel.objects.get(id=document_id)
             #TODO: Enforce valid vote types
-            vote = Vote(user=info.context.user,
+            vote = Vote(user=current.user,
                         document_id=document_id,
                         voted_at=datetime.today(),
                         vote_type=vote_type)
@@ -449,7 +509,7 @@ class NewVote(graphene.Mutation):
                 raise ValueError("User already voted on this")
             post = PostModel.objects.get(id=document_id)
             #TODO: Enforce valid vote types
-            vote = Vote(user=info.context.user,
+            vote = Vote(user=current.user,
                         document_id=document_id,
                         voted_at=datetime.today(),
                         vote_type=vote_type)
@@ -471,12 +531,40 @@ class NewVote(graphene.Mutation):
                 
     
 class CommentsTerms(graphene.InputObjectType):
-    """Search terms for the comments_total and the comments_list."""
+    """Search terms for the comments_total and the comments_list.
+
+    comments_list has the LW 2 views recentComments, allRecentComments,
+    postCommentsTop, postCommentsNew (both need post_id) and userComments
+    (needs user_id), which leave out deleted comments and return limit
+    comments at most, see lw2.comments.VIEWS. It also has these, in thread
+    order:
+
+    - postCommentsThreaded: Every comment on post_id.
+    - commentReplies: The comment with comment_id and every reply under it.
+    - commentAncestors: The comments that comment_id is a reply to, from
+      the top of the thread down.
+
+    Giving max_depth or max_children cuts the first two down to that many
+    levels of replies and that many replies per comment, at most and by
+    default lw2.comments.MAX_CHILDREN_LIMIT, see Comment.more_replies. Then
+    limit and offset page through the top level comments of
+    postCommentsThreaded, COMMENTS_PAGE_SIZE of them by default."""
     limit = graphene.Int()
     offset = graphene.Int()
     post_id = graphene.String()
     user_id = graphene.String()
+    comment_id = graphene.String()
     view = graphene.String()
+    max_depth = graphene.Int()
+    max_children = graphene.Int()
+
+class CommentBranch(graphene.ObjectType):
+    """Replies that were left out of a comment tree, with their own replies
+    cut down the same way."""
+    comments = graphene.List(Comment)
+    more_replies = graphene.Int(description="How many replies are still left out.")
+    more_replies_cursor = graphene.String(
+        description="Pass to CommentsBranch to get the rest of them.")
 
 class PostsTerms(graphene.InputObjectType):
     """Search terms for the posts_list."""
@@ -489,6 +577,14 @@ class PostsTerms(graphene.InputObjectType):
     # Should be boolean, but sometimes presents as null so generic required 
     meta = graphene.Boolean()
     
+class TagPostsTerms(graphene.InputObjectType):
+    """Search terms for the posts_by_tag."""
+    tag = graphene.String()
+    limit = graphene.Int()
+    offset = graphene.Int()
+    # Either 'recent' or 'score'
+    order = graphene.String()
+
 class NotificationsTerms(graphene.InputObjectType):
     """Search terms for the notifications."""
     limit = graphene.Int()
@@ -496,9 +592,35 @@ class NotificationsTerms(graphene.InputObjectType):
     user_id = graphene.String()
     view = graphene.String()
 
+class MarkNotificationsRead(graphene.Mutation):
+    """Mark the current user's notifications as viewed, all of them up to and
+    including the one with _id up_to."""
+    class Arguments:
+        up_to = graphene.String()
+
+    count = graphene.Int()
+
+    @staticmethod
+    def mutate(root, info, up_to=None):
+        current = get_user_context(info.context)
+        current.require_login()
+        try:
+            up_to = int(up_to)
+        except (TypeError, ValueError):
+            raise ValueError("'{}' is not a notification id".format(up_to))
+        return MarkNotificationsRead(
+            count=wl_notifications.mark_read(current.id, up_to))
+
 class MessagesTerms(graphene.InputObjectType):
+    """Search terms for the messages_list. Pages hold limit messages, up to
+    MESSAGES_PAGE_SIZE_MAX, oldest first. before gives the page of messages
+    before the message with that _id, after the page following it,
+    otherwise the page is the newest messages."""
     conversation_id = graphene.String()
     view = graphene.String()
+    limit = graphene.Int()
+    before = graphene.String()
+    after = graphene.String()
     
 class NotificationType(DjangoObjectType):
     class Meta:
@@ -519,6 +641,12 @@ class NotificationType(DjangoObjectType):
         # Just do a dummy resolver for now
         return None
 
+class TagNameType(DjangoObjectType):
+    class Meta:
+        model = TagName
+        only_fields = {'key', 'text', 'count'}
+        description = "An entry in the normalized tag vocabulary."
+
 class ParticipantType(DjangoObjectType):
     class Meta:
         model = Participant
@@ -527,7 +655,11 @@ class ParticipantType(DjangoObjectType):
     slug = graphene.String()
 
     def resolve_display_name(self, info):
-        display_name = self.user.profile.get(user=self.user).display_name
+        # Profiles come with the participants, see ConversationType
+        try:
+            display_name = self.user.profile.display_name
+        except Profile.DoesNotExist:
+            display_name = None
         if display_name:
             return display_name
         else:
@@ -545,12 +677,55 @@ class ConversationType(DjangoObjectType):
 
     _id = graphene.String(name="_id")
     participants = graphene.List(ParticipantType)
+    unread_count = graphene.Int()
+    last_read_at = graphene.types.datetime.DateTime()
     
     def resolve__id(self, info):
         return str(self.id)
 
     def resolve_participants(self, info):
-        return self.participants.all()
+        if "participants" in getattr(self, "_prefetched_objects_cache", {}):
+            return self.participants.all()
+        return self.participants.select_related("user__profile")
+
+    def get_inbox_entry(self, info):
+        """The current user's Participant row, as loaded by ConversationsList
+        or looked up if need be."""
+        if not hasattr(self, "inbox_entry"):
+            current = get_user_context(info.context)
+            self.inbox_entry = Participant.objects.filter(
+                conversation_id=self.id, user_id=current.id).first() if (
+                    current.is_authenticated) else None
+        return self.inbox_entry
+
+    def resolve_unread_count(self, info):
+        entry = ConversationType.get_inbox_entry(self, info)
+        return entry.unread_count if entry else None
+
+    def resolve_last_read_at(self, info):
+        entry = ConversationType.get_inbox_entry(self, info)
+        return entry.last_read_at if entry else None
+
+class ConversationsTerms(graphene.InputObjectType):
+    """Search terms for the conversations_list, the current user's
+    conversations with the most recently active first."""
+    limit = graphene.Int()
+    offset = graphene.Int()
+    view = graphene.String()
+
+class MarkConversationRead(graphene.Mutation):
+    """Mark a conversation as read by the current user."""
+    class Arguments:
+        document_id = graphene.String()
+
+    _id = graphene.String(name="_id")
+
+    @staticmethod
+    def mutate(root, info, document_id=None):
+        current = get_user_context(info.context)
+        current.require_login()
+        wl_conversations.mark_read(current.id, int(document_id))
+        return MarkConversationRead(_id=document_id)
     
 class ConversationsNew(graphene.Mutation):
     class Arguments:
@@ -566,14 +741,19 @@ class ConversationsNew(graphene.Mutation):
                     repr(document)
                     )
             )
-        convo = Conversation(title=document.title)
-        convo.save()
-        #TODO: Delete convo if we get error here
-        for participant_id in document.participant_ids:
-            user = User.objects.get(id=int(participant_id))
-            participant = Participant(user=user,
-                                      conversation=convo)
-            participant.save()
+        user_ids = set(int(participant_id)
+                       for participant_id in document.participant_ids or [])
+        missing = user_ids - set(User.objects.filter(id__in=user_ids).values_list(
+            "id", flat=True))
+        if missing:
+            raise ValueError("No user with ID '{}' found".format(min(missing)))
+        with transaction.atomic():
+            convo = Conversation(title=document.title)
+            convo.save()
+            Participant.objects.bulk_create([
+                Participant(user_id=user_id, conversation=convo,
+                            last_message_at=convo.last_message_at)
+                for user_id in sorted(user_ids)])
         return ConversationsNew(_id=convo.id)
     
 class MessagesInput(graphene.InputObjectType):
@@ -615,15 +795,18 @@ class MessagesNew(graphene.Mutation):
                     repr(document)
                     )
             )
-        if not info.context.user.is_authenticated:
-            raise ValueError("You need to be logged in to send private messages")
+        current = get_user_context(info.context)
+        current.require_write("You need to be logged in to send private messages")
         
         conversation = Conversation.objects.get(id=int(document.conversation_id))
         message_text = document.body
-        message = MessageModel(user=info.context.user,
+        message = MessageModel(user=current.user,
                                conversation=conversation,
                                body=message_text)
-        message.save()
+        with transaction.atomic():
+            message.save()
+            wl_conversations.record_message(message)
+        wl_notifications.notify_message(message)
         return MessagesNew(_id=message.id)
         
     
@@ -665,6 +848,17 @@ class Query(object):
                                 _id = graphene.String(name="_id"),
                                 slug = graphene.String(),
                                 name="PostsEdit")
+    posts_by_tag = graphene.Field(graphene.List(Post),
+                                  terms = graphene.Argument(TagPostsTerms),
+                                  name="PostsByTag")
+    tags_top = graphene.Field(graphene.List(TagNameType),
+                              limit = graphene.Int(),
+                              name="TagsTop")
+    comments_branch = graphene.Field(CommentBranch,
+                                     cursor = graphene.String(),
+                                     max_depth = graphene.Int(),
+                                     max_children = graphene.Int(),
+                                     name="CommentsBranch")
     comment = graphene.Field(Comment,
                              id=graphene.String(),
                              posted_at=graphene.types.datetime.Date(),
@@ -692,6 +886,11 @@ class Query(object):
     notifications_list = graphene.Field(graphene.List(NotificationType),
                                         terms = graphene.Argument(NotificationsTerms),
                                         name="NotificationsList")
+    unread_notifications_count = graphene.Field(graphene.Int,
+                                                name="UnreadNotificationsCount")
+    conversations_list = graphene.Field(graphene.List(ConversationType),
+                                        terms = graphene.Argument(ConversationsTerms),
+                                        name="ConversationsList")
     conversations_single = graphene.Field(ConversationType,
                                           document_id = graphene.String(),
                                           name="ConversationsSingle")
@@ -742,6 +941,18 @@ class Query(object):
             return PostModel.objects.all().annotate(test=Greatest('posted_at','comments__posted_at')).order_by('-test')[:args.limit]
         return PostModel.objects.all().annotate(test=Greatest('posted_at','comments__posted_at')).order_by('-test')
 
+    def resolve_posts_by_tag(self, info, **kwargs):
+        args = kwargs.get("terms")
+        if not (args and args.tag):
+            raise ValueError("No tag given to list posts for.")
+        offset = args.offset or 0
+        limit = min(args.limit or 20, 100)
+        posts = wl_tags.posts_with_tag(args.tag, args.order or "recent")
+        return posts[offset:offset + limit]
+
+    def resolve_tags_top(self, info, **kwargs):
+        return wl_tags.top_tags(min(kwargs.get("limit") or 20, 100))
+
     def resolve_comment(self, info, **kwargs):
         id = kwargs.get('id')
 
@@ -763,7 +974,30 @@ class Query(object):
 
     def resolve_comments_list(self, info, **kwargs):
         args = dict(kwargs.get('terms'))
-        if "user_id" in args:
+        view = args.get("view")
+        truncated = (args.get("max_depth") is not None or
+                     args.get("max_children") is not None)
+        if view in wl_comments.VIEWS:
+            return wl_comments.list_view(view, post_id=args.get("post_id"),
+                                         user_id=args.get("user_id"),
+                                         limit=args.get("limit"),
+                                         offset=args.get("offset"))
+        elif view == "postCommentsThreaded":
+            if truncated:
+                return wl_comments.load_tree(
+                    wl_comments.thread_roots(args.get("post_id"), args.get("limit"),
+                                             args.get("offset")),
+                    args.get("max_depth"), args.get("max_children"))
+            return wl_comments.thread(args.get("post_id"))
+        elif view in ("commentReplies", "commentAncestors"):
+            comment = CommentModel.objects.get(id=args.get("comment_id"))
+            if view == "commentAncestors":
+                return wl_comments.ancestors(comment)
+            if truncated:
+                return wl_comments.load_tree([comment.id], args.get("max_depth"),
+                                             args.get("max_children"))
+            return wl_comments.subtree(comment)
+        elif "user_id" in args:
             user = User.objects.get(id=int(args["user_id"]))
             return CommentModel.objects.filter(user=user)
         elif "post_id" in args:
@@ -773,9 +1007,17 @@ class Query(object):
             except:
                 return graphene.List(Comment, resolver=lambda x,y: [])
         else:
-            return CommentModel.objects.all().order_by('-posted_at')
+            return wl_comments.list_view("allRecentComments", limit=args.get("limit"),
+                                         offset=args.get("offset"))
 
             
+    def resolve_comments_branch(self, info, cursor=None, max_depth=None,
+                                max_children=None):
+        comments, more, more_cursor = wl_comments.branch(cursor or "", max_depth,
+                                                         max_children)
+        return CommentBranch(comments=comments, more_replies=more,
+                             more_replies_cursor=more_cursor)
+
     def resolve_vote(self, info, **kwargs):
         id = kwargs.get('id')
 
@@ -798,6 +1040,21 @@ class Query(object):
             else:
                 return Notification.objects.filter(user=user)
 
+    def resolve_unread_notifications_count(self, info, **kwargs):
+        current = get_user_context(info.context)
+        if not current.is_authenticated:
+            return 0
+        # Read fresh, the cached profile misses notifications fanned out since
+        return Profile.objects.filter(user_id=current.id).values_list(
+            "unread_notifications", flat=True).first() or 0
+
+    def resolve_conversations_list(self, info, **kwargs):
+        current = get_user_context(info.context)
+        current.require_login("You need to be logged in to read private messages")
+        terms = kwargs.get("terms") or {}
+        return wl_conversations.inbox(current.id, limit=terms.get("limit"),
+                                      offset=terms.get("offset"))
+
     def resolve_conversations_single(self, info, **kwargs):
         document_id = kwargs["document_id"]
         if document_id:
@@ -811,12 +1068,17 @@ class Query(object):
     def resolve_messages_list(self, info, **kwargs):
         #if not info.context.user.is_authenticated:
         #    raise ValueError("Need to be logged in to read private messages!")
-        convo_id = kwargs["terms"].conversation_id
-        return Conversation.objects.get(id=int(convo_id)).messages.all()
+        terms = kwargs["terms"]
+        convo_id = Conversation.objects.values_list("id", flat=True).get(
+            id=int(terms.conversation_id))
+        return wl_conversations.message_page(convo_id, limit=terms.limit,
+                                             before=terms.before, after=terms.after)
     
 
 class Mutations(object):
     users_edit = UsersEdit.Field(name="usersEdit")
+    mark_notifications_read = MarkNotificationsRead.Field(name="markNotificationsRead")
+    mark_conversation_read = MarkConversationRead.Field(name="markConversationRead")
     login = Login.Field(name="Login")
     vote = NewVote.Field(name="vote")
     posts_new = PostsNew.Field(name="PostsNew")
@@ -1,6 +1,18 @@
 import json
 import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+from dateutil import parser as date_parser
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.db.models import Q 
+from django.utils import timezone
+from django.utils.html import escape
+from lw2 import fulltext
+from lw2.analysis import get_synonym_table, stem
+from lw2.models import Post, Tag
+from lw2.tags import normalize_tag_key
 
 """Search Syntax Quick Guide
 
@@ -11,71 +23,466 @@ OPERATORS.
   may not be enclosed by quotation marks. 
 
 - An expression enclosed in DOUBLE QUOTES is searched for exactly, otherwise 
-  it's searched for as a substring and may have enhancement features such as 
-  synonym matching applied.
+  it's searched for as a word, matching other forms of the word (apple finds
+  apples) and its synonyms from settings.SEARCH_SYNONYMS (ai finds artificial
+  intelligence). Quoted expressions may contain spaces.
 
 - There are three operators: AND, OR, and NOT
 
 - The AND operator is applied by separating two or more expressions with SPACES.
 
 - The OR operator is applied by typing capital OR surrounded by whitespace 
-  between two or more expressions.
+  between two or more expressions. OR binds tighter than AND, so 
+  'cat dog OR wolf' finds cat together with either dog or wolf.
 
 - The NOT operator is applied by putting a dash (-) in front of an expression,
-  this will cause the search backend to use an exclude() instead of a filter()
-  for that exrpression.
+  this will cause the search backend to exclude documents matching that 
+  expression.
+
+- Expressions can be grouped with PARENTHESES, e.g '(cat OR dog) -(wolf fox)'.
+  Unbalanced parentheses are closed or dropped rather than rejected.
 
 The syntax also supports PARAMETERS, which are special search string keywords
 that can be passed to specify certain behavior such as date restrictions. These
 are structured as keyword:argument pairs that may appear as expressions in a
-search string. All parameters are currently undefined, but in a later edition
-will provide extended search functionality."""
+search string, the argument may be quoted. Parameters always apply to the 
+whole search, wherever they appear. Anything else shaped like a parameter,
+such as a URL, is searched for like any other expression. The defined
+parameters are:
+
+- author:USERNAME   Only documents written by USERNAME.
+- after:DATE        Only documents posted on or after DATE.
+- before:DATE       Only documents posted before DATE.
+- tag:TAG           Only posts tagged TAG, or comments on those posts.
+- minscore:N        Only documents with a score of at least N.
+- post:ID           Only the post ID, or comments on it.
+
+  DATE is either a calendar date such as 2019-02-16, or an age such as 30d,
+  meaning 30 days ago. Ages are given in days (d), weeks (w), months (m) or
+  years (y).
+
+Search strings are parsed into a tree of Term, And, Or and Not nodes, which is
+expanded with synonyms, normalized and turned into a SearchPlan. Plans are
+cached by search string and synonym table, so a repeated search skips
+parsing and compiling.
+Searches run against the full text index in fulltext.py, which ranks results
+by relevance. The filter built by mk_text_filter is used when there's no index
+to search, see fulltext.ScanBackend, and for searches that parameters narrow
+down to a few documents. It matches titles and bodies the same way, but can
+only approximate the index's stemming and sorts newest first instead of by
+relevance."""
+
+AGE_UNITS = {"d":1, "w":7, "m":30, "y":365}
+
+def parse_date(value):
+    """Parse the DATE argument of a date parameter into an aware datetime."""
+    age = re.fullmatch("(\d+)([dwmy])", value)
+    if age:
+        try:
+            return timezone.now() - timedelta(
+                days=int(age.group(1)) * AGE_UNITS[age.group(2)])
+        except OverflowError:
+            raise ValueError("The age '{}' is out of range".format(value))
+    try:
+        date = date_parser.parse(value, default=datetime(2000, 1, 1))
+    except (ValueError, OverflowError):
+        raise ValueError("Couldn't understand the date '{}'".format(value))
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Expected a whole number, got '{}'".format(value))
+
+def mk_author_filter(value, model):
+    user_ids = list(User.objects.filter(username=value).values_list("id", flat=True))
+    return Q(user_id__in=user_ids)
+
+def mk_tag_filter(value, model):
+    tagged = Tag.objects.filter(tag_name__key=normalize_tag_key(value),
+                                type="post").values("document_id")
+    if model is Post:
+        return Q(id__in=tagged)
+    return Q(post_id__in=tagged)
+
+def mk_post_filter(value, model):
+    if model is Post:
+        return Q(id=value)
+    return Q(post_id=value)
+
+# Parameter keyword: function building its filter. Listed from the usually most
+# selective to the least, which decides the order when estimates tie.
+PARAMETERS = (
+    ("post", mk_post_filter),
+    ("author", mk_author_filter),
+    ("tag", mk_tag_filter),
+    ("after", lambda value, model: Q(posted_at__gte=parse_date(value))),
+    ("before", lambda value, model: Q(posted_at__lt=parse_date(value))),
+    ("minscore", lambda value, model: Q(base_score__gte=parse_int(value))),
+)
+
+def mk_parameter_filters(parameters, model):
+    """Create the filters for the known parameters in a parsed query string, in
+    order of how selective they usually are."""
+    return [mk_filter(parameters[keyword], model)
+            for keyword, mk_filter in PARAMETERS if keyword in parameters]
+
+class Term(namedtuple("Term", "text exact")):
+    """A word or, if exact, a quoted phrase to match."""
+    op = "term"
+
+class And(namedtuple("And", "children")):
+    op = "and"
+
+class Or(namedtuple("Or", "children")):
+    op = "or"
+
+class Not(namedtuple("Not", "child")):
+    op = "not"
+
+# Only known keywords make parameters, anything else before a colon, like the
+# scheme of a URL, is part of a word
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<param>(?P<keyword>(?i:%s)):(?P<argument>"[^"]*"?|[^\s()"]+))
+  | (?P<phrase>"[^"]*"?)
+  | (?P<dash>-(?=\S))
+  | (?P<word>[^\s()"]+)
+""" % "|".join(keyword for keyword, mk_filter in PARAMETERS), re.VERBOSE)
+
+def tokenize(search_s):
+    """Split a search string into (kind, value) tokens."""
+    tokens = []
+    for match in TOKEN_RE.finditer(search_s):
+        kind = match.lastgroup
+        if kind == "space":
+            continue
+        if kind == "param":
+            tokens.append(("param", (match.group("keyword").lower(),
+                                     match.group("argument").strip("\""))))
+        elif kind == "phrase":
+            tokens.append(("phrase", match.group().strip("\"")))
+        elif kind == "word" and match.group() in ("OR", "AND"):
+            tokens.append((match.group(), None))
+        else:
+            tokens.append((kind, match.group()))
+    return tokens
+
+class Parser(object):
+    """Recursive descent parser for search strings:
+
+    query   := (or | "AND" | "OR" | param)*
+    or      := unary ("OR" unary?)*
+    unary   := "-" unary? | "(" query ")"? | phrase | word
+
+    The items of a query are ANDed together. Operators with nothing to join
+    are skipped, as are unbalanced parentheses, and a dash with nothing
+    after it. Parameters are collected on the side rather than put in the
+    tree."""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.parameters = {}
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        tree = self.parse_query(top=True)
+        return tree, self.parameters
+
+    def parse_query(self, top=False):
+        children = []
+        while True:
+            kind = self.peek()
+            if kind is None:
+                break
+            if kind == "close":
+                if top:
+                    # Unbalanced, drop it
+                    self.take()
+                    continue
+                break
+            if kind in ("AND", "OR"):
+                # Nothing to join on this side, skip the operator
+                self.take()
+                continue
+            if kind == "param":
+                keyword, argument = self.take()[1]
+                self.parameters[keyword] = argument
+                continue
+            children.append(self.parse_or())
+        return And(tuple(children))
+
+    def parse_or(self):
+        children = [self.parse_unary()]
+        while self.peek() == "OR":
+            self.take()
+            if self.peek() in ("dash", "open", "phrase", "word"):
+                children.append(self.parse_unary())
+        return Or(tuple(children))
+
+    def parse_unary(self):
+        kind, value = self.take()
+        if kind == "dash":
+            if self.peek() in ("dash", "open", "phrase", "word"):
+                return Not(self.parse_unary())
+            return And(())
+        if kind == "open":
+            tree = self.parse_query()
+            if self.peek() == "close":
+                self.take()
+            return tree
+        return Term(value, kind == "phrase")
+
+# Length in characters of the snippets made by mk_snippet, and how much of a
+# document it looks through for matches
+SNIPPET_LENGTH = 200
+SNIPPET_SCAN_LIMIT = 65536
+
+def has_words(text):
+    return any(character.isalnum() for character in text)
+
+def expand_synonyms(tree, table):
+    """Replace each unquoted term that has synonyms with an Or of the term
+    and its synonyms."""
+    if tree.op == "term":
+        synonyms = () if tree.exact else table.synonyms(tree.text)
+        if not synonyms:
+            return tree
+        return Or((tree,) + tuple(Term(synonym, False) for synonym in synonyms))
+    if tree.op == "not":
+        return Not(expand_synonyms(tree.child, table))
+    return type(tree)(tuple(expand_synonyms(child, table)
+                            for child in tree.children))
+
+def normalize(tree):
+    """Simplify a parsed tree: drop terms with nothing to search for and empty
+    groups, flatten nested groups of the same kind, remove duplicates, double
+    negatives and single child groups, and sort children into a canonical 
+    order. Returns None if nothing is left to search for."""
+    if tree.op == "term":
+        text = " ".join(tree.text.split())
+        if not has_words(text):
+            return None
+        return Term(text if tree.exact else text.lower(), tree.exact)
+    if tree.op == "not":
+        child = normalize(tree.child)
+        if child is None:
+            return None
+        if child.op == "not":
+            return child.child
+        return Not(child)
+    children = set()
+    for child in tree.children:
+        child = normalize(child)
+        if child is None:
+            continue
+        if child.op == tree.op:
+            children.update(child.children)
+        else:
+            children.add(child)
+    if not children:
+        return None
+    if len(children) == 1:
+        return children.pop()
+    return type(tree)(tuple(sorted(children, key=repr)))
+
+class SearchPlan(object):
+    """A parsed and normalized search string.
+
+    - tree: The normalized tree of search terms, or None if there are none.
+    - parameters: The parameters given, as a dict of keyword: argument.
+    - highlighter: A regex matching the terms to highlight in snippets.
+    - compiled: Cache of each search backend's compiled form of the tree."""
+    def __init__(self, tree, parameters):
+        self.tree = tree
+        self.parameters = parameters
+        self.highlighter = mk_highlighter(tree)
+        self.compiled = {}
+
+    def text_filter(self, fields):
+        """The Q object matching the tree against the given text fields."""
+        key = ("text_filter", fields)
+        if key not in self.compiled:
+            self.compiled[key] = mk_text_filter(self.tree, fields)
+        return self.compiled[key]
+
+    def __repr__(self):
+        return "SearchPlan({!r}, {!r})".format(self.tree, self.parameters)
+
+def regex_literal(text):
+    """Escape text for a regex, the same way for Python and the regex dialects
+    of the databases: a backslash before a character that isn't a letter or
+    digit makes it stand for itself in all of them."""
+    return "".join(char if char.isalnum() or char == " " else "\\" + char
+                   for char in text)
+
+def mk_text_filter(tree, fields):
+    """Create a single Q object that implements a search tree with substring
+    matching on the given text fields of a document, a term matching if any
+    of them has it."""
+    if tree.op == "term":
+        if tree.exact:
+            lookup, text = "contains", tree.text
+        else:
+            # Matching from the start of a word makes the stem match every
+            # form of the word, and only that word
+            text = tree.text if " " in tree.text else stem(tree.text)
+            lookup, text = "iregex", r"(^|\W)" + regex_literal(text)
+        combined = Q(**{"{}__{}".format(fields[0], lookup):text})
+        for field in fields[1:]:
+            combined |= Q(**{"{}__{}".format(field, lookup):text})
+        return combined
+    if tree.op == "not":
+        return ~mk_text_filter(tree.child, fields)
+    filters = [mk_text_filter(child, fields) for child in tree.children]
+    combined = filters[0]
+    for _filter in filters[1:]:
+        combined = (combined & _filter) if tree.op == "and" else (combined | _filter)
+    return combined
+
+def positive_terms(tree):
+    """The terms in a search tree that aren't excluded."""
+    if tree is None or tree.op == "not":
+        return []
+    if tree.op == "term":
+        return [tree]
+    return [term for child in tree.children for term in positive_terms(child)]
+
+def mk_highlighter(tree):
+    """Return a regex matching any term a document is searched for, or None
+    if there aren't any."""
+    patterns = []
+    for term in positive_terms(tree):
+        words = term.text.split()
+        pattern = r"\s+".join(re.escape(word) for word in words)
+        if term.exact:
+            patterns.append(pattern)
+        elif len(words) == 1:
+            patterns.append(r"(?i:\b{}\w*)".format(re.escape(stem(words[0]))))
+        else:
+            patterns.append(r"(?i:\b{})".format(pattern))
+    if not patterns:
+        return None
+    # Longest first, so a term that contains another wins where both match
+    patterns.sort(key=len, reverse=True)
+    return re.compile("|".join(patterns))
+
+def mk_snippet(plan, text, length=SNIPPET_LENGTH, scan_limit=SNIPPET_SCAN_LIMIT):
+    """Cut a snippet of about length characters out of text around the part
+    that matches the most distinct search terms, as HTML with the matches
+    wrapped in fulltext.HIGHLIGHT.
+
+    This is for results that didn't come through the index. It makes a single
+    pass over at most scan_limit characters of text, sliding a window over the
+    matches found to pick the best spot."""
+    text = text or ""
+    matches = []
+    if plan.highlighter is not None:
+        matches = list(plan.highlighter.finditer(text, 0, scan_limit))
+    best_start, best_score = 0, 0
+    distinct = {}
+    first = 0
+    for last, match in enumerate(matches):
+        word = match.group().lower()
+        distinct[word] = distinct.get(word, 0) + 1
+        # A match longer than the window is left alone in it
+        while first < last and match.end() - matches[first].start() > length:
+            dropped = matches[first].group().lower()
+            distinct[dropped] -= 1
+            if not distinct[dropped]:
+                del distinct[dropped]
+            first += 1
+        if len(distinct) > best_score:
+            best_start, best_score = matches[first].start(), len(distinct)
+    # Show some of what leads up to the match, starting on a word boundary
+    start = max(0, best_start - length // 4)
+    if start:
+        space = text.find(" ", start, best_start)
+        start = space + 1 if space != -1 else best_start
+    end = min(len(text), start + length)
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        if space > start:
+            end = space
+    pieces = [fulltext.ELLIPSIS] if start else []
+    position = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        pieces.extend([escape(text[position:match.start()]), fulltext.HIGHLIGHT[0],
+                       escape(match.group()), fulltext.HIGHLIGHT[1]])
+        position = match.end()
+    pieces.append(escape(text[position:end]))
+    if end < len(text):
+        pieces.append(fulltext.ELLIPSIS)
+    return "".join(pieces)
+
+@lru_cache(maxsize=getattr(settings, "SEARCH_PLAN_CACHE_SIZE", 1024))
+def compile_search(search_s, synonym_table):
+    tree, parameters = Parser(tokenize(search_s)).parse()
+    tree = expand_synonyms(tree, synonym_table)
+    return SearchPlan(normalize(tree), parameters)
 
 def parse_search_string(search_s):
-    # Extract parameters
-    parameters = {}
-    param_re = re.compile("(\S+):(\S+)")
-    parameters_raw = param_re.findall(search_s)
-    for parameter in parameters_raw:
-        parameters[parameter[0]] = parameter[1]
-    search_s = param_re.sub('', search_s)
-    # Extract OR operations
-    or_op_re = re.compile("(\S+) OR (\S+)")
-    or_ops = or_op_re.findall(search_s)
-    search_s = or_op_re.sub('', search_s)
-    # Extract rest
-    and_ops = search_s.split()
-    return {"parameters":parameters,
-            "or_ops":or_ops,
-            "and_ops":and_ops}
-
-def mk_search_filters(parsed_operations):
-    """Create the search filters that implement the operations from the parsed
-    query string."""
-    filters = []
-    for and_op in parsed_operations["and_ops"]:
-        operation = mk_operation(and_op)
-        operation["type"] = "and"
-        filters.append(operation)
-    for or_op in parsed_operations["or_ops"]:
-        operation = {"type":"or",
-                     "exclude":None,
-                     "Q":None}
-        left_or = mk_operation(or_op[0])
-        right_or = mk_operation(or_op[1])
-        operation["Q"] = (left_or["Q"] | right_or["Q"])
-        filters.append(operation)
-    return filters
-
-def mk_operation(op):
-    operation = {"exclude":False,
-                     "Q":None}
-    if op[0] == "-":
-        operation["exclude"] = True
-        op = op[1:]
-        
-    if op[0] == op[-1] == "\"":
-        operation["Q"] = Q(body__contains=op)
-    else:
-        operation["Q"] = Q(body__icontains=op)
-    return operation
+    """Return the SearchPlan for a search string, from the plan cache if the 
+    same search (up to whitespace) was seen recently with the same synonyms."""
+    return compile_search(" ".join(search_s.split()), get_synonym_table())
+
+def has_search_terms(plan):
+    return plan.tree is not None
+
+def search(queryset, search_s, snippets=False):
+    """Filter a queryset of posts or comments by a search string.
+
+    Parameters are applied before any body matching. Each parameter's filter
+    is tried against its index with a read capped at SEARCH_SCOPE_THRESHOLD
+    rows, and the most selective one drives the query. If it narrows the
+    search to at most that many documents, their ids are fixed up front and
+    the titles and bodies of just those documents are matched directly with
+    fulltext.ScanBackend, newest first. Otherwise the parameters become plain
+    filters on a ranked full text index search.
+
+    If snippets is true, results found through the index carry a highlighted
+    search_snippet of their body. The others need one cut with mk_snippet."""
+    plan = parse_search_string(search_s)
+    predicates = mk_parameter_filters(plan.parameters, queryset.model)
+    if not predicates:
+        if not has_search_terms(plan):
+            return queryset.order_by("-posted_at")
+        return fulltext.search(queryset, plan, snippets)
+    threshold = getattr(settings, "SEARCH_SCOPE_THRESHOLD", 1000)
+    scoped_ids = None
+    estimates = []
+    for position, predicate in enumerate(predicates):
+        ids = list(queryset.filter(predicate).values_list("pk", flat=True)
+                   [:threshold + 1])
+        if len(ids) <= threshold and (scoped_ids is None or len(ids) < len(scoped_ids)):
+            scoped_ids = ids
+        estimates.append((len(ids), position, predicate))
+    estimates.sort(key=lambda estimate: estimate[:2])
+    if scoped_ids is not None:
+        queryset = queryset.filter(pk__in=scoped_ids)
+        for count, position, predicate in estimates[1:]:
+            queryset = queryset.filter(predicate)
+        if has_search_terms(plan):
+            queryset = fulltext.ScanBackend().search(queryset, None, plan)
+        return queryset.order_by("-posted_at")
+    for count, position, predicate in estimates:
+        queryset = queryset.filter(predicate)
+    if not has_search_terms(plan):
+        return queryset.order_by("-posted_at")
+    return fulltext.search(queryset, plan, snippets)
@@ -1,5 +1,8 @@
 from django.contrib.auth.models import User
+from django.db import transaction
 from lw2.models import *
+from lw2.tags import normalize_tag_key, resolve_tag_names, adjust_tag_counts
+from lw2.user_context import get_user_context
 from rest_framework import serializers
 import datetime
 import hashlib
@@ -133,14 +136,16 @@ class TagSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ('id', 'user', 'created_at', 'type')
 
     def create(self, validated_data):
-        user = self.context["request"].user
+        current = get_user_context(self.context["request"])
+        user = current.user
         document_id = validated_data.pop('document_id')
         try:
             post = Post.objects.filter(id=document_id)[0]
         except IndexError:
             raise ValueError("No post with ID {}".format(document_id))
         #TODO: Use more flexible way of determining this permission
-        if (user != post.user) and not user.profile.moderator:
+        current.require_write()
+        if not (current.is_user(post.user_id) or current.is_moderator):
             raise ValueError(
                 "User '{}' is not authorized to add a tag to this document.".format(
                     user.username
@@ -154,10 +159,35 @@ class TagSerializer(serializers.HyperlinkedModelSerializer):
         #TODO: Add ability to tag more than just posts, perhaps comments?
         new_tag.type = "post"
         new_tag.document_id = document_id
-        new_tag.full_clean()
-        new_tag.save()
+        new_tag.full_clean(exclude=['tag_name'])
+        with transaction.atomic():
+            key = normalize_tag_key(new_tag.text)
+            new_tag.tag_name = resolve_tag_names([new_tag.text])[key]
+            new_tag.save()
+            adjust_tag_counts({new_tag.tag_name.id:1})
         return new_tag
 
+    def update(self, instance, validated_data):
+        instance.text = validated_data.get('text', instance.text)
+        instance.document_id = validated_data.get('document_id',
+                                                  instance.document_id)
+        instance.full_clean(exclude=['tag_name'])
+        with transaction.atomic():
+            old_tag_name_id = instance.tag_name_id
+            key = normalize_tag_key(instance.text)
+            instance.tag_name = resolve_tag_names([instance.text])[key]
+            instance.save()
+            if instance.tag_name_id != old_tag_name_id:
+                adjust_tag_counts({old_tag_name_id:-1,
+                                   instance.tag_name_id:1})
+        return instance
+
+class TagNameSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TagName
+        fields = ('key', 'text', 'count')
+        read_only_fields = ('key', 'text', 'count')
+
 class VoteSerializer(serializers.HyperlinkedModelSerializer):
     collection_name = serializers.CharField(
         write_only=True,
@@ -244,19 +274,19 @@ class InviteSerializer(serializers.HyperlinkedModelSerializer):
         
     def create(self, validated_data):
         #TODO: Limit how many invites a user can make based on a configuration option
-        user = self.context["request"].user
+        current = get_user_context(self.context["request"])
+        user = current.user
         try:
             expires = validated_data.pop('expires')
         except KeyError:
             expires = None
         invite = Invite()
-        if not user.is_authenticated:
-            raise ValueError("This user is not authenticated with services.")
+        current.require_write("This user is not authenticated with services.")
         invite.creator = user
         rng = random.SystemRandom()
         invite.code = str(rng.getrandbits(64))
         invite.date_created = datetime.datetime.now()
-        if user.profile.moderator and expires:
+        if current.is_moderator and expires:
             invite.expires = expires
         else:
             invite.expires = datetime.datetime.now() + datetime.timedelta(weeks=+9)
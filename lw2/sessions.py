@@ -0,0 +1,36 @@
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+import time
+
+"""Session housekeeping.
+
+settings.SESSION_STORE picks where sessions live:
+
+- db: Rows in the database, read on every request. The default.
+- cached_db: Rows in the database, read through the cache and written to both.
+  Only safe with a cache every server process shares, like memcached. With
+  the default per process cache, a session logged out or swept in one
+  process carries on working in the others until their copy expires.
+- signed: No storage at all, the session key is the signed session data. These
+  sessions can't be revoked before they expire, except by changing the 
+  password.
+
+The database backed stores leave a row behind for every session that expires
+without logging out, which sweep_expired_sessions() clears out."""
+
+def sweep_expired_sessions(batch_size=1000, pause=0.1, now=None):
+    """Delete expired sessions batch_size at a time, sleeping pause seconds
+    between batches so other writers to the table aren't held up for long.
+    Returns how many sessions were deleted."""
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        keys = list(Session.objects.filter(expire_date__lt=now).values_list(
+            "session_key", flat=True)[:batch_size])
+        if not keys:
+            return deleted
+        deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+        if len(keys) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,184 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from lw2.models import Post, Tag, TagName
+import bisect
+import heapq
+import re
+import threading
+import time
+
+"""Tag vocabulary maintenance and the queries it backs.
+
+Every Tag points at a TagName, a single row per case-folded tag text which
+keeps a running count of how many tags use it. Code that creates or deletes
+tags should go through resolve_tag_names() and adjust_tag_counts() so the
+counts stay correct; bulk_create and queryset deletes don't fire any hooks."""
+
+POST_ORDERINGS = {"recent":("-posted_at", "id"),
+                  "score":("-base_score", "-posted_at", "id")}
+
+def normalize_tag_key(text):
+    """Return the vocabulary key for a piece of tag text."""
+    return re.sub("\s+", " ", text).strip().casefold()
+
+def resolve_tag_names(texts):
+    """Return a dict mapping the key of each text in texts to its TagName,
+    creating any missing vocabulary entries with one bulk insert."""
+    wanted = {}
+    for text in texts:
+        wanted.setdefault(normalize_tag_key(text), text)
+    found = {tag_name.key:tag_name
+             for tag_name in TagName.objects.filter(key__in=wanted.keys())}
+    missing = [TagName(key=key, text=text)
+               for key, text in wanted.items() if key not in found]
+    if missing:
+        try:
+            with transaction.atomic():
+                TagName.objects.bulk_create(missing)
+        except IntegrityError:
+            # Somebody else created one of these names first, fall back to
+            # creating them one at a time
+            for tag_name in missing:
+                TagName.objects.get_or_create(key=tag_name.key,
+                                              defaults={"text":tag_name.text})
+        # bulk_create doesn't set primary keys on every backend, so reload
+        created = TagName.objects.filter(key__in=[m.key for m in missing])
+        for tag_name in created:
+            found[tag_name.key] = tag_name
+            tag_prefix_index.add(tag_name.id, tag_name.key,
+                                 tag_name.text, tag_name.count)
+    return found
+
+def adjust_tag_counts(deltas):
+    """Apply a dict of {tag_name_id: change in uses} to the vocabulary counts,
+    with one UPDATE per distinct change amount."""
+    by_delta = {}
+    for tag_name_id, delta in deltas.items():
+        if delta and tag_name_id is not None:
+            by_delta.setdefault(delta, []).append(tag_name_id)
+    for delta, tag_name_ids in by_delta.items():
+        TagName.objects.filter(id__in=tag_name_ids).update(count=F("count") + delta)
+    tag_prefix_index.apply_deltas(deltas)
+
+def top_tags(limit=20):
+    """The most used tags in the vocabulary."""
+    return TagName.objects.filter(count__gt=0).order_by("-count", "key")[:limit]
+
+def posts_with_tag(text, order="recent"):
+    """Return a queryset of the posts tagged with text, matched case
+    insensitively through the vocabulary, in the given order ('recent' or
+    'score'). Slice the result to paginate it."""
+    try:
+        ordering = POST_ORDERINGS[order]
+    except KeyError:
+        raise ValueError("Unknown order '{}', expected one of {}".format(
+            order, ", ".join(sorted(POST_ORDERINGS))))
+    document_ids = Tag.objects.filter(tag_name__key=normalize_tag_key(text),
+                                      type="post").values("document_id")
+    return Post.objects.filter(id__in=document_ids).order_by(*ordering)
+
+class TagPrefixIndex(object):
+    """An in-process index of the tag vocabulary for prefix lookups.
+
+    Keys are kept in a sorted list so the keys starting with a prefix are one
+    contiguous run found with bisect, which is then ranked by usage count.
+    The index is loaded from the database on first use and updated in place
+    as tags are created or deleted in this process. Changes made by other
+    processes, or rolled back after being applied here, are picked up by a
+    full reload once the index is older than settings.TAG_INDEX_MAX_AGE
+    seconds."""
+    # Results for prefixes this short cover a lot of keys, so memoize them
+    MEMO_PREFIX_LENGTH = 2
+    MAX_SUGGESTIONS = 50
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.loaded_at = None
+        self.keys = []
+        self.entries = {}
+        self.ids = {}
+        self.memo = {}
+
+    def get_max_age(self):
+        if self.max_age is not None:
+            return self.max_age
+        return getattr(settings, "TAG_INDEX_MAX_AGE", 300)
+
+    def load(self):
+        """Rebuild the index from the vocabulary table."""
+        entries = {}
+        ids = {}
+        for tag_name_id, key, text, count in TagName.objects.values_list(
+                "id", "key", "text", "count"):
+            entries[key] = [text, count]
+            ids[tag_name_id] = key
+        with self.lock:
+            self.entries = entries
+            self.ids = ids
+            self.keys = sorted(entries)
+            self.memo = {}
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Drop the index so it's reloaded on next use."""
+        with self.lock:
+            self.loaded_at = None
+
+    def ensure_loaded(self):
+        loaded_at = self.loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.get_max_age():
+            self.load()
+
+    def forget_memo(self, key):
+        for length in range(self.MEMO_PREFIX_LENGTH + 1):
+            self.memo.pop(key[:length], None)
+
+    def add(self, tag_name_id, key, text, count=0):
+        """Add a new vocabulary entry to the index, if it's loaded."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            if key not in self.entries:
+                bisect.insort(self.keys, key)
+            self.entries[key] = [text, count]
+            self.ids[tag_name_id] = key
+            self.forget_memo(key)
+
+    def apply_deltas(self, deltas):
+        """Apply the same {tag_name_id: change in uses} given to
+        adjust_tag_counts() to the indexed counts."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for tag_name_id, delta in deltas.items():
+                key = self.ids.get(tag_name_id)
+                if key is None:
+                    # Created by another process, wait for the next reload
+                    continue
+                self.entries[key][1] += delta
+                self.forget_memo(key)
+
+    def suggest(self, prefix, limit=10):
+        """Return up to limit (key, text, count) tuples for the tags in use
+        whose key starts with prefix, most used first."""
+        self.ensure_loaded()
+        prefix = normalize_tag_key(prefix)
+        limit = min(limit, self.MAX_SUGGESTIONS)
+        with self.lock:
+            if prefix in self.memo:
+                return self.memo[prefix][:limit]
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)
+            candidates = ((key,) + tuple(self.entries[key])
+                          for key in self.keys[start:end])
+            suggestions = heapq.nlargest(
+                self.MAX_SUGGESTIONS,
+                (candidate for candidate in candidates if candidate[2] > 0),
+                key=lambda candidate: candidate[2])
+            if len(prefix) <= self.MEMO_PREFIX_LENGTH:
+                self.memo[prefix] = suggestions
+            return suggestions[:limit]
+
+tag_prefix_index = TagPrefixIndex()
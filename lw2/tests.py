@@ -1,9 +1,25 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test import Client
-from django.contrib.auth.models import User
+from django.test import override_settings
+from django.test import RequestFactory
+from django.contrib.auth.models import User, AnonymousUser
 from lw2.models import *
+from lw2.tags import tag_prefix_index
+from lw2.auth_header import AuthHeaderMiddleware, session_users, users
+from lw2.sessions import sweep_expired_sessions
+from lw2.user_context import get_user_context
+from lw2.bans import active_bans
+from lw2.notifications import (FanoutQueue, fanout_queue, reconcile_unread_counts,
+                               prune_notifications)
+from lw2.events import event_hub
+from django.contrib.sessions.models import Session
+from django.utils.timezone import utc
+from lw2.fuzzy import post_title_index, user_name_index
+from lw2.related import compute_related_posts, sparse
 from datetime import datetime, timedelta
 import json
+import threading
+import time
 import pdb
 
 # Create your tests here.
@@ -98,6 +114,39 @@ class PostTestCase(TestCase):
         self.assertEquals(len(tags), 3)
         self.assertEquals(set(["my","tag","set"]), set([tag["text"] for tag in tags]))
 
+    def test_tagset_update_diff(self):
+        """Test that a tagset update only touches the tags which changed."""
+        self.login()
+        response0= c.post("/api/posts/",
+                          {"title":"My Fruit Post",
+                           "body":"My Apple Orange Mango"})
+        post = json.loads(response0.content.decode("UTF-8"))
+        c.post("/api/posts/" + post["_id"] + "/update_tagset/",
+               {"tags":"my,tag,set"})
+        kept_ids = set(Tag.objects.filter(document_id=post["_id"],
+                                          text__in=["my","tag"]).values_list("id", flat=True))
+        response1 = c.post("/api/posts/" + post["_id"] + "/update_tagset/",
+                           {"tags":"my,tag,new,new"})
+        self.assertEqual(response1.status_code, 200)
+        tags = Tag.objects.filter(document_id=post["_id"])
+        self.assertEqual(set(["my","tag","new"]), set([tag.text for tag in tags]))
+        self.assertTrue(kept_ids <= set([tag.id for tag in tags]))
+
+    def test_tagset_update_invalid_is_atomic(self):
+        """Test that a rejected tagset update leaves the existing tags alone."""
+        self.login()
+        response0= c.post("/api/posts/",
+                          {"title":"My Fruit Post",
+                           "body":"My Apple Orange Mango"})
+        post = json.loads(response0.content.decode("UTF-8"))
+        c.post("/api/posts/" + post["_id"] + "/update_tagset/",
+               {"tags":"my,tag,set"})
+        response1 = c.post("/api/posts/" + post["_id"] + "/update_tagset/",
+                           {"tags":"my, \t ,set"})
+        self.assertEqual(response1.status_code, 400)
+        tags = Tag.objects.filter(document_id=post["_id"])
+        self.assertEqual(set(["my","tag","set"]), set([tag.text for tag in tags]))
+
 class CommentTestCase(TestCase):
     def setUp(self):
         pass
@@ -129,6 +178,146 @@ class CommentTestCase(TestCase):
         TODO: Write this test and make it pass."""
         pass
         
+class CommentThreadTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.post = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                        title='Threads', slug="threads", body="Talk")
+        self.comments = {}
+        # name: parent, minutes after the first comment
+        for name, parent, minutes in (("a", None, 0), ("b", None, 1), ("a1", "a", 2),
+                                      ("a2", "a", 3), ("a1x", "a1", 4), ("b1", "b", 5)):
+            self.comments[name] = Comment.objects.create(
+                id=name.ljust(17, "_"), user=self.user, post=self.post, body=name,
+                parent_comment=self.comments.get(parent),
+                posted_at=datetime(2019, 1, 1, tzinfo=utc) + timedelta(minutes=minutes))
+
+    def comments_list(self, **terms):
+        terms = ", ".join('{}: {}'.format(key, json.dumps(value))
+                          for key, value in terms.items())
+        response = Client().post("/graphql/", {"query":"{ CommentsList(terms: {%s}) { body depth } }" % terms})
+        return [(comment["body"], comment["depth"]) for comment in
+                json.loads(response.content.decode("UTF-8"))["data"]["CommentsList"]]
+
+    def test_thread_order(self):
+        self.assertEqual(self.comments_list(view="postCommentsThreaded", postId=self.post.id),
+                         [("a", 0), ("a1", 1), ("a1x", 2), ("a2", 1), ("b", 0), ("b1", 1)])
+        self.assertEqual(self.comments_list(view="commentReplies",
+                                            commentId=self.comments["a1"].id),
+                         [("a1", 1), ("a1x", 2)])
+        self.assertEqual(self.comments_list(view="commentAncestors",
+                                            commentId=self.comments["a1x"].id),
+                         [("a", 0), ("a1", 1)])
+
+    def test_moving_comment_moves_replies(self):
+        comment = self.comments["a1"]
+        comment.parent_comment = self.comments["b"]
+        comment.save()
+        self.assertEqual(self.comments_list(view="postCommentsThreaded", postId=self.post.id),
+                         [("a", 0), ("a2", 1), ("b", 0), ("a1", 1), ("a1x", 2), ("b1", 1)])
+        # Saves that leave the comment where it is don't look at the parent
+        comment = Comment.objects.get(id=self.comments["a1x"].id)
+        path = comment.path
+        comment.base_score += 1
+        with self.assertNumQueries(1):
+            comment.save()
+        self.assertEqual(Comment.objects.get(id=comment.id).path, path)
+
+    def test_truncated_tree(self):
+        """Test that trees are cut down to the budget with stubs counting
+        what was left out, and that the stubs' cursors fetch the rest."""
+        def query(q):
+            response = Client().post("/graphql/", {"query":q})
+            return json.loads(response.content.decode("UTF-8"))["data"]
+        tree = query("""{ CommentsList(terms: {view: "postCommentsThreaded",
+                           postId: "%s", maxDepth: 1, maxChildren: 1}) {
+                           body moreReplies moreRepliesCursor } }""" % self.post.id)
+        tree = tree["CommentsList"]
+        self.assertEqual([(comment["body"], comment["moreReplies"]) for comment in tree],
+                         [("a", 1), ("a1", 1), ("b", 0), ("b1", 0)])
+        branch = query("""{ CommentsBranch(cursor: "%s", maxChildren: 1) {
+                             comments { body } moreReplies } }""" % tree[0]["moreRepliesCursor"])
+        self.assertEqual(branch["CommentsBranch"], {"comments":[{"body":"a2"}],
+                                                    "moreReplies":0})
+        branch = query("""{ CommentsBranch(cursor: "%s") { comments { body } } }"""
+                       % tree[1]["moreRepliesCursor"])
+        self.assertEqual(branch["CommentsBranch"]["comments"], [{"body":"a1x"}])
+        self.assertEqual(self.comments_list(view="postCommentsThreaded", postId=self.post.id,
+                                            maxDepth=0, limit=1, offset=1), [("b", 0)])
+
+    @override_settings(COMMENTS_PAGE_SIZE=1)
+    def test_tree_budget(self):
+        """Test that cutting a tree down reads a bounded number of replies,
+        and that top level comments are paged by default."""
+        from lw2.comments import load_tree, thread_roots
+        for minutes in range(9):
+            Comment.objects.create(
+                id="b1{}".format(minutes).ljust(17, "_"), user=self.user, post=self.post,
+                body="b", parent_comment=self.comments["b"],
+                posted_at=datetime(2019, 1, 2, tzinfo=utc) + timedelta(minutes=minutes))
+        self.assertEqual(thread_roots(self.post.id), [self.comments["a"].id])
+        # The first replies, counting the rest, counting the next level
+        # down and loading the comments shown
+        with self.assertNumQueries(4):
+            tree = load_tree([self.comments["b"].id], max_depth=1, max_children=2)
+        self.assertEqual([(comment.body, comment.more_replies) for comment in tree],
+                         [("b", 8), ("b1", 0), ("b", 0)])
+
+    def test_tree_reads_levels_at_once(self):
+        """Test that each level is read with one query, except when a
+        comment with many replies crowds out the others, and that trees stop
+        at COMMENT_TREE_MAX_NODES comments."""
+        from lw2.comments import load_tree
+        for minutes in range(9):
+            Comment.objects.create(
+                id="a3{}".format(minutes).ljust(17, "_"), user=self.user, post=self.post,
+                body="a3", parent_comment=self.comments["a"],
+                posted_at=datetime(2019, 1, 2, tzinfo=utc) + timedelta(minutes=minutes))
+        roots = [self.comments["a"].id, self.comments["b"].id]
+        # Two reads of the level, counting what was cut, counting the next
+        # level down and loading the comments shown
+        with self.assertNumQueries(5):
+            tree = load_tree(roots, max_depth=1, max_children=2)
+        self.assertEqual([(comment.body, comment.more_replies) for comment in tree],
+                         [("a", 9), ("a1", 1), ("a2", 0), ("b", 0), ("b1", 0)])
+        with self.settings(COMMENT_TREE_MAX_NODES=4):
+            tree = load_tree(roots, max_children=2)
+        self.assertEqual([(comment.body, comment.more_replies) for comment in tree],
+                         [("a", 9), ("a1", 1), ("a2", 0), ("b", 1)])
+        self.assertIsNotNone(tree[-1].more_replies_cursor)
+
+    @override_settings(COMMENTS_PAGE_SIZE_MAX=3)
+    def test_comment_views(self):
+        """Test that the list views leave out deleted comments, sort their
+        own way and stick to the page size."""
+        Comment.objects.filter(id=self.comments["a2"].id).update(is_deleted=True)
+        Comment.objects.filter(id=self.comments["b"].id).update(base_score=5)
+        Comment.objects.filter(id=self.comments["a1"].id).update(base_score=0)
+        def bodies(**terms):
+            return [body for body, depth in self.comments_list(**terms)]
+        self.assertEqual(bodies(view="allRecentComments"), ["b1", "a1x", "a1"])
+        self.assertEqual(bodies(view="recentComments", limit=10), ["b1", "a1x", "b"])
+        self.assertEqual(bodies(view="postCommentsTop", postId=self.post.id, offset=1),
+                         ["b1", "a1x", "a"])
+        self.assertEqual(bodies(view="postCommentsNew", postId=self.post.id, limit=2),
+                         ["b1", "a1x"])
+        self.assertEqual(bodies(view="userComments", userId=str(self.user.id), offset=3),
+                         ["b", "a"])
+
+    def test_comment_views_use_their_indexes(self):
+        from django.db import connection
+        from lw2.comments import list_view
+        if connection.vendor != "sqlite":
+            self.skipTest("Checks SQLite's query plans")
+        for view, index in (("allRecentComments", "lw2_comment_recent"),
+                            ("postCommentsTop", "lw2_comment_post_top"),
+                            ("userComments", "lw2_comment_user_new")):
+            sql, params = list_view(view, post_id=self.post.id,
+                                    user_id=self.user.id).query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                self.assertIn(index, str(cursor.fetchall()), view)
+
 class SearchTestCase(TestCase):
     def setUp(self):
         user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
@@ -170,6 +359,311 @@ class SearchTestCase(TestCase):
         self.assertEquals(len(search_data), 1)
         self.assertEquals(search_data[0]["title"], "My Animal Post")
 
+    def test_post_search_negation_in_or(self):
+        """Test that a negation the index can't express is scanned for instead."""
+        user = User.objects.get(username='testuser')
+        Post.objects.create(id='ccccccccccccccccc', user=user, title='Plain Post',
+                            slug="test-slug-3", body="Nothing to see here")
+        search = c.get('/api/post_search/', {"query":"Panda OR -Apple"})
+        self.assertEquals(search.status_code, 200)
+        self.assertEquals(set(post["title"] for post in
+                              json.loads(search.content.decode("UTF-8"))),
+                          set(["My Animal Post", "Plain Post"]))
+
+    def test_post_search_stemmed_and_ranked(self):
+        """Test that the index matches word forms and ranks title hits first."""
+        user = User.objects.get(username='testuser')
+        Post.objects.create(id='ccccccccccccccccc', user=user,
+                            title='Apples', slug="test-slug-3",
+                            body="Nothing to see here")
+        search = c.get('/api/post_search/?query=apples')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals([post["title"] for post in search_data],
+                          ["Apples", "My Fruit Post"])
+
+    def test_post_search_exclusion_with_terms(self):
+        search = c.get('/api/post_search/?query=My+-Apple')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals([post["title"] for post in search_data],
+                          ["My Animal Post"])
+
+    def test_search_index_follows_edits(self):
+        """Test that edited, deleted and hidden documents leave the index."""
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body = "My Banana"
+        post.save()
+        search = c.get("/api/post_search/?query=Apple")
+        self.assertEquals(json.loads(search.content.decode("UTF-8")), [])
+        search = c.get("/api/post_search/?query=Banana")
+        self.assertEquals(len(json.loads(search.content.decode("UTF-8"))), 1)
+        comment = Comment.objects.create(id='ccccccccccccccccc', post=post,
+                                         user=post.user, body="Banana split")
+        search = c.get("/api/comment_search/?query=Banana")
+        self.assertEquals(len(json.loads(search.content.decode("UTF-8"))), 1)
+        comment.is_deleted = True
+        comment.save()
+        search = c.get("/api/comment_search/?query=Banana")
+        self.assertEquals(json.loads(search.content.decode("UTF-8")), [])
+        # Saves that leave the text alone, like votes, skip the index
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+            post.base_score += 1
+            post.save()
+            post.save(update_fields=["base_score"])
+        self.assertFalse([query for query in queries
+                          if "lw2_search" in query["sql"]])
+        post.delete()
+        self.assertFalse(SearchDocument.objects.filter(document_id=post.id).exists())
+
+    def test_post_search_parameters(self):
+        """Test that search parameters narrow the results, scoped or not."""
+        other = User.objects.create_user('otheruser', 'other@example.com', 'pw')
+        Post.objects.create(id='ccccccccccccccccc', user=other,
+                            title='Other Fruit Post', slug="test-slug-3",
+                            base_score=20, posted_at=datetime(2018, 1, 1),
+                            body="Their Apple Pie")
+        Tag.objects.create(document_id='ccccccccccccccccc', type="post",
+                           text="Pie", tag_name=TagName.objects.create(key="pie",
+                                                                       text="Pie"))
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body += " from https://example.com"
+        post.save()
+        queries = {"Apple author:otheruser":["Other Fruit Post"],
+                   "Apple author:nobody":[],
+                   # Titles are searched too, stemmed
+                   "Fruits author:testuser":["My Fruit Post"],
+                   "Fruit -pie minscore:1":["My Fruit Post"],
+                   "Apple before:2018-06-01":["Other Fruit Post"],
+                   "Apple after:2018-06-01":["My Fruit Post"],
+                   "minscore:10":["My Animal Post", "Other Fruit Post"],
+                   "Apple tag:PIE":["Other Fruit Post"],
+                   "post:bbbbbbbbbbbbbbbbb":["My Animal Post"],
+                   # Unknown parameters are words like any other
+                   "Apple whatever:thing":[],
+                   "Apple https://example.com":["My Fruit Post"],
+                   "Apple -https://example.com":["Other Fruit Post"]}
+        for threshold in (1000, 0):
+            with self.settings(SEARCH_SCOPE_THRESHOLD=threshold):
+                for query, titles in queries.items():
+                    search = c.get('/api/post_search/', {"query":query})
+                    search_data = json.loads(search.content.decode("UTF-8"))
+                    self.assertEquals(set([post["title"] for post in search_data]),
+                                      set(titles), query)
+        for query in ("Apple after:yesterdayish", "Apple after:99999999999d",
+                      "Apple before:9999999d", "Apple after:99999-01-01"):
+            search = c.get('/api/post_search/', {"query":query})
+            self.assertEquals(search.status_code, 400, query)
+
+    def test_comment_search_parameters(self):
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        Comment.objects.create(id='ccccccccccccccccc', post=post,
+                               user=post.user, body="Apple crumble")
+        Comment.objects.create(id='ddddddddddddddddd', user=post.user,
+                               post=Post.objects.get(id='bbbbbbbbbbbbbbbbb'),
+                               body="Apple tart")
+        search = c.get('/api/comment_search/',
+                       {"query":"apple author:testuser after:30d post:aaaaaaaaaaaaaaaaa"})
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals([comment["_id"] for comment in search_data],
+                          ['ccccccccccccccccc'])
+
+    def test_post_search_pagination(self):
+        """Test following search result pages by cursor."""
+        search = c.get('/api/post_search/', {"query":"My", "limit":1})
+        first_page = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(first_page), 1)
+        self.assertEquals(search["X-Total-Hits"], "2")
+        self.assertEquals(search["X-Total-Hits-Relation"], "eq")
+        search = c.get('/api/post_search/', {"query":"My", "limit":1,
+                                             "cursor":search["X-Next-Cursor"]})
+        second_page = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(second_page), 1)
+        self.assertFalse(search.has_header("X-Next-Cursor"))
+        self.assertEquals(set([first_page[0]["title"], second_page[0]["title"]]),
+                          set(["My Fruit Post", "My Animal Post"]))
+        search = c.get('/api/post_search/', {"query":"My", "cursor":"nonsense"})
+        self.assertEquals(search.status_code, 400)
+
+    def test_post_search_cursor_is_a_position(self):
+        """Test that a cursor carries on after the last row it saw, ranked or
+        not, and that newer posts arriving ahead of it don't shift it."""
+        user = User.objects.get(username='testuser')
+        for query in ("My", "minscore:0"):
+            search = c.get('/api/post_search/', {"query":query, "limit":1})
+            titles = [post["title"] for post in json.loads(search.content.decode("UTF-8"))]
+            if query == "minscore:0":
+                # Ranks move with the index's statistics, only dates stay put
+                Post.objects.create(id='ccccccccccccccccc', user=user, title='My My My',
+                                    slug="test-slug-3", body="My My", base_score=1,
+                                    posted_at=datetime.now() + timedelta(days=1))
+            while search.has_header("X-Next-Cursor"):
+                search = c.get('/api/post_search/', {"query":query, "limit":1,
+                                                     "cursor":search["X-Next-Cursor"]})
+                titles.extend(post["title"] for post in
+                              json.loads(search.content.decode("UTF-8")))
+            self.assertEquals(len(titles), len(set(titles)), query)
+            self.assertEquals(set(titles) - {"My My My"},
+                              set(["My Fruit Post", "My Animal Post"]), query)
+            Post.objects.filter(id='ccccccccccccccccc').delete()
+
+    def test_post_search_streaming(self):
+        search = c.get('/api/post_search/', {"query":"My", "stream":"true"})
+        self.assertTrue(search.streaming)
+        search_data = json.loads(b"".join(search.streaming_content).decode("UTF-8"))
+        self.assertEquals(set([post["title"] for post in search_data]),
+                          set(["My Fruit Post", "My Animal Post"]))
+        search = c.get('/api/post_search/', {"query":"Nothing", "stream":"true"})
+        self.assertEquals(json.loads(b"".join(search.streaming_content).decode("UTF-8")), [])
+
+    @override_settings(SEARCH_BACKEND='scan')
+    def test_post_search_scan_backend(self):
+        search = c.get('/api/post_search/?query=Apple+OR+Panda')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(search_data), 2)
+
+    def test_post_search_grouping_and_phrases(self):
+        """Test parentheses, chained OR and quoted phrases, indexed and not."""
+        queries = {'(Apple OR Panda) My':["My Fruit Post", "My Animal Post"],
+                   'Mango OR Kiwi OR Panda':["My Fruit Post", "My Animal Post"],
+                   '"Dog Cat" -(Apple Orange)':["My Animal Post"],
+                   '"Cat Dog"':[],
+                   'My -(Mango OR Panda)':[],
+                   '(Apple':["My Fruit Post"]}
+        for backend in ("auto", "scan"):
+            with self.settings(SEARCH_BACKEND=backend):
+                for query, titles in queries.items():
+                    search = c.get('/api/post_search/', {"query":query})
+                    search_data = json.loads(search.content.decode("UTF-8"))
+                    self.assertEquals(set([post["title"] for post in search_data]),
+                                      set(titles), (backend, query))
+
+    def test_post_search_snippets_and_fields(self):
+        """Test that results carry highlighted snippets and that ?fields=
+        leaves out the rest."""
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body = " ".join(["Filler"] * 100 + ["My Apple Orange Mango"] +
+                             ["Padding"] * 100)
+        post.save()
+        for threshold in (1000, 0):
+            with self.settings(SEARCH_SCOPE_THRESHOLD=threshold):
+                search = c.get('/api/post_search/',
+                               {"query":"apple author:testuser",
+                                "fields":"_id,snippet"})
+                search_data = json.loads(search.content.decode("UTF-8"))
+                self.assertEquals(list(search_data[0].keys()), ["_id", "snippet"])
+                snippet = search_data[0]["snippet"]
+                self.assertIn("<mark>Apple</mark>", snippet)
+                self.assertTrue(snippet.startswith("…"))
+                self.assertTrue(snippet.endswith("…"))
+                self.assertLess(len(snippet), 400)
+        search = c.get('/api/post_search/', {"query":"Panda"})
+        result = json.loads(search.content.decode("UTF-8"))[0]
+        self.assertIn("<mark>Panda</mark>", result["snippet"])
+        self.assertNotIn("body", result)
+        search = c.get('/api/post_search/', {"query":"Panda", "fields":"body"})
+        self.assertEquals(json.loads(search.content.decode("UTF-8")),
+                          [{"body":"My Dog Cat Panda"}])
+        search = c.get('/api/post_search/', {"query":"Panda", "fields":"nonsense"})
+        self.assertEquals(search.status_code, 400)
+
+    def test_post_search_snippet_escaping(self):
+        """Test that markup in a body comes out of snippets escaped."""
+        from lw2.fulltext import render_snippet
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body = ('<script>alert("apple")</script> & Apple pie '
+                     # Stray highlight markers in a body don't unbalance the tags
+                     '\ue001x\ue000')
+        post.save()
+        for threshold in (1000, 0):
+            with self.settings(SEARCH_SCOPE_THRESHOLD=threshold):
+                search = c.get('/api/post_search/',
+                               {"query":"apple author:testuser",
+                                "fields":"snippet"})
+                snippet = json.loads(search.content.decode("UTF-8"))[0]["snippet"]
+                self.assertNotIn("<script>", snippet)
+                self.assertIn("&lt;script&gt;", snippet)
+                self.assertIn("<mark>Apple</mark>", snippet)
+                self.assertEquals(snippet.count("<mark>"), snippet.count("</mark>"))
+        self.assertEquals(render_snippet("a\ue001<b>\ue000c\ue000d"),
+                          "a&lt;b&gt;<mark>cd</mark>")
+
+    def test_post_search_long_term_snippet(self):
+        """Test that a term longer than a snippet doesn't break cutting one."""
+        term = "a" * 250
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body = "Before {} after".format(term)
+        post.save()
+        with self.settings(SEARCH_SCOPE_THRESHOLD=1000):
+            search = c.get('/api/post_search/',
+                           {"query":"{} author:testuser".format(term)})
+        self.assertEquals(search.status_code, 200)
+        self.assertEquals(len(json.loads(search.content.decode("UTF-8"))), 1)
+
+    @override_settings(SEARCH_SYNONYMS=[["fruit", "orange mango"], ["dogs", "puppy"]])
+    def test_post_search_synonyms_and_stems(self):
+        from lw2.search import mk_snippet, parse_search_string
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.title = "My Post"
+        post.save()
+        queries = {"fruit":["My Post"],
+                   "puppies":["My Animal Post"],
+                   "apples":["My Post"],
+                   # Terms match whole words or their starts, not any part
+                   "ang":[],
+                   '"fruit"':[]}
+        for backend in ("auto", "scan"):
+            with self.settings(SEARCH_BACKEND=backend):
+                for query, titles in queries.items():
+                    search = c.get('/api/post_search/', {"query":query})
+                    search_data = json.loads(search.content.decode("UTF-8"))
+                    self.assertEquals([post["title"] for post in search_data],
+                                      titles, (backend, query))
+        self.assertEquals(mk_snippet(parse_search_string("run"), "Prune before running"),
+                          "Prune before <mark>running</mark>")
+        # Cached plans don't outlive the synonyms they were expanded with
+        with self.settings(SEARCH_SYNONYMS=[]):
+            self.assertEquals(parse_search_string("fruit").tree.op, "term")
+        self.assertEquals(parse_search_string("fruit").tree.op, "or")
+
+    def test_fuzzy_lookup(self):
+        """Test that titles and names are found from substrings and typos,
+        including ones saved after the index was loaded."""
+        post_title_index.invalidate()
+        user_name_index.invalidate()
+        def lookup(**params):
+            response = c.get('/api/fuzzy_lookup/', params)
+            return json.loads(response.content.decode("UTF-8"))
+        self.assertEquals([post["title"] for post in lookup(query="animl post")],
+                          ["My Animal Post"])
+        self.assertEquals([post["title"] for post in lookup(query="ruit")],
+                          ["My Fruit Post"])
+        self.assertEquals(len(lookup(query="Post")), 2)
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.title = "Mangoes"
+        post.save()
+        self.assertEquals([post["title"] for post in lookup(query="mangos")],
+                          ["Mangoes"])
+        self.assertEquals(lookup(query="fruit"), [])
+        user = User.objects.get(username='testuser')
+        Profile.objects.create(user=user, display_name="Jonathan Doe")
+        self.assertEquals(lookup(query="jonathon", type="users")[0]["username"],
+                          "testuser")
+        self.assertEquals(lookup(query="te", type="users")[0]["displayName"],
+                          "Jonathan Doe")
+        self.assertEquals(c.get('/api/fuzzy_lookup/', {"type":"nope"}).status_code, 400)
+
+    def test_search_plan_cache(self):
+        from lw2.search import parse_search_string, And, Or, Term
+        plan = parse_search_string('apple  (Mango OR "Big Cat") author:me')
+        self.assertEquals(plan.tree, And((Or((Term("Big Cat", True),
+                                              Term("mango", False))),
+                                          Term("apple", False))))
+        self.assertEquals(plan.parameters, {"author":"me"})
+        self.assertIs(parse_search_string('apple (Mango OR "Big Cat")  author:me'),
+                      plan)
+
 class InviteTestCase(TestCase):
     """Test the user invite and signup API's."""
     def setUp(self):
@@ -255,6 +749,96 @@ class TagTestCase(TestCase):
                             "text":"my;bad;tag"})
         self.assertEquals(response1.status_code, 400)
 
+    def test_tag_vocabulary_counts(self):
+        """Test that tags differing only in case share a vocabulary entry whose
+        count follows tag creation and deletion."""
+        self.login()
+        c.post("/api/tags/", {"document_id":self.post1.id, "text":"Fruit"})
+        response1 = c.post("/api/tags/", {"document_id":self.post1.id,
+                                          "text":"fruit"})
+        self.assertEquals(TagName.objects.get(key="fruit").count, 2)
+        tag_id = json.loads(response1.content.decode("UTF-8"))["id"]
+        c.delete("/api/tags/" + str(tag_id) + "/")
+        tag_name = TagName.objects.get(key="fruit")
+        self.assertEquals(tag_name.count, 1)
+        self.assertEquals(tag_name.text, "Fruit")
+
+    def test_tagset_with_duplicate_rows(self):
+        """Test that replacing a tagset takes every row it deletes off the
+        vocabulary counts, even when a post has the same tag twice."""
+        self.login()
+        c.post("/api/posts/" + self.post1.id + "/update_tagset/", {"tags":"fruit"})
+        tag = Tag.objects.get(document_id=self.post1.id)
+        tag.pk = None
+        tag.save()
+        TagName.objects.filter(key="fruit").update(count=2)
+        c.post("/api/posts/" + self.post1.id + "/update_tagset/", {"tags":"food"})
+        self.assertEquals(list(Tag.objects.filter(document_id=self.post1.id).values_list(
+            "text", flat=True)), ["food"])
+        self.assertEquals(TagName.objects.get(key="fruit").count, 0)
+
+    def test_posts_by_tag(self):
+        """Test listing the posts with a tag through REST and GraphQL."""
+        self.login()
+        c.post("/api/posts/" + self.post1.id + "/update_tagset/",
+               {"tags":"Fruit,food"})
+        response1 = c.get("/api/tag_names/FRUIT/posts/")
+        posts = json.loads(response1.content.decode("UTF-8"))
+        self.assertEquals([post["_id"] for post in posts], [self.post1.id])
+        response2 = c.post("/graphql/", {"query":"""
+        { PostsByTag(terms: {tag: "food", order: "score"}) { _id }
+          TagsTop(limit: 5) { key count } }"""})
+        data = json.loads(response2.content.decode("UTF-8"))["data"]
+        self.assertEquals(data["PostsByTag"], [{"_id":self.post1.id}])
+        self.assertEquals(set([tag["key"] for tag in data["TagsTop"]]),
+                          set(["fruit", "food"]))
+
+    def test_tag_autocomplete(self):
+        """Test that tag suggestions match by prefix, rank by usage count and
+        pick up newly created tags."""
+        tag_prefix_index.invalidate()
+        self.login()
+        post2 = Post.objects.create(id='bbbbbbbbbbbbbbbbb', user=self.post1.user,
+                                    title='My Animal Post', slug="test-slug-2",
+                                    body="My Dog Cat Panda")
+        c.post("/api/posts/" + self.post1.id + "/update_tagset/",
+               {"tags":"Fruit,food"})
+        response1 = c.get("/api/tag_autocomplete/?prefix=F")
+        suggestions = json.loads(response1.content.decode("UTF-8"))
+        self.assertEquals(set([tag["key"] for tag in suggestions]),
+                          set(["fruit", "food"]))
+        c.post("/api/posts/" + post2.id + "/update_tagset/",
+               {"tags":"food,fox"})
+        response2 = c.get("/api/tag_autocomplete/?prefix=fo&limit=2")
+        suggestions = json.loads(response2.content.decode("UTF-8"))
+        self.assertEquals(suggestions[0], {"key":"food", "text":"food", "count":2})
+        self.assertEquals(suggestions[1]["key"], "fox")
+        self.assertEquals(len(suggestions), 2)
+
+    def test_related_posts(self):
+        """Test that precomputed related posts favor posts sharing rare tags,
+        with and without scipy."""
+        self.login()
+        user = self.post1.user
+        for post_id in ('bbbbbbbbbbbbbbbbb', 'ccccccccccccccccc', 'ddddddddddddddddd'):
+            Post.objects.create(id=post_id, user=user, title=post_id,
+                                slug=post_id, body="")
+        tagsets = {self.post1.id:"fruit,citrus",
+                   'bbbbbbbbbbbbbbbbb':"fruit,citrus",
+                   'ccccccccccccccccc':"fruit,berry",
+                   'ddddddddddddddddd':"fruit,berry"}
+        for post_id, tags in tagsets.items():
+            c.post("/api/posts/" + post_id + "/update_tagset/", {"tags":tags})
+        for use_sparse in set([False, sparse is not None]):
+            compute_related_posts(top_k=2, use_sparse=use_sparse)
+            response = c.post("/graphql/", {"query":"""
+            { PostsSingle(documentId: "%s") { relatedPosts(limit: 3) { _id } } }
+            """ % self.post1.id})
+            related = json.loads(response.content.decode("UTF-8"))["data"]
+            related = [post["_id"] for post in related["PostsSingle"]["relatedPosts"]]
+            self.assertEquals(len(related), 2)
+            self.assertEquals(related[0], 'bbbbbbbbbbbbbbbbb')
+
     def test_no_post_without_tags(self):
         """Test that it's not possible to create a post without at least one 
         tag.
@@ -363,3 +947,444 @@ class VoteTestCase(TestCase):
         response1 = c.get("/api/votes/")
         post1_updated = Post.objects.all()[0]
         self.assertEqual(post1_updated.base_score,4)
+
+class AuthHeaderTestCase(TestCase):
+    """Test authenticating with a session key in the Authorization header."""
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        Profile.objects.create(user=self.user)
+        session_users.clear()
+        users.clear()
+        self.session_key = self.login()
+
+    def login(self):
+        response = Client().post("/graphql/", {"query":"""
+        mutation Login($user: String, $password: String) {
+        Login(username: $user, password: $password) {
+        sessionKey
+        }
+        } """,
+                                              "variables":"""{
+                                              "user":"testuser",
+                                              "password":"testpassword"
+                                              }"""})
+        data = json.loads(response.content.decode("UTF-8"))
+        return data["data"]["Login"]["sessionKey"]
+
+    def authenticate(self, session_key):
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION=session_key)
+        request.user = AnonymousUser()
+        AuthHeaderMiddleware(lambda request: None)(request)
+        return request.user
+
+    def test_session_user_is_cached(self):
+        self.assertEqual(self.authenticate(self.session_key).id, self.user.id)
+        with self.assertNumQueries(0):
+            user = self.authenticate(self.session_key)
+        self.assertEqual(user.username, "testuser")
+
+    def test_users_edit_with_cached_profile(self):
+        """Test that editing a user whose profile is cached only writes the
+        edited fields."""
+        self.assertEqual(self.authenticate(self.session_key).id, self.user.id)
+        Profile.objects.filter(user=self.user).update(karma=42, unread_notifications=3)
+        response = Client(HTTP_AUTHORIZATION=self.session_key).post("/graphql/", {"query":"""
+        mutation { usersEdit(documentId: "%d",
+                   set: {lastNotificationsCheck: "2100-01-01T00:00:00+00:00"}) { _id } }
+        """ % self.user.id})
+        self.assertNotIn("errors", json.loads(response.content.decode("UTF-8")))
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.karma, 42)
+        self.assertEqual(profile.unread_notifications, 0)
+        self.assertEqual(profile.last_notifications_check,
+                         datetime(2100, 1, 1, tzinfo=utc))
+        response = Client(HTTP_AUTHORIZATION=self.session_key).post("/graphql/", {"query":"""
+        mutation { usersEdit(documentId: "me",
+                   set: {lastNotificationsCheck: "2100-01-01T00:00:00+00:00"}) { _id } }
+        """})
+        self.assertEqual(json.loads(response.content.decode("UTF-8"))["errors"][0]["message"],
+                         "'me' is not a user id")
+
+    def test_cache_drops_entries_by_value(self):
+        from lw2.auth_header import TTLCache
+        cache = TTLCache(3)
+        for key, value in (("a", 1), ("b", 2), ("c", 1), ("d", 1)):
+            cache.set(key, value, 60)
+        cache.set("c", 2, 60)
+        cache.pop_value(1)
+        # a was evicted and d popped
+        self.assertEqual(list(cache.entries), ["b", "c"])
+        self.assertEqual(cache.keys, {2:{"b", "c"}})
+
+    def test_unknown_session_is_anonymous(self):
+        self.assertFalse(self.authenticate("nosuchsession").is_authenticated)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.authenticate("nosuchsession").is_authenticated)
+
+    def test_password_change_logs_out(self):
+        self.assertTrue(self.authenticate(self.session_key).is_authenticated)
+        self.user.set_password("newpassword")
+        self.user.save()
+        self.assertFalse(self.authenticate(self.session_key).is_authenticated)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_sessions(self):
+        session_key = self.login()
+        self.assertEqual(self.authenticate(session_key).id, self.user.id)
+        self.assertEqual(Session.objects.count(), 1)
+
+    def test_sweep_expired_sessions(self):
+        for number in range(5):
+            Session.objects.create(session_key="expired{}".format(number),
+                                   session_data="",
+                                   expire_date=datetime(2000, 1, 1, tzinfo=utc))
+        self.assertEqual(sweep_expired_sessions(batch_size=2, pause=0), 5)
+        self.assertEqual(list(Session.objects.values_list("session_key", flat=True)),
+                         [self.session_key])
+
+    def test_user_context_loads_once(self):
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(id=self.user.id)
+        with self.assertNumQueries(1):
+            current = get_user_context(request)
+            self.assertFalse(current.is_moderator)
+            self.assertFalse(current.is_banned)
+            self.assertIs(get_user_context(request), current)
+
+    def test_banned_user_cannot_post(self):
+        client = Client()
+        client.post("/graphql/", {"query":"""
+        mutation Login($user: String, $password: String) {
+        Login(username: $user, password: $password) { sessionKey }
+        } """, "variables":'{"user":"testuser", "password":"testpassword"}'})
+        new_post = """mutation { PostsNew(document: {title: "Hello", body: "World"}) { _id } }"""
+        response = client.post("/graphql/", {"query":new_post})
+        self.assertNotIn("errors", json.loads(response.content.decode("UTF-8")))
+        # The ban outlives this test in memory, forget it afterwards
+        self.addCleanup(active_bans.invalidate)
+        Ban.objects.create(user=self.user, reason="Spam", ban_message="Bye",
+                           until=datetime(2100, 1, 1, tzinfo=utc),
+                           appeal_on=datetime(2100, 1, 1, tzinfo=utc))
+        response = client.post("/graphql/", {"query":new_post})
+        errors = json.loads(response.content.decode("UTF-8"))["errors"]
+        self.assertIn("banned", errors[0]["message"])
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_ban_set(self):
+        """Test that bans take effect at once, for header authentication too,
+        and stop counting at their until date."""
+        self.addCleanup(active_bans.invalidate)
+        ban = Ban.objects.create(user=self.user, reason="Spam", ban_message="Bye",
+                                 until=datetime(2100, 1, 1, tzinfo=utc),
+                                 appeal_on=datetime(2100, 1, 1, tzinfo=utc))
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION=self.session_key)
+        response = AuthHeaderMiddleware(lambda request: None)(request)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("Bye", response.content.decode("UTF-8"))
+        ban.until = datetime(2000, 1, 1, tzinfo=utc)
+        ban.save()
+        with self.assertNumQueries(0):
+            self.assertIsNone(active_bans.get(self.user.id))
+        self.assertEqual(self.authenticate(self.session_key).id, self.user.id)
+
+    def test_ban_set_follows_other_processes(self):
+        """Test that a ban made by another process is picked up once the
+        version in the database moves on."""
+        self.addCleanup(active_bans.invalidate)
+        self.assertIsNone(active_bans.get(self.user.id))
+        # As another process would leave things, bulk_create sends no signals
+        Ban.objects.bulk_create([Ban(user=self.user, reason="Spam", ban_message="Bye",
+                                     until=datetime(2100, 1, 1, tzinfo=utc),
+                                     appeal_on=datetime(2100, 1, 1, tzinfo=utc))])
+        BanSetVersion.objects.update_or_create(id=1, defaults={"version":1000})
+        with self.settings(BAN_SET_CHECK_INTERVAL=0):
+            self.assertEqual(active_bans.get(self.user.id)[1], "Bye")
+
+@override_settings(NOTIFICATION_FANOUT='inline', NOTIFICATION_EVENTS_NOTIFIER='local')
+class NotificationTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.carol = User.objects.create_user('carol', 'carol@example.com', 'pw')
+        self.post = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.alice,
+                                        title='My Fruit Post', slug="test-slug-1",
+                                        body="My Apple Orange Mango")
+        self.client = Client()
+        self.client.login(username='bob', password='pw')
+
+    def graphql(self, query):
+        response = self.client.post("/graphql/", {"query":query})
+        return json.loads(response.content.decode("UTF-8"))
+
+    def test_comment_notifications(self):
+        """Test that comments notify the post author, repliees and mentioned
+        users, once each and never the commenter."""
+        self.graphql("""mutation { CommentsNew(document: {postId: "aaaaaaaaaaaaaaaaa",
+                        body: "Hi @alice and @carol, and @bob, and @nobody."}) { _id } }""")
+        self.assertEqual(
+            set(Notification.objects.values_list("user__username", "type")),
+            set([("alice", "newComment"), ("carol", "newMention")]))
+        comment = Comment.objects.get()
+        Notification.objects.all().delete()
+        self.client.login(username='carol', password='pw')
+        self.graphql("""mutation { CommentsNew(document: {postId: "aaaaaaaaaaaaaaaaa",
+                        parentCommentId: "%s", body: "Thanks @bob"}) { _id } }""" % comment.id)
+        self.assertEqual(
+            list(Notification.objects.values_list("user__username", "type")),
+            [("bob", "newReply")])
+
+    def test_message_notifications(self):
+        conversation = Conversation.objects.create(title="Fruit")
+        for user in (self.alice, self.bob, self.carol):
+            Participant.objects.create(user=user, conversation=conversation)
+        self.graphql("""mutation { MessagesNew(document: {conversationId: "%d",
+                        body: "Hello"}) { _id } }""" % conversation.id)
+        self.assertEqual(
+            set(Notification.objects.values_list("user__username", "type")),
+            set([("alice", "newMessage"), ("carol", "newMessage")]))
+        self.assertEqual(fanout_queue.metrics["errors"], 0)
+
+    def test_comment_on_deleted_post(self):
+        """Test that a comment whose post is gone still notifies repliees and
+        doesn't cost the other comments in its batch their notifications."""
+        other = Post.objects.create(id='bbbbbbbbbbbbbbbbb', user=self.alice,
+                                    title='Doomed Post', slug="test-slug-2", body="Soon gone")
+        parent = Comment.objects.create(id='ccccccccccccccccc', post=other, user=self.carol, body="First",
+                                        posted_at=datetime.now(utc))
+        orphan = Comment.objects.create(id='ddddddddddddddddd', post=other, user=self.bob, parent_comment=parent,
+                                        body="Reply", posted_at=datetime.now(utc))
+        comment = Comment.objects.create(id='eeeeeeeeeeeeeeeee', post=self.post,
+                                         user=self.bob, body="Hi",
+                                         posted_at=datetime.now(utc))
+        Comment.objects.filter(post=other).update(post=None)
+        Notification.objects.all().delete()
+        queue = FanoutQueue()
+        queue.handle([("comment", orphan.id), ("comment", comment.id)])
+        self.assertEqual(queue.metrics["errors"], 0)
+        self.assertEqual(
+            set(Notification.objects.values_list("user__username", "type", "message")),
+            set([("carol", "newReply", "bob replied to your comment on a deleted post"),
+                 ("alice", "newComment", "bob commented on My Fruit Post")]))
+
+    def test_unread_count(self):
+        """Test that fan-out counts unread notifications, that checking
+        notifications resets the count and that reconciling fixes drift."""
+        for user in (self.alice, self.bob, self.carol):
+            Profile.objects.create(user=user, last_notifications_check=datetime(2000, 1, 1, tzinfo=utc))
+        self.graphql("""mutation { CommentsNew(document: {postId: "aaaaaaaaaaaaaaaaa",
+                        body: "Hi @alice and @carol"}) { _id } }""")
+        self.graphql("""mutation { CommentsNew(document: {postId: "aaaaaaaaaaaaaaaaa",
+                        body: "Me again @carol"}) { _id } }""")
+        self.assertEqual(dict(Profile.objects.values_list("user__username",
+                                                          "unread_notifications")),
+                         {"alice":2, "bob":0, "carol":2})
+        self.client.login(username='carol', password='pw')
+        self.assertEqual(self.graphql("{ UnreadNotificationsCount }")["data"],
+                         {"UnreadNotificationsCount":2})
+        self.graphql("""mutation { usersEdit(documentId: "%d",
+                        set: {lastNotificationsCheck: "%s"}) { _id } }""" % (
+                            self.carol.id, datetime.now(utc).isoformat()))
+        self.assertEqual(self.graphql("{ UnreadNotificationsCount }")["data"],
+                         {"UnreadNotificationsCount":0})
+        Profile.objects.filter(user=self.alice).update(unread_notifications=7)
+        self.assertEqual(reconcile_unread_counts(batch_size=2), 1)
+        self.assertEqual(dict(Profile.objects.values_list("user__username",
+                                                          "unread_notifications")),
+                         {"alice":2, "bob":0, "carol":0})
+
+    def test_events(self):
+        """Test that waiting for events answers with new notifications and
+        messages, and that publishing wakes waiting clients."""
+        self.assertEqual(json.loads(self.client.get("/api/events/").content.decode("UTF-8")),
+                         {"cursor":0, "notifications":[], "messages":[]})
+        conversation = Conversation.objects.create(title="Fruit")
+        for user in (self.alice, self.bob):
+            Participant.objects.create(user=user, conversation=conversation)
+        self.graphql("""mutation { MessagesNew(document: {conversationId: "%d",
+                        body: "Hello"}) { _id } }""" % conversation.id)
+        notification = Notification.objects.get()
+        self.client.login(username='alice', password='pw')
+        events = json.loads(self.client.get("/api/events/?since=0&timeout=0").content.decode("UTF-8"))
+        self.assertEqual(events, {"cursor":notification.id,
+                                  "notifications":[notification.id],
+                                  "messages":[notification.document_id]})
+        events = json.loads(self.client.get(
+            "/api/events/?since=%d&timeout=0" % notification.id).content.decode("UTF-8"))
+        self.assertEqual(events["notifications"], [])
+        self.assertEqual(self.client.get("/api/events/?since=x").status_code, 400)
+        # Last-Event-ID is a cursor too
+        events = json.loads(self.client.get(
+            "/api/events/?timeout=0", HTTP_LAST_EVENT_ID="0").content.decode("UTF-8"))
+        self.assertEqual(events["notifications"], [notification.id])
+
+        event = event_hub.subscribe(self.alice.id)
+        self.addCleanup(event_hub.unsubscribe, self.alice.id, event)
+        threading.Timer(0.05, event_hub.publish, [[self.bob.id, self.alice.id]]).start()
+        self.assertTrue(event.wait(5))
+
+    @override_settings(NOTIFICATION_EVENTS_STREAM_SECONDS=0.2)
+    def test_event_stream(self):
+        """Test that the event stream starts at the cursor, sends what's new
+        and carries on from Last-Event-ID."""
+        first = Notification.objects.create(user=self.bob, message="first")
+        second = Notification.objects.create(user=self.bob, message="second")
+        response = self.client.get("/api/events/?timeout=0", HTTP_ACCEPT="text/event-stream",
+                                   HTTP_LAST_EVENT_ID=str(first.id))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = [chunk.decode("UTF-8") for chunk in response.streaming_content]
+        self.assertEqual(chunks[0], "id: {}\ndata: {}\n\n".format(first.id, json.dumps(
+            {"cursor":first.id, "notifications":[], "messages":[]})))
+        self.assertEqual(chunks[1], "id: {}\ndata: {}\n\n".format(second.id, json.dumps(
+            {"cursor":second.id, "notifications":[second.id], "messages":[]})))
+        self.assertLessEqual(set(chunks[2:]), {": keepalive\n\n"})
+
+    def test_mark_read_and_prune(self):
+        """Test marking notifications read up to one of them, and that only
+        old viewed notifications are pruned."""
+        old = datetime(2000, 1, 1, tzinfo=utc)
+        first, second, third = [
+            Notification.objects.create(user=self.bob, created_at=old, message=str(i))
+            for i in range(3)]
+        Notification.objects.create(user=self.alice, created_at=old, message="alice's")
+        Profile.objects.create(user=self.bob, unread_notifications=3,
+                               last_notifications_check=datetime(1999, 1, 1, tzinfo=utc))
+        result = self.graphql("""mutation { markNotificationsRead(upTo: "%d") { count } }"""
+                              % second.id)
+        self.assertEqual(result["data"], {"markNotificationsRead":{"count":2}})
+        self.assertEqual(list(Notification.objects.filter(viewed=True).order_by("id")),
+                         [first, second])
+        self.assertEqual(Profile.objects.get(user=self.bob).unread_notifications, 1)
+        self.assertEqual(reconcile_unread_counts(), 0)
+        Notification.objects.create(user=self.bob, viewed=True, message="new")
+        self.assertEqual(prune_notifications(max_age_days=30, batch_size=1), 2)
+        self.assertEqual(sorted(Notification.objects.values_list("message", flat=True)),
+                         ["2", "alice's", "new"])
+
+    def test_messages_pages(self):
+        """Test paging through a conversation back and forth by cursor."""
+        conversation = Conversation.objects.create(title="Fruit")
+        messages = [Message.objects.create(
+            user=self.bob, conversation=conversation, body=str(i),
+            created_at=datetime(2019, 1, 1, tzinfo=utc) + timedelta(minutes=i // 2))
+                    for i in range(7)]
+        def page(**terms):
+            terms = ", ".join('{}: {}'.format(key, json.dumps(value))
+                              for key, value in terms.items())
+            result = self.graphql("""{ MessagesList(terms: {conversationId: "%d", %s})
+                                       { body } }""" % (conversation.id, terms))
+            return [message["body"] for message in result["data"]["MessagesList"]]
+        self.assertEqual(page(limit=3), ["4", "5", "6"])
+        self.assertEqual(page(limit=3, before=str(messages[4].id)), ["1", "2", "3"])
+        self.assertEqual(page(limit=3, before=str(messages[1].id)), ["0"])
+        self.assertEqual(page(limit=2, after=str(messages[2].id)), ["3", "4"])
+        self.assertEqual(page(after=str(messages[6].id)), [])
+
+    def test_inbox(self):
+        """Test that sending messages keeps the inbox order, previews and
+        unread counts up to date, and that reading resets the count."""
+        conversations = [Conversation.objects.create(title=title)
+                         for title in ("Fruit", "Vegetables")]
+        for conversation in conversations:
+            for user in (self.alice, self.bob):
+                Participant.objects.create(user=user, conversation=conversation)
+        for conversation, body in ((conversations[1], "Carrots?"),
+                                   (conversations[0], "Apples?"),
+                                   (conversations[0], "Or  pears?")):
+            self.graphql("""mutation { MessagesNew(document: {conversationId: "%d",
+                            body: "%s"}) { _id } }""" % (conversation.id, body))
+        inbox = """{ ConversationsList(terms: {limit: 10}) {
+                       title lastMessagePreview unreadCount } }"""
+        self.assertEqual(self.graphql(inbox)["data"]["ConversationsList"], [
+            {"title":"Fruit", "lastMessagePreview":"Or pears?", "unreadCount":0},
+            {"title":"Vegetables", "lastMessagePreview":"Carrots?", "unreadCount":0}])
+        self.client.login(username='alice', password='pw')
+        self.assertEqual([conversation["unreadCount"] for conversation in
+                          self.graphql(inbox)["data"]["ConversationsList"]], [2, 1])
+        self.graphql("""mutation { markConversationRead(documentId: "%d") { _id } }"""
+                     % conversations[0].id)
+        self.assertEqual([conversation["unreadCount"] for conversation in
+                          self.graphql(inbox)["data"]["ConversationsList"]], [0, 1])
+
+    def test_conversations_new(self):
+        """Test that conversations are created with their participants in
+        one go, or not at all, and that listing them costs a fixed number of
+        queries."""
+        Profile.objects.create(user=self.alice, display_name="Alice A.")
+        result = self.graphql("""mutation { ConversationsNew(document: {title: "Fruit",
+                                 participantIds: ["%d", "%d", "%d"]}) { _id } }""" % (
+                                     self.alice.id, self.bob.id, self.alice.id))
+        conversation = Conversation.objects.get(id=int(result["data"]["ConversationsNew"]["_id"]))
+        self.assertEqual(sorted(conversation.participants.values_list("user__username", flat=True)),
+                         ["alice", "bob"])
+        result = self.graphql("""mutation { ConversationsNew(document: {title: "Nope",
+                                 participantIds: ["%d", "12345"]}) { _id } }""" % self.alice.id)
+        self.assertIn("errors", result)
+        self.assertEqual(Conversation.objects.count(), 1)
+        Conversation.objects.create(title="Vegetables").participants.create(user=self.bob)
+        with self.assertNumQueries(5):
+            # The session, the user, their profile, the inbox and the participants
+            result = self.graphql("""{ ConversationsList { title
+                                         participants { displayName } } }""")
+        self.assertEqual(result["data"]["ConversationsList"], [
+            {"title":"Vegetables", "participants":[{"displayName":"bob"}]},
+            {"title":"Fruit", "participants":[{"displayName":"Alice A."},
+                                               {"displayName":"bob"}]}])
+
+@override_settings(NOTIFICATION_FANOUT='thread', NOTIFICATION_FANOUT_DELAY=0.2,
+                   NOTIFICATION_EVENTS_NOTIFIER='local')
+class NotificationFanoutThreadTestCase(TransactionTestCase):
+    """Fan-out through the background thread. Its events are only queued once
+    their transaction commits, and it reads them on its own connection, so
+    these tests commit for real."""
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        Profile.objects.create(user=self.alice)
+        self.post = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.alice,
+                                        title='My Fruit Post', slug="test-slug-1",
+                                        body="My Apple Orange Mango")
+        self.client = Client()
+        self.client.login(username='bob', password='pw')
+
+    def test_thread_fanout(self):
+        """Test that comments are fanned out by the worker thread, which
+        wakes the clients waiting on their recipients."""
+        before = fanout_queue.snapshot()
+        event = event_hub.subscribe(self.alice.id)
+        self.addCleanup(event_hub.unsubscribe, self.alice.id, event)
+        for number in range(3):
+            self.client.post("/graphql/", {"query":"""mutation { CommentsNew(document:
+                {postId: "aaaaaaaaaaaaaaaaa", body: "Hi @alice %d"}) { _id } }""" % number})
+        self.assertTrue(event.wait(5))
+        deadline = time.monotonic() + 5
+        while (fanout_queue.snapshot()["processed"] < before["processed"] + 3 and
+               time.monotonic() < deadline):
+            time.sleep(0.05)
+        after = fanout_queue.snapshot()
+        self.assertEqual(after["enqueued"] - before["enqueued"], 3)
+        self.assertEqual(after["processed"] - before["processed"], 3)
+        self.assertEqual(after["errors"], before["errors"])
+        self.assertEqual(Notification.objects.filter(user=self.alice).count(), 3)
+        self.assertEqual(Profile.objects.get(user=self.alice).unread_notifications, 3)
+
+    @override_settings(NOTIFICATION_QUEUE_SIZE=2, NOTIFICATION_BATCH_SIZE=2)
+    def test_batches_and_overflow(self):
+        """Test that batches stop at the batch size and that a full queue
+        makes the caller handle its own event."""
+        comments = [Comment.objects.create(id=str(number).ljust(17, "_"), post=self.post,
+                                           user=self.bob, body="Hi")
+                    for number in range(3)]
+        fanout = FanoutQueue()
+        # Stand in for a busy worker, so nothing drains the queue
+        fanout.worker = threading.current_thread()
+        for comment in comments:
+            fanout.put(("comment", comment.id))
+        self.assertEqual(fanout.snapshot()["enqueued"], 2)
+        self.assertEqual(fanout.snapshot()["overflows"], 1)
+        self.assertEqual(fanout.snapshot()["processed"], 1)
+        self.assertEqual(Notification.objects.count(), 1)
+        batch = fanout.take_batch()
+        self.assertEqual(batch, [("comment", comment.id) for comment in comments[:2]])
+        fanout.handle(batch)
+        self.assertEqual(fanout.snapshot()["batches"], 2)
+        self.assertEqual(Notification.objects.filter(user=self.alice).count(), 3)
@@ -10,7 +10,12 @@ router.register(r'users', views.UserViewSet)
 router.register(r'posts', views.PostViewSet)
 router.register(r'comments', views.CommentViewSet)
 router.register(r'tags', views.TagViewSet)
+router.register(r'tag_names', views.TagNameViewSet)
+router.register(r'tag_autocomplete', views.TagAutocompleteView, basename="tag-autocomplete")
+router.register(r'fuzzy_lookup', views.FuzzyLookupView, basename="fuzzy-lookup")
 router.register(r'votes',views.VoteViewSet)
+router.register(r'events', views.EventsView, basename="events")
+router.register(r'notification_metrics', views.NotificationMetricsView, basename="notification-metrics")
 router.register(r'post_search', views.PostSearchView, basename="post-search")
 router.register(r'comment_search', views.CommentSearchView, basename="comment-search")
 router.register(r'bans', views.BanViewSet)
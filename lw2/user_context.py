@@ -0,0 +1,84 @@
+from django.contrib.auth.models import User
+from lw2.bans import active_bans
+from lw2.models import Profile
+
+"""The current user of a request, with what permission checks need to know.
+
+get_user_context() loads the user once per request, with their profile in
+the same query, and keeps the result on the request. Ban state comes from
+the in-memory set in lw2.bans, so checking it costs no queries either.
+Resolvers, serializers and views should check permissions through it rather
+than following relations off request.user, which costs a query per relation
+per check."""
+
+def load_user(user_id):
+    """Fetch a user along with their profile."""
+    return User.objects.select_related("profile").get(id=user_id)
+
+class UserContext(object):
+    """Wraps the user making a request.
+
+    - user: The User, loaded with load_user(), or AnonymousUser.
+    - profile: Their Profile, or None if they don't have one.
+    - is_moderator: Whether they're a moderator.
+    - banned_until: When their ban ends if they're banned, otherwise None."""
+    def __init__(self, user):
+        self.user = user
+
+    @property
+    def id(self):
+        return self.user.id
+
+    @property
+    def is_authenticated(self):
+        return self.user.is_authenticated
+
+    @property
+    def profile(self):
+        if not self.is_authenticated:
+            return None
+        try:
+            return self.user.profile
+        except Profile.DoesNotExist:
+            return None
+
+    @property
+    def is_moderator(self):
+        return bool(self.profile and self.profile.moderator)
+
+    @property
+    def banned_until(self):
+        if not self.is_authenticated:
+            return None
+        return active_bans.banned_until(self.user.id)
+
+    @property
+    def is_banned(self):
+        return self.banned_until is not None
+
+    def is_user(self, user_id):
+        """Whether this is the user with user_id, e.g an author's user_id."""
+        return self.is_authenticated and self.user.id == user_id
+
+    def require_login(self, message="You're not logged in!"):
+        if not self.is_authenticated:
+            raise ValueError(message)
+
+    def require_write(self, message="You're not logged in!"):
+        """Raise ValueError unless this user may create or change content."""
+        self.require_login(message)
+        if self.is_banned:
+            raise ValueError("You are banned until {}".format(
+                self.banned_until.isoformat()))
+
+def get_user_context(request):
+    """Return the UserContext for a Django or REST framework request."""
+    request = getattr(request, "_request", request)
+    context = getattr(request, "user_context", None)
+    if context is None:
+        user = request.user
+        if user.is_authenticated and not User.profile.is_cached(user):
+            user = load_user(user.id)
+            request.user = user
+        context = request.user_context = UserContext(user)
+    return context
@@ -1,23 +1,46 @@
 from django.shortcuts import render
 from django.views import View
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.dateparse import parse_datetime
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
 from rest_framework import viewsets, filters, generics
 from rest_framework.permissions import DjangoModelPermissions
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.renderers import JSONRenderer
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.decorators import action
 from lw2.models import *
 from lw2.serializers import *
 import lw2.search as wl_search
+import lw2.fulltext as wl_fulltext
+import lw2.tags as wl_tags
+import lw2.fuzzy as wl_fuzzy
+import lw2.notifications as wl_notifications
+import lw2.events as wl_events
+from lw2.user_context import get_user_context
+import base64
 import datetime
 import json
+import time
 import h_annot # TODO: Modularize this out as some kind of extension
 
 
+def parse_limit(value, default, maximum=100):
+    """Parse a non-negative integer query parameter, clamped to maximum."""
+    try:
+        limit = max(int(value), 0)
+    except (TypeError, ValueError):
+        return default
+    if maximum is not None and limit > maximum:
+        return maximum
+    return limit
+
 class CsrfExemptSessionAuthentication(SessionAuthentication):
     """The API doesn't actually communicate with a users browser, so CSRF 
     doesn't make sense."""
@@ -45,6 +68,9 @@ class PostViewSet(viewsets.ModelViewSet):
         """Replace the current set of tags on a post with the tags specified in 
         a comma separated list given by the client.
 
+        Only the difference between the current and requested tag sets is 
+        written, as one delete and one bulk insert inside a transaction.
+
         Parameters:
 
         tags: A comma separated list of tags to update the post set to. 
@@ -77,20 +103,63 @@ class PostViewSet(viewsets.ModelViewSet):
                                 status=404)
         # It'd be quite the bug if you could delete the tags on someone else's
         # post
-        if post.user != request.user:
+        current = get_user_context(request)
+        if not current.is_user(post.user_id):
             return HttpResponse(
-                "User {} is not the author of this post ({})".format(request.user.username,
+                "User {} is not the author of this post ({})".format(current.user.username,
                                                                      post.user.username),
                 status=403)
-        tags = Tag.objects.filter(document_id=pk).delete()
+        if current.is_banned:
+            return HttpResponse("User {} is banned until {}".format(
+                current.user.username, current.banned_until.isoformat()), status=403)
+        # Normalize and deduplicate the requested tags, keeping client order
+        requested = []
+        requested_texts = set()
         for new_tag_text in request.POST["tags"].split(","):
-            new_tag = Tag(user=request.user,
+            new_tag = Tag(user=current.user,
                           document_id=pk,
                           type="post",
-                          created_at = datetime.datetime.now(),
+                          created_at=datetime.datetime.now(),
                           text=new_tag_text)
-            new_tag.full_clean()
-            new_tag.save()
+            new_tag.clean()
+            if new_tag.text not in requested_texts:
+                requested_texts.add(new_tag.text)
+                requested.append(new_tag)
+        existing = Tag.objects.filter(document_id=pk, type="post")
+        existing_texts = set(existing.values_list("text", flat=True))
+        to_create = [tag for tag in requested if tag.text not in existing_texts]
+        to_delete = existing_texts - requested_texts
+        # Validate everything up front so a bad tag can't leave a partial update
+        errors = []
+        for new_tag in to_create:
+            try:
+                # The author was checked above and the vocabulary entry is
+                # assigned below, skip the per-tag lookups
+                new_tag.full_clean(exclude=["user", "tag_name"])
+            except ValidationError as e:
+                errors.extend(e.messages)
+        if errors:
+            return HttpResponse(JSONRenderer().render(errors),
+                                content_type="application/json",
+                                status=400)
+        count_deltas = {}
+        with transaction.atomic():
+            if to_delete:
+                # Count the rows actually deleted, a text can have more than one
+                deleted = list(existing.filter(text__in=to_delete).select_for_update(
+                    ).values_list("id", "tag_name_id"))
+                Tag.objects.filter(id__in=[tag_id for tag_id, tag_name_id in deleted]).delete()
+                for tag_id, tag_name_id in deleted:
+                    count_deltas[tag_name_id] = count_deltas.get(tag_name_id, 0) - 1
+            if to_create:
+                tag_names = wl_tags.resolve_tag_names(
+                    [tag.text for tag in to_create])
+                for new_tag in to_create:
+                    new_tag.tag_name = tag_names[wl_tags.normalize_tag_key(new_tag.text)]
+                    count_deltas[new_tag.tag_name.id] = (
+                        count_deltas.get(new_tag.tag_name.id, 0) + 1)
+                Tag.objects.bulk_create(to_create)
+            wl_tags.adjust_tag_counts(count_deltas)
         return HttpResponse("Tags updated")
     
 class CommentViewSet(viewsets.ModelViewSet):
@@ -106,8 +175,10 @@ class CommentViewSet(viewsets.ModelViewSet):
     
     def destroy(self, request, pk=None):
         comment = self.queryset.get(id=pk)
-        if comment.user != request.user:
+        current = get_user_context(request)
+        if not current.is_user(comment.user_id):
             raise ValueError("Only a comments author can delete their comment")
+        current.require_write()
         comment.is_deleted = True
         comment.save()
         return HttpResponse("Comment deleted")
@@ -120,7 +191,122 @@ class TagViewSet(viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     filter_fields = ('user','document_id','text',)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            wl_tags.adjust_tag_counts({instance.tag_name_id:-1})
+
+class TagNameViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint for the tag vocabulary, most used tags first.
+
+    Parameters:
+
+    limit: How many tags to list, at most 100.
+    """
+    queryset = TagName.objects.filter(count__gt=0).order_by('-count', 'key')
+    serializer_class = TagNameSerializer
+    lookup_field = 'key'
+    lookup_value_regex = '[^/]+'
+
+    def get_object(self):
+        try:
+            return TagName.objects.get(
+                key=wl_tags.normalize_tag_key(self.kwargs["key"]))
+        except TagName.DoesNotExist:
+            raise Http404("No tag named '{}'".format(self.kwargs["key"]))
+
+    def list(self, request):
+        limit = parse_limit(request.GET.get("limit"), default=20)
+        serializer = TagNameSerializer(wl_tags.top_tags(limit), many=True,
+                                       context={'request': request})
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def posts(self, request, key=None):
+        """List the posts with this tag.
+
+        Parameters:
+
+        order: 'recent' (default) or 'score'.
+        limit: How many posts to return, at most 100.
+        offset: How many posts to skip."""
+        limit = parse_limit(request.GET.get("limit"), default=20)
+        offset = parse_limit(request.GET.get("offset"), default=0, maximum=None)
+        try:
+            posts = wl_tags.posts_with_tag(key, request.GET.get("order", "recent"))
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
+        post_serializer = PostSerializer(posts[offset:offset + limit],
+                                         context={'request': request}, many=True)
+        return Response(post_serializer.data)
         
+class TagAutocompleteView(viewsets.ViewSet):
+    """Suggest tags starting with ?prefix=, most used first.
+
+    Served from an in-memory index of the tag vocabulary, so lookups don't
+    touch the database.
+
+    Parameters:
+
+    prefix: The start of the tag text, matched case insensitively.
+    limit: How many suggestions to return, at most 50."""
+    def list(self, request):
+        limit = parse_limit(request.GET.get("limit"), default=10,
+                            maximum=wl_tags.TagPrefixIndex.MAX_SUGGESTIONS)
+        suggestions = wl_tags.tag_prefix_index.suggest(
+            request.GET.get("prefix", ""), limit)
+        return Response([{"key":key, "text":text, "count":count}
+                         for key, text, count in suggestions])
+
+class FuzzyLookupView(viewsets.ViewSet):
+    """Find posts by title or users by name with ?query=, tolerating typos
+    and partial input. Meant for quick-jump and @-mention boxes.
+
+    Results are ranked with titles or names containing the query first, then
+    by trigram similarity, which is given as each result's score.
+
+    Parameters:
+
+    query: The partial or misspelled title or name.
+    type: What to look up, 'posts' (the default) or 'users'.
+    limit: How many results to return, at most 50."""
+    def list(self, request):
+        collection = request.GET.get("type", "posts")
+        if collection not in ("posts", "users"):
+            return HttpResponse("type must be 'posts' or 'users'", status=400)
+        limit = parse_limit(request.GET.get("limit"), default=10, maximum=50)
+        matches = wl_fuzzy.lookup(collection, request.GET.get("query", ""), limit)
+        ids = [document_id for document_id, score in matches]
+        if collection == "posts":
+            posts = Post.objects.only("id", "title", "slug").in_bulk(ids)
+            return Response([{"_id":post_id, "title":posts[post_id].title,
+                              "slug":posts[post_id].slug, "score":score}
+                             for post_id, score in matches if post_id in posts])
+        users = User.objects.select_related("profile").only(
+            "id", "username", "profile__display_name").in_bulk(ids)
+        results = []
+        for user_id, score in matches:
+            if user_id not in users:
+                continue
+            user = users[user_id]
+            try:
+                display_name = user.profile.display_name
+            except Profile.DoesNotExist:
+                display_name = None
+            results.append({"id":user_id, "username":user.username,
+                            "displayName":display_name, "score":score})
+        return Response(results)
+
+class NotificationMetricsView(viewsets.ViewSet):
+    """Counters for the notification fan-out stage of this process, for staff.
+    See lw2.notifications.fanout_metrics for what they mean."""
+    permission_classes = (IsAdminUser,)
+
+    def list(self, request):
+        return Response(wl_notifications.fanout_metrics())
+
 class VoteViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows votes to be viewed or edited.
@@ -160,49 +346,282 @@ class InviteList(viewsets.ViewSet):
         if user.is_authenticated:
             return Response(invite_serializer.data)
 
-# TODO: Refactor these to both inherit from one class or use same underlying method
-# definition
-class PostSearchView(viewsets.ViewSet):
-    """Search posts with a query string ?query=
+def keyset_order(results):
+    """Order search results by a key that's unique to each row, so a page
+    can pick up after the last row of the one before: best rank first for
+    ranked results and newest first for the rest, ties broken by primary
+    key. Returns the ordered results and a function from a row to its key."""
+    if "search_rank" in results.query.extra_select:
+        ascending = wl_fulltext.get_backend().rank_ascending
+        return (results.order_by("search_rank" if ascending else "-search_rank", "-pk"),
+                lambda row: [row.search_rank, row.pk])
+    return (results.order_by("-posted_at", "-pk"),
+            lambda row: [row.posted_at.isoformat(), row.pk])
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps({"after":key}).encode()).decode()
+
+def after_cursor(results, cursor):
+    """The results from keyset_order() that come after the row a cursor
+    from encode_cursor() was made from. Raises ValueError for cursors that
+    don't fit the results."""
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())["after"]
+        if not isinstance(pk, str):
+            raise TypeError(pk)
+        if "search_rank" not in results.query.extra_select:
+            posted_at = parse_datetime(value)
+            if posted_at is None:
+                raise ValueError(value)
+            return results.filter(Q(posted_at__lt=posted_at) |
+                                  Q(posted_at=posted_at, pk__lt=pk))
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(value)
+    except (ValueError, TypeError, KeyError, UnicodeError):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+    # The rank is an expression, compare against it as the ordering does
+    rank_sql, rank_params = results.query.extra_select["search_rank"]
+    pk_column = "{}.{}".format(results.model._meta.db_table,
+                               results.model._meta.pk.column)
+    worse = ">" if wl_fulltext.get_backend().rank_ascending else "<"
+    return results.extra(
+        where=["({rank} {worse} %s OR ({rank} = %s AND {pk} < %s))".format(
+            rank=rank_sql, worse=worse, pk=pk_column)],
+        params=list(rank_params) + [value] + list(rank_params) + [value, pk])
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets views accept requests for text/event-stream, which they answer
+    with their own StreamingHttpResponse."""
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data)
+
+class EventsView(viewsets.ViewSet):
+    """Wait for new notifications, instead of polling NotificationsList and
+    MessagesList. Answers as soon as the logged in user has notifications
+    after ?since=, or with none after ?timeout= seconds:
+
+    {"cursor": 1234, "notifications": [1233, 1234], "messages": ["56"]}
+
+    notifications are the new notifications' ids and messages the ids of
+    the new messages among them. Pass cursor as since on the next request.
+    Without since the answer is immediate, with the cursor to start from.
+
+    With the header Accept: text/event-stream the response is instead an
+    event stream of the same objects as they happen, each with the cursor as
+    its id. It ends after NOTIFICATION_EVENTS_STREAM_SECONDS, reconnect with
+    the Last-Event-ID header to carry on.
+
+    Parameters:
+
+    since: The cursor from the previous answer. The Last-Event-ID header
+    does the same, for either kind of response.
+    timeout: How many seconds to wait, at most NOTIFICATION_EVENTS_TIMEOUT."""
+    permission_classes = (IsAuthenticated,)
+    renderer_classes = (JSONRenderer, EventStreamRenderer)
+
+    def list(self, request):
+        user_id = request.user.id
+        given = request.GET.get("since", request.META.get("HTTP_LAST_EVENT_ID"))
+        since = given
+        if since is None:
+            since = wl_events.latest_notification_id(user_id)
+        else:
+            try:
+                since = int(since)
+            except ValueError:
+                return HttpResponse("since must be a cursor", status=400)
+        maximum = getattr(settings, "NOTIFICATION_EVENTS_TIMEOUT", 30)
+        timeout = parse_limit(request.GET.get("timeout"), default=maximum,
+                              maximum=maximum)
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            response = StreamingHttpResponse(self.stream(user_id, since, timeout),
+                                             content_type="text/event-stream")
+            response["Cache-Control"] = "no-cache"
+            return response
+        if given is None:
+            return Response(self.serialize((since, [], [])))
+        return Response(self.serialize(
+            wl_events.wait_for_events(user_id, since, timeout)))
+
+    def serialize(self, events):
+        cursor, notification_ids, message_ids = events
+        return {"cursor":cursor, "notifications":notification_ids,
+                "messages":message_ids}
+
+    def stream(self, user_id, since, timeout):
+        deadline = time.monotonic() + getattr(
+            settings, "NOTIFICATION_EVENTS_STREAM_SECONDS", 300)
+        # Tell the client where it's starting from
+        yield "id: {}\ndata: {}\n\n".format(
+            since, json.dumps(self.serialize((since, [], []))))
+        while time.monotonic() < deadline:
+            events = wl_events.wait_for_events(
+                user_id, since, min(timeout or 1, deadline - time.monotonic()))
+            if events[1]:
+                since = events[0]
+                yield "id: {}\ndata: {}\n\n".format(
+                    since, json.dumps(self.serialize(events)))
+            else:
+                # Keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+
+class SearchView(viewsets.ViewSet):
+    """Base class for searching a collection with a query string ?query=
+
+    Results come a page at a time as a JSON list. The response headers say 
+    how to get the rest:
+
+    - X-Total-Hits: How many documents matched, counted up to 
+      SEARCH_COUNT_LIMIT.
+    - X-Total-Hits-Relation: 'eq' if X-Total-Hits is exact, 'gte' if there 
+      were more matches than were counted.
+    - X-Next-Cursor: Pass as ?cursor= to get the next page, absent on the 
+      last page. Also given as a Link header. It holds the last result's 
+      rank, or its date for unranked results, and the next page starts 
+      after that rather than at a count of rows.
+
+    Parameters:
+
+    query: The search string.
+    limit: How many results per page, at most SEARCH_PAGE_SIZE_MAX.
+    cursor: Where to continue from, see X-Next-Cursor.
+    stream: If true, stream every result from the cursor onwards as one JSON
+    list instead of returning a page.
+    fields: Comma separated names of the fields to return for each result, 
+    e.g _id,title,body. By default every field but body, and snippet.
+
+    Besides the serializer's fields each result can have a snippet, an 
+    excerpt of its body as HTML, escaped, with the search terms in <mark> 
+    tags. The whole body is left out unless asked for, since the snippet 
+    stands in for it and bodies are most of the response.
 
     See search.py for a quick guide to the search syntax rules."""
+    model = None
+    serializer_class = None
+    # How many rows to serialize at a time when streaming
+    stream_chunk_size = 100
+
+    def parse_fields(self, request):
+        """Return the field names asked for with ?fields=, or the defaults."""
+        if not request.GET.get("fields"):
+            return [field for field in self.serializer_class.Meta.fields
+                    if field != "body"] + ["snippet"]
+        fields = [field.strip() for field in request.GET["fields"].split(",")
+                  if field.strip()]
+        known = set(self.serializer_class.Meta.fields) | {"snippet"}
+        unknown = [field for field in fields if field not in known]
+        if unknown:
+            raise ValueError("Unknown fields: {}".format(", ".join(unknown)))
+        return fields
+
+    def serialize(self, request, rows, plan, fields):
+        """Serialize rows as a list of dicts with only the requested fields,
+        and their snippets."""
+        serializer = self.serializer_class(rows, context={'request': request},
+                                           many=True)
+        for name in list(serializer.child.fields):
+            if name not in fields:
+                serializer.child.fields.pop(name)
+        data = serializer.data
+        if "snippet" in fields:
+            for row, result in zip(rows, data):
+                snippet = getattr(row, "search_snippet", None)
+                if snippet is None:
+                    snippet = wl_search.mk_snippet(plan, row.body)
+                else:
+                    snippet = wl_fulltext.render_snippet(snippet)
+                result["snippet"] = snippet
+        return data
+
     def list(self, request):
         try:
-            parsed_search = wl_search.parse_search_string(request.GET["query"])
+            query = request.GET["query"]
         except MultiValueDictKeyError:
             raise ValueError("Didn't specify a query string. Use ?query=")
-        filters = wl_search.mk_search_filters(parsed_search)
-        posts = Post.objects.all()
-        for _filter in filters:
-            if _filter["exclude"]:
-                posts = posts.exclude(_filter["Q"])
-            else:
-                posts = posts.filter(_filter["Q"])
-        post_serializer = PostSerializer(posts, context={'request': request}, many=True)
-        return HttpResponse(JSONRenderer().render(post_serializer.data),
-                            content_type="application/json")
+        try:
+            fields = self.parse_fields(request)
+            snippets = "snippet" in fields
+            plan = wl_search.parse_search_string(query)
+            results, key = keyset_order(
+                wl_search.search(self.model.objects.all(), query, snippets))
+            cursor = request.GET.get("cursor")
+            page_results = after_cursor(results, cursor) if cursor else results
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
+        if "body" not in fields and (
+                not snippets or "search_snippet" in results.query.extra_select):
+            # Nothing needs the bodies, which are most of the row
+            page_results = page_results.defer("body")
+        if request.GET.get("stream", "").lower() in ("1", "true", "yes"):
+            return StreamingHttpResponse(
+                self.stream(request, page_results, plan, fields),
+                content_type="application/json")
+        limit = parse_limit(request.GET.get("limit"),
+                            default=getattr(settings, "SEARCH_PAGE_SIZE", 50),
+                            maximum=getattr(settings, "SEARCH_PAGE_SIZE_MAX", 200))
+        # Fetch one extra row to find out whether there's a next page
+        page = list(page_results[:limit + 1])
+        has_next = len(page) > limit
+        page = page[:limit]
+        response = HttpResponse(
+            JSONRenderer().render(self.serialize(request, page, plan, fields)),
+            content_type="application/json")
+        if not cursor and not has_next:
+            # The whole result set fit on this page, no need to count it
+            total, relation = len(page), "eq"
+        else:
+            count_limit = getattr(settings, "SEARCH_COUNT_LIMIT", 1000)
+            total = results[:count_limit + 1].count()
+            relation = "eq" if total <= count_limit else "gte"
+            total = min(total, count_limit)
+        response["X-Total-Hits"] = str(total)
+        response["X-Total-Hits-Relation"] = relation
+        if has_next:
+            next_cursor = encode_cursor(key(page[-1]))
+            params = request.GET.copy()
+            params["cursor"] = next_cursor
+            response["X-Next-Cursor"] = next_cursor
+            response["Link"] = '<{}?{}>; rel="next"'.format(
+                request.build_absolute_uri(request.path), params.urlencode())
+        return response
+
+    def stream(self, request, results, plan, fields):
+        """Yield the results as a JSON list, a chunk of rows at a time."""
+        yield "["
+        first = True
+        chunk = []
+        for result in results.iterator(chunk_size=self.stream_chunk_size):
+            chunk.append(result)
+            if len(chunk) == self.stream_chunk_size:
+                yield self.render_chunk(request, chunk, plan, fields, first)
+                first = False
+                chunk = []
+        if chunk:
+            yield self.render_chunk(request, chunk, plan, fields, first)
+        yield "]"
+
+    def render_chunk(self, request, chunk, plan, fields, first):
+        data = self.serialize(request, chunk, plan, fields)
+        # Render as a list and strip the brackets to join onto the stream
+        rendered = JSONRenderer().render(data).decode("UTF-8")[1:-1]
+        return rendered if first else "," + rendered
+
+class PostSearchView(SearchView):
+    """Search posts with a query string ?query=
+
+    See search.py for a quick guide to the search syntax rules."""
+    model = Post
+    serializer_class = PostSerializer
         
-class CommentSearchView(viewsets.ViewSet):
+class CommentSearchView(SearchView):
     """Search comments with a query string ?query=
 
     See search.py for a quick guide to the search syntax rules."""
-    def list(self, request):
-        try:
-            parsed_search = wl_search.parse_search_string(request.GET["query"])
-        except MultiValueDictKeyError:
-            raise ValueError("Didn't specify a query string. Use ?query=")
-        filters = wl_search.mk_search_filters(parsed_search)
-        comments = Comment.objects.all()
-        for _filter in filters:
-            if _filter["exclude"]:
-                comments = comments.exclude(_filter["Q"])
-            else:
-                comments = comments.filter(_filter["Q"])
-        comment_serializer = CommentSerializer(comments,
-                                               context={'request': request},
-                                               many=True)
-        return HttpResponse(JSONRenderer().render(comment_serializer.data),
-                            content_type="application/json")
+    model = Comment
+    serializer_class = CommentSerializer
 
 class AnnotationList(viewsets.ViewSet):
     """Get a list of hypothes.is annotations for a given user."""